@@ -16,7 +16,9 @@
 #   limitations under the License.                                            #
 # --------------------------------------------------------------------------- #
 
+import importlib
 import os
+import time
 
 import click
 
@@ -27,12 +29,14 @@ Did not find conf.py. You should copy the file sample_conf.py
 
 and then adapt conf.py as desired.
 """
+conf_import_start = time.perf_counter()
 try:
     import conf
 except ModuleNotFoundError:
     print(MISSING_CONF_ERR_MSG)
     import sys
     sys.exit(1)
+CONF_IMPORT_SECONDS = time.perf_counter() - conf_import_start
 
 PFSC_MANAGE_ROOT = os.path.dirname(__file__)
 # In the standard, recommended installation, the top-level directory
@@ -41,20 +45,94 @@ PFSC_MANAGE_ROOT = os.path.dirname(__file__)
 PFSC_ROOT = getattr(conf, 'PFSC_ROOT', None) or os.path.dirname(PFSC_MANAGE_ROOT)
 
 
-@click.group()
-def cli():
-    pass
-
-# These imports define all the commands.
-import tools.basic
-import tools.build
-import tools.deploy
-import tools.gdb
-#import tools.install
-import tools.license
-import tools.make
-import tools.repo
-import tools.update
-import tools.release
-import tools.grep
-import tools.get
+# Each subcommand of `pfsc` is defined in one of the `tools` modules. Importing
+# all of those modules at startup is slow (they pull in `requests`, build Jinja
+# environments, construct large tables of license info, etc.), so instead we
+# record here just the name of each subcommand, the module defining it, and its
+# short help text. A module is imported only when its command is actually run.
+LAZY_COMMANDS = {
+    'bench': ('tools.bench', 'Benchmarks for the pfsc tool, and the images it builds.'),
+    'build': ('tools.build', 'Tools for building docker images for development.'),
+    'deploy': ('tools.deploy', 'Utilities for deploying docker containers.'),
+    'gdb': ('tools.gdb', 'Utilities for the graph database.'),
+    'get': ('tools.get', 'Utilities for downloading various resources.'),
+    'grep': ('tools.grep', 'Grep the licensable files of projects.'),
+    'license': ('tools.license', 'Generate combined license files and "About" dialogs.'),
+    'make': ('tools.make', 'Make/build/compile for various projects.'),
+    'makestruct': ('tools.basic', 'Build the directory structure for Proofscape.'),
+    'release': ('tools.release', 'Tools for building docker images for release.'),
+    'repo': ('tools.repo', 'Utilities for cloning source repos.'),
+    'update': ('tools.update', 'Utilities for updating things like copyright statements.'),
+}
+
+
+class LazyGroup(click.Group):
+    """
+    A click group that knows the names of its subcommands up front, but
+    imports the module defining a subcommand only when that subcommand is
+    requested.
+
+    The modules register their commands on `cli` in the usual way, i.e. via
+    the `@cli.command()` and `@cli.group()` decorators, so importing the module
+    is all that is needed.
+    """
+
+    def __init__(self, *args, lazy_commands=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.lazy_commands = lazy_commands or {}
+        # Record how long it took to import each module, for `--timings`:
+        self.import_seconds = {}
+
+    def list_commands(self, ctx):
+        return sorted(set(super().list_commands(ctx)) | set(self.lazy_commands))
+
+    def get_command(self, ctx, cmd_name):
+        if cmd_name not in self.commands and cmd_name in self.lazy_commands:
+            module_name, _ = self.lazy_commands[cmd_name]
+            t0 = time.perf_counter()
+            importlib.import_module(module_name)
+            self.import_seconds[module_name] = time.perf_counter() - t0
+        return super().get_command(ctx, cmd_name)
+
+    def format_commands(self, ctx, formatter):
+        """
+        Like `click.Group.format_commands()`, except that we use our recorded
+        short help text for any command that has not been loaded, instead of
+        importing its module.
+        """
+        names = self.list_commands(ctx)
+        if not names:
+            return
+        limit = formatter.width - 6 - max(len(name) for name in names)
+        rows = []
+        for name in names:
+            cmd = self.commands.get(name)
+            if cmd is None:
+                help_text = self.lazy_commands[name][1]
+            elif cmd.hidden:
+                continue
+            else:
+                help_text = cmd.get_short_help_str(limit)
+            rows.append((name, help_text))
+        if rows:
+            with formatter.section('Commands'):
+                formatter.write_dl(rows)
+
+
+def load_all_commands():
+    """
+    Import every module that defines commands. This restores the old behavior
+    of eager loading, and is useful for benchmarking and testing.
+    """
+    for module_name, _ in LAZY_COMMANDS.values():
+        importlib.import_module(module_name)
+
+
+@click.group(cls=LazyGroup, lazy_commands=LAZY_COMMANDS)
+@click.option('--timings', is_flag=True, help="Print a table of time spent in each phase of the command.")
+@click.option('--profile', 'profile_path', metavar='FILE', help="Run the command under cProfile, and dump stats to FILE.")
+@click.pass_context
+def cli(ctx, timings, profile_path):
+    if timings or profile_path:
+        from tools.timing import start_session
+        start_session(ctx, timings=timings, profile_path=profile_path)
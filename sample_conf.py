@@ -53,6 +53,35 @@ AUTH_BASIC_TITLE = "Testing Area"
 AUTH_BASIC_USERNAME = "dev"
 AUTH_BASIC_PASSWORD = None
 
+# Static File Serving
+#
+# The front end Nginx server serves static assets directly. Those under a
+# versioned path (such as `/static/ise/v25.0`) never change, so are sent with
+# `Cache-Control: public, max-age=31536000, immutable`. Others (such as
+# `/static/PDFLibrary` and `/static/whl`) may change, so are cached for only
+# `NGINX_STATIC_MAX_AGE` seconds. Set `NGINX_STATIC_CACHING = False` to send no
+# caching headers at all. (Caching headers are sent only under the production
+# Flask config, since in development the assets change under fixed versions.)
+NGINX_STATIC_CACHING = True
+NGINX_STATIC_MAX_AGE = 3600
+# File I/O: `sendfile` (with `tcp_nopush`) lets the kernel copy files straight
+# to the socket; `open_file_cache` saves repeated open/stat calls; and
+# `aio threads` keeps large reads (like `pyodide.asm.wasm`, or big PDFs) from
+# blocking an Nginx worker.
+NGINX_SENDFILE = True
+NGINX_OPEN_FILE_CACHE = True
+NGINX_AIO_THREADS = True
+
+# Compression of Proxied Responses
+#
+# Methods by which the front end Nginx server compresses responses from the
+# pfsc web server on the fly (JSON dashgraphs, built modules, HTML pages, etc.).
+# May contain 'gzip' and 'brotli'. As with `STATIC_PRECOMPRESS` (below),
+# brotli requires an nginx image with the ngx_brotli module (see
+# `NGINX_IMAGE_TAG`). Set to an empty list to turn compression off. Use
+# `pfsc bench compression` to measure the effect.
+NGINX_PROXY_COMPRESS = ['gzip']
+
 # Twin Site
 #
 # In some MCA deployments you may want a "twin" or "companion" site, to be
@@ -149,12 +178,28 @@ REDISGRAPH_IMAGE_TAG = '2.4.13'
 NEO4J_IMAGE_TAG = '4.0.6'
 GREMLIN_SERVER_IMAGE_TAG = '3.6.0'
 JANUSGRAPH_IMAGE_TAG = '0.6.0'
+# (To run more than one pfscweb replica, via `pfsc deploy generate -r`, the
+# nginx image must be at least 1.27.3.)
 NGINX_IMAGE_TAG = '1.22.0'
 # If you want RedisInsight to be dispatched as part of the MCA when RedisGraph
 # is being used, set a version tag here. Otherwise leave as None.
 # REDISINSIGHT_IMAGE_TAG = '1.11.0'
 REDISINSIGHT_IMAGE_TAG = None
 
+# Resource Budget
+#
+# Set `RESOURCE_BUDGET = True` to have `pfsc deploy generate` write CPU and
+# memory limits (`cpus`, `mem_limit`) into the generated compose files. The
+# host's cores and memory, less a reserve for the host itself, are divided
+# among the services by role, and the graph database and the workers are
+# pinned to disjoint sets of cores (`cpuset`). By default the cores and memory
+# of the machine where you run `pfsc` are used; if you are generating a
+# deployment for another machine, set its number of cores and its memory (in
+# MiB) here.
+RESOURCE_BUDGET = False
+RESOURCE_BUDGET_CPUS = None
+RESOURCE_BUDGET_MEM_MB = None
+
 # Wheel Files
 #
 # During development, the Python wheels running in the browser via Pyodide
@@ -196,6 +241,75 @@ APP_URL_PREFIX = None
 # operations (such as `docker build`, `docker run`, etc.). Depending on your
 # environment, you may need to substitute 'sudo docker' here.
 DOCKER_CMD = 'docker'
+# Similarly, `DOCKER_COMPOSE_CMD` is used by `pfsc deploy up`. With Compose V2
+# you may want 'docker compose' here.
+DOCKER_COMPOSE_CMD = 'docker-compose'
+
+# Docker Engine API
+#
+# Optionally, set `DOCKER_SOCKET` to the path of the Docker daemon's unix socket
+# (normally '/var/run/docker.sock') to have `pfsc` talk to the Docker Engine
+# API directly, instead of running `DOCKER_CMD`, where it can. This gives
+# structured build progress, image inspection without subprocesses, and lets
+# `pfsc license` query an image by `exec` in a single container. (Builds using
+# BuildKit, i.e. with `BUILDKIT_CACHE` or `REPRODUCIBLE_BUILDS`, still use
+# `DOCKER_CMD`.)
+DOCKER_SOCKET = None
+
+# BuildKit Cache
+#
+# Set `BUILDKIT_CACHE = True` to have `pfsc build` use BuildKit (via
+# `docker buildx build`), with persistent cache mounts for pip and apt
+# downloads, and a local layer cache under `PFSC_ROOT/build-cache/buildkit`.
+# This makes incremental builds much faster, e.g. after a change to the
+# pfsc-server requirements. Exporting the layer cache requires a builder using
+# the `docker-container` driver, which you can set up with
+#   docker buildx create --use --driver docker-container
+BUILDKIT_CACHE = False
+# Optionally, keep the BuildKit layer cache in a registry instead, so that it
+# can be shared between machines (best combined with `REPRODUCIBLE_BUILDS`).
+# Set this to a registry and repository prefix, e.g. 'registry.example.org/pfsc'.
+# Each image's cache is then stored as `PREFIX/IMAGE_NAME:buildcache`.
+BUILDKIT_CACHE_REGISTRY = None
+
+# Reproducible Builds
+#
+# Set `REPRODUCIBLE_BUILDS = True` to have `pfsc build` produce identical layers
+# from identical sources, on any machine. This requires BuildKit (via
+# `docker buildx build`). Files in the build context get normalized times and
+# permissions, and the times of all files in all layers are set to
+# `SOURCE_DATE_EPOCH`. If that is `None`, we use the time of the last commit
+# in pfsc-server. Use `pfsc build check-repro` to check a build.
+REPRODUCIBLE_BUILDS = False
+SOURCE_DATE_EPOCH = None
+
+# Bytecode Strategy
+#
+# How `pfsc build` handles Python bytecode in the pfsc-server and OCA images.
+#   'strip': delete all `.pyc` files. Containers compile on demand, each time
+#       they start up.
+#   'compile': precompile everything in the final layer, using deterministic
+#       (checked-hash) pycs, so that the image ships with warm bytecode.
+# Use `pfsc bench coldstart` to compare container startup times.
+BYTECODE_STRATEGY = 'strip'
+
+# Static Precompression
+#
+# Methods by which `pfsc build static` precompresses static assets at build
+# time, writing e.g. `ise.bundle.js.gz` next to `ise.bundle.js`, so that nginx
+# can serve them via `gzip_static`, and never compresses static files on the
+# fly. May contain 'gzip' and 'brotli'. Note that serving the .br files
+# requires an nginx image with the ngx_brotli module, which the official images
+# lack. Use `pfsc bench precompress` to see what is saved.
+STATIC_PRECOMPRESS = ['gzip']
+
+# Layer Rewrite Limit
+#
+# If set to a number, then after each `pfsc build`, we check that no layer of
+# the new image (above its base image) rewrites more than this many megabytes
+# of files already present in earlier layers, as e.g. a `RUN chown -R` would.
+# The build fails if the check fails. See also `pfsc build check-layers`.
+LAYER_REWRITE_LIMIT_MB = None
 
 ##############################################################################
 # Infrastructure-specific settings
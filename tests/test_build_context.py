@@ -0,0 +1,133 @@
+# --------------------------------------------------------------------------- #
+#   Proofscape Manage                                                         #
+#                                                                             #
+#   Copyright (c) 2021-2022 Proofscape contributors                           #
+#                                                                             #
+#   Licensed under the Apache License, Version 2.0 (the "License");           #
+#   you may not use this file except in compliance with the License.          #
+#   You may obtain a copy of the License at                                   #
+#                                                                             #
+#       http://www.apache.org/licenses/LICENSE-2.0                            #
+#                                                                             #
+#   Unless required by applicable law or agreed to in writing, software       #
+#   distributed under the License is distributed on an "AS IS" BASIS,         #
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.  #
+#   See the License for the specific language governing permissions and       #
+#   limitations under the License.                                            #
+# --------------------------------------------------------------------------- #
+
+import io
+import tarfile
+
+from tools.build_context import (
+    BuildContext, CONTEXT_DOCKERFILE_NAME,
+    find_final_base_image, list_base_images, list_context_sources,
+    list_final_stage_instructions, parse_copy_args, prune_nested,
+)
+
+DOCKERFILE = """\
+FROM redislabs/redisgraph:2.4.13 AS rg
+FROM python:3.8.12-slim-buster
+# COPY commented/out ./
+COPY --from=rg /usr/local/bin/redis-server /usr/local/bin
+COPY pfsc-server/req/requirements.txt requirements.txt
+COPY --chown=pfsc:pfsc pfsc-server/pfsc pfsc
+COPY a.txt \\
+     b.txt ./
+ADD https://example.org/x.tar.gz /tmp/
+COPY ["c d.txt", "./"]
+"""
+
+
+def test_parse_copy_args():
+    flags, srcs, dest = parse_copy_args('--chown=pfsc:pfsc --link a b ./')
+    assert flags == {'chown': 'pfsc:pfsc', 'link': True}
+    assert srcs == ['a', 'b']
+    assert dest == './'
+
+
+def test_list_context_sources():
+    assert list_context_sources(DOCKERFILE) == [
+        'pfsc-server/req/requirements.txt',
+        'pfsc-server/pfsc',
+        'a.txt', 'b.txt',
+        'c d.txt',
+    ]
+
+
+def test_list_base_images():
+    df = DOCKERFILE + 'FROM rg AS again\nFROM --platform=linux/amd64 nginx\n'
+    assert list_base_images(df) == [
+        'redislabs/redisgraph:2.4.13', 'python:3.8.12-slim-buster', 'nginx',
+    ]
+
+
+def test_find_final_base_image():
+    assert find_final_base_image(DOCKERFILE) == 'python:3.8.12-slim-buster'
+    df = 'FROM python:3.8 AS oca\nFROM oca AS licenses\nFROM oca\n'
+    assert find_final_base_image(df) == 'python:3.8'
+
+
+def test_list_final_stage_instructions():
+    df = ('FROM python:3.8 AS oca\nRUN a\n'
+          'FROM oca AS licenses\nRUN b\n'
+          'FROM oca\nCOPY --from=licenses x y\n')
+    assert list_final_stage_instructions(df) == [
+        ('RUN', 'a'), ('COPY', '--from=licenses x y'),
+    ]
+
+
+def test_prune_nested():
+    assert prune_nested(['a/b/c', 'a/b', 'a/bc', 'd']) == ['a/b', 'a/bc', 'd']
+
+
+def test_write_tar(tmp_path):
+    (tmp_path / 'pkg' / '__pycache__').mkdir(parents=True)
+    (tmp_path / 'pkg' / '__pycache__' / 'x.cpython-38.pyc').write_bytes(b'x')
+    (tmp_path / 'pkg' / 'mod.py').write_text('print(1)\n')
+    (tmp_path / 'other.txt').write_text('not copied')
+    df = 'FROM python\nCOPY pkg pkg\nCOPY missing ./\n'
+    context = BuildContext(df, str(tmp_path))
+    assert context.sources == ['pkg']
+    assert context.missing == ['missing']
+    buf = io.BytesIO()
+    assert context.write_tar(buf) == (1, 9)
+    buf.seek(0)
+    names = tarfile.open(fileobj=buf).getnames()
+    assert names == [CONTEXT_DOCKERFILE_NAME, 'pkg', 'pkg/mod.py']
+
+
+def test_write_tar_normalized(tmp_path):
+    (tmp_path / 'pkg').mkdir()
+    (tmp_path / 'pkg' / 'mod.py').write_text('print(1)\n')
+    (tmp_path / 'pkg' / 'run.sh').write_text('#!/bin/sh\n')
+    (tmp_path / 'pkg' / 'mod.py').chmod(0o600)
+    (tmp_path / 'pkg' / 'run.sh').chmod(0o700)
+    context = BuildContext('FROM python\nCOPY pkg pkg\n', str(tmp_path))
+    buf = io.BytesIO()
+    context.write_tar(buf, mtime=1234)
+    buf.seek(0)
+    members = {m.name: m for m in tarfile.open(fileobj=buf).getmembers()}
+    assert members['pkg/mod.py'].mode == 0o644
+    assert members['pkg/run.sh'].mode == 0o755
+    assert members['pkg'].mode == 0o755
+    assert {m.mtime for m in members.values() if m.name != CONTEXT_DOCKERFILE_NAME} == {1234}
+    assert {m.uid for m in members.values()} == {0}
+
+
+def test_digest(tmp_path):
+    (tmp_path / 'pkg' / '__pycache__').mkdir(parents=True)
+    (tmp_path / 'pkg' / 'mod.py').write_text('print(1)\n')
+    (tmp_path / 'other.txt').write_text('not copied')
+    df = 'FROM python\nCOPY pkg pkg\n'
+    d0 = BuildContext(df, str(tmp_path)).digest()
+    assert d0.startswith('sha256:')
+    # Unaffected by files outside the context, and by bytecode:
+    (tmp_path / 'other.txt').write_text('changed')
+    (tmp_path / 'pkg' / '__pycache__' / 'mod.cpython-38.pyc').write_bytes(b'x')
+    assert BuildContext(df, str(tmp_path)).digest() == d0
+    # Affected by file contents, the Dockerfile, and extras:
+    assert BuildContext(df, str(tmp_path)).digest(extras=['sha256:abc']) != d0
+    assert BuildContext(df + 'USER pfsc\n', str(tmp_path)).digest() != d0
+    (tmp_path / 'pkg' / 'mod.py').write_text('print(2)\n')
+    assert BuildContext(df, str(tmp_path)).digest() != d0
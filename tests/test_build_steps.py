@@ -0,0 +1,70 @@
+# --------------------------------------------------------------------------- #
+#   Proofscape Manage                                                         #
+#                                                                             #
+#   Copyright (c) 2021-2022 Proofscape contributors                           #
+#                                                                             #
+#   Licensed under the Apache License, Version 2.0 (the "License");           #
+#   you may not use this file except in compliance with the License.          #
+#   You may obtain a copy of the License at                                   #
+#                                                                             #
+#       http://www.apache.org/licenses/LICENSE-2.0                            #
+#                                                                             #
+#   Unless required by applicable law or agreed to in writing, software       #
+#   distributed under the License is distributed on an "AS IS" BASIS,         #
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.  #
+#   See the License for the specific language governing permissions and       #
+#   limitations under the License.                                            #
+# --------------------------------------------------------------------------- #
+
+from tools.build_steps import StepTimer
+
+CLASSIC_OUTPUT = """\
+Step 1/3 : FROM python:3.8
+ ---> 0123456789ab
+Step 2/3 : COPY a b
+ ---> Using cache
+ ---> 123456789abc
+Step 3/3 : RUN make
+ ---> Running in 23456789abcd
+Removing intermediate container 23456789abcd
+ ---> 3456789abcde
+Successfully built 3456789abcde
+"""
+
+BUILDKIT_OUTPUT = """\
+#1 [internal] load build definition from Dockerfile.pfsc-manage
+#1 DONE 0.1s
+
+#2 [oca 1/3] FROM docker.io/library/python:3.8
+#2 DONE 0.0s
+
+#3 [oca 2/3] COPY a b
+#3 CACHED
+
+#4 [oca 3/3] RUN make
+#4 0.512 compiling...
+#4 DONE 12.5s
+"""
+
+
+def test_classic_output():
+    timer = StepTimer()
+    for t, line in enumerate(CLASSIC_OUTPUT.split('\n')):
+        timer.feed(line, t=float(t))
+    timer.finish(t=100.0)
+    assert [s.instruction for s in timer.steps] == ['FROM python:3.8', 'COPY a b', 'RUN make']
+    assert [s.seconds for s in timer.steps] == [2.0, 3.0, 4.0]
+    assert timer.cache_counts() == (1, 2)
+    assert timer.first_cache_miss().instruction == 'RUN make'
+
+
+def test_buildkit_output():
+    timer = StepTimer()
+    for line in BUILDKIT_OUTPUT.split('\n'):
+        timer.feed(line, t=0.0)
+    timer.finish(t=0.0)
+    assert len(timer.steps) == 4
+    assert timer.steps[0].instruction is None
+    assert timer.cache_counts() == (1, 2)
+    slowest = timer.slowest(1)[0]
+    assert slowest.instruction == 'RUN make' and slowest.seconds == 12.5
@@ -0,0 +1,44 @@
+# --------------------------------------------------------------------------- #
+#   Proofscape Manage                                                         #
+#                                                                             #
+#   Copyright (c) 2021-2022 Proofscape contributors                           #
+#                                                                             #
+#   Licensed under the Apache License, Version 2.0 (the "License");           #
+#   you may not use this file except in compliance with the License.          #
+#   You may obtain a copy of the License at                                   #
+#                                                                             #
+#       http://www.apache.org/licenses/LICENSE-2.0                            #
+#                                                                             #
+#   Unless required by applicable law or agreed to in writing, software       #
+#   distributed under the License is distributed on an "AS IS" BASIS,         #
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.  #
+#   See the License for the specific language governing permissions and       #
+#   limitations under the License.                                            #
+# --------------------------------------------------------------------------- #
+
+import subprocess
+import sys
+
+import pytest
+
+import manage
+
+
+@pytest.mark.parametrize('name', sorted(manage.LAZY_COMMANDS))
+def test_lazy_help_matches_docstring(name):
+    manage.load_all_commands()
+    cmd = manage.cli.commands[name]
+    assert cmd.get_short_help_str(limit=80) == manage.LAZY_COMMANDS[name][1]
+
+
+def test_help_does_not_import_tools():
+    code = (
+        "import sys, manage\n"
+        "try:\n"
+        "    manage.cli(['--help'])\n"
+        "except SystemExit:\n"
+        "    pass\n"
+        "print(sorted(m for m in sys.modules if m.startswith('tools')))\n"
+    )
+    out = subprocess.check_output([sys.executable, '-c', code], cwd=manage.PFSC_MANAGE_ROOT)
+    assert out.decode().strip().split('\n')[-1] == '[]'
@@ -0,0 +1,46 @@
+# --------------------------------------------------------------------------- #
+#   Proofscape Manage                                                         #
+#                                                                             #
+#   Copyright (c) 2021-2022 Proofscape contributors                           #
+#                                                                             #
+#   Licensed under the Apache License, Version 2.0 (the "License");           #
+#   you may not use this file except in compliance with the License.          #
+#   You may obtain a copy of the License at                                   #
+#                                                                             #
+#       http://www.apache.org/licenses/LICENSE-2.0                            #
+#                                                                             #
+#   Unless required by applicable law or agreed to in writing, software       #
+#   distributed under the License is distributed on an "AS IS" BASIS,         #
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.  #
+#   See the License for the specific language governing permissions and       #
+#   limitations under the License.                                            #
+# --------------------------------------------------------------------------- #
+
+from tools.deploy.budget import compute_budget, apply_budget
+
+
+SERVICES = ['redis', 'redisgraph', 'pfscwork0', 'pfscwork1', 'pfscmath0', 'pfscweb', 'nginx']
+
+
+def test_budget_pins_gdb_and_workers_to_disjoint_cores():
+    budget = compute_budget(SERVICES, 16, 32768)
+    assert budget['redisgraph']['cpuset'] == '12-15'
+    worker_sets = {budget[name]['cpuset'] for name in ['pfscwork0', 'pfscwork1', 'pfscmath0']}
+    assert worker_sets == {'6-11'}
+    assert budget['pfscweb']['cpuset'] is None
+    assert sum(a['cpus'] for a in budget.values()) <= 15
+    assert sum(a['mem_mb'] for a in budget.values()) <= 32768 - 1024
+
+
+def test_budget_skips_pinning_on_small_host():
+    budget = compute_budget(SERVICES, 2, 4096)
+    assert all(a['cpuset'] is None for a in budget.values())
+
+
+def test_apply_budget():
+    budget = compute_budget(['redis', 'nginx'], 4, 4096)
+    s = {'redis': {'image': 'redis:6.2.1'}, 'other': {}}
+    apply_budget(s, budget)
+    assert s['redis']['mem_limit'] == f'{budget["redis"]["mem_mb"]}m'
+    assert s['redis']['ulimits']['nofile']['soft'] == 65536
+    assert s['other'] == {}
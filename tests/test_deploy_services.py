@@ -0,0 +1,48 @@
+# --------------------------------------------------------------------------- #
+#   Proofscape Manage                                                         #
+#                                                                             #
+#   Copyright (c) 2021-2022 Proofscape contributors                           #
+#                                                                             #
+#   Licensed under the Apache License, Version 2.0 (the "License");           #
+#   you may not use this file except in compliance with the License.          #
+#   You may obtain a copy of the License at                                   #
+#                                                                             #
+#       http://www.apache.org/licenses/LICENSE-2.0                            #
+#                                                                             #
+#   Unless required by applicable law or agreed to in writing, software       #
+#   distributed under the License is distributed on an "AS IS" BASIS,         #
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.  #
+#   See the License for the specific language governing permissions and       #
+#   limitations under the License.                                            #
+# --------------------------------------------------------------------------- #
+
+import pytest
+
+import tools.deploy.services as services
+from tools.deploy import container_readiness
+
+
+def test_websrv_waits_for_healthy_dependencies():
+    d = services.pfsc_server('/deploy', 'websrv', 'production', gdb=['re', 'np'], workers=1, math_workers=1)
+    assert d['depends_on'] == {
+        'redis': {'condition': 'service_healthy'},
+        'redisgraph': {'condition': 'service_healthy'},
+        'pfscwork0': {'condition': 'service_started'},
+        'pfscmath0': {'condition': 'service_started'},
+    }
+    assert 'healthcheck' in d
+    # Every service waited on as healthy must have a healthcheck.
+    assert 'healthcheck' in services.redis()
+    assert 'healthcheck' in services.redisgraph()
+
+
+@pytest.mark.parametrize('state, expected', [
+    ({'Status': 'running'}, 'ready'),
+    ({'Status': 'created'}, 'starting'),
+    ({'Status': 'exited'}, 'failed'),
+    ({'Status': 'running', 'Health': {'Status': 'starting'}}, 'starting'),
+    ({'Status': 'running', 'Health': {'Status': 'healthy'}}, 'ready'),
+    ({'Status': 'running', 'Health': {'Status': 'unhealthy'}}, 'failed'),
+])
+def test_container_readiness(state, expected):
+    assert container_readiness({'State': state}) == expected
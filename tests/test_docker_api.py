@@ -0,0 +1,125 @@
+# --------------------------------------------------------------------------- #
+#   Proofscape Manage                                                         #
+#                                                                             #
+#   Copyright (c) 2021-2022 Proofscape contributors                           #
+#                                                                             #
+#   Licensed under the Apache License, Version 2.0 (the "License");           #
+#   you may not use this file except in compliance with the License.          #
+#   You may obtain a copy of the License at                                   #
+#                                                                             #
+#       http://www.apache.org/licenses/LICENSE-2.0                            #
+#                                                                             #
+#   Unless required by applicable law or agreed to in writing, software       #
+#   distributed under the License is distributed on an "AS IS" BASIS,         #
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.  #
+#   See the License for the specific language governing permissions and       #
+#   limitations under the License.                                            #
+# --------------------------------------------------------------------------- #
+
+from http.server import BaseHTTPRequestHandler
+import io
+import json
+import socketserver
+import struct
+import tarfile
+import threading
+
+import pytest
+
+from tools.docker_api import DockerClient, DockerAPIError, STDOUT, STDERR
+
+
+class FakeDockerHandler(BaseHTTPRequestHandler):
+    """
+    Answers a few Docker Engine API requests, the way the daemon would.
+    """
+
+    def address_string(self):
+        return 'fake'
+
+    def log_message(self, *args):
+        pass
+
+    def read_body(self):
+        if self.headers.get('Transfer-Encoding') == 'chunked':
+            data = b''
+            while True:
+                size = int(self.rfile.readline().strip(), 16)
+                chunk = self.rfile.read(size + 2)[:size]
+                if size == 0:
+                    return data
+                data += chunk
+        return self.rfile.read(int(self.headers.get('Content-Length', 0)))
+
+    def reply(self, status, body=b'', content_type='application/json'):
+        if isinstance(body, (dict, list)):
+            body = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path == '/v1.41/images/pise%3A1/json':
+            self.reply(200, {'Id': 'sha256:abc', 'RootFS': {'Layers': ['sha256:1']}})
+        elif self.path == '/v1.41/exec/e1/json':
+            self.reply(200, {'ExitCode': 3})
+        else:
+            self.reply(404, {'message': 'No such image'})
+
+    def do_POST(self):
+        body = self.read_body()
+        if self.path.startswith('/v1.41/build?'):
+            names = tarfile.open(fileobj=io.BytesIO(body)).getnames()
+            events = [{'stream': f'Step 1/1 : COPY {" ".join(names)} /\n'},
+                      {'aux': {'ID': 'sha256:new'}}]
+            self.reply(200, b''.join(json.dumps(e).encode() + b'\r\n' for e in events))
+        elif self.path == '/v1.41/containers/c1/exec':
+            assert json.loads(body)['Cmd'] == ['pip', 'freeze']
+            self.reply(201, {'Id': 'e1'})
+        elif self.path == '/v1.41/exec/e1/start':
+            frames = (struct.pack('>BxxxL', STDOUT, 3) + b'out'
+                      + struct.pack('>BxxxL', STDERR, 3) + b'err')
+            self.reply(200, frames, 'application/vnd.docker.multiplexed-stream')
+        else:
+            self.reply(404, {'message': 'not found'})
+
+
+class FakeDockerServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+@pytest.fixture
+def client(tmp_path):
+    socket_path = str(tmp_path / 'docker.sock')
+    server = FakeDockerServer(socket_path, FakeDockerHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield DockerClient(socket_path)
+    server.shutdown()
+    server.server_close()
+
+
+def test_inspect_image(client):
+    assert client.image_id('pise:1') == 'sha256:abc'
+    assert client.image_id('missing') is None
+    with pytest.raises(DockerAPIError):
+        client.inspect_image('missing')
+
+
+def test_build_streams_context(client):
+    def write_context(fileobj):
+        with tarfile.open(fileobj=fileobj, mode='w|') as tar:
+            info = tarfile.TarInfo('Dockerfile')
+            data = b'FROM scratch\n' * 2000
+            info.size = len(data)
+            tar.addfile(info, io.BytesIO(data))
+
+    events = list(client.build(write_context, 'x:1', labels={'a': 'b'}))
+    assert events[0]['stream'] == 'Step 1/1 : COPY Dockerfile /\n'
+    assert events[1]['aux']['ID'] == 'sha256:new'
+
+
+def test_exec_run(client):
+    assert client.exec_run('c1', ['pip', 'freeze']) == (3, b'out', b'err')
@@ -0,0 +1,80 @@
+# --------------------------------------------------------------------------- #
+#   Proofscape Manage                                                         #
+#                                                                             #
+#   Copyright (c) 2021-2022 Proofscape contributors                           #
+#                                                                             #
+#   Licensed under the Apache License, Version 2.0 (the "License");           #
+#   you may not use this file except in compliance with the License.          #
+#   You may obtain a copy of the License at                                   #
+#                                                                             #
+#       http://www.apache.org/licenses/LICENSE-2.0                            #
+#                                                                             #
+#   Unless required by applicable law or agreed to in writing, software       #
+#   distributed under the License is distributed on an "AS IS" BASIS,         #
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.  #
+#   See the License for the specific language governing permissions and       #
+#   limitations under the License.                                            #
+# --------------------------------------------------------------------------- #
+
+import hashlib
+import io
+import tarfile
+
+from tools.image_bundle import (
+    compute_chain_ids, find_omittable_layers, hash_layer_members,
+    filter_saved_images,
+)
+
+
+def sha(data):
+    return 'sha256:' + hashlib.sha256(data).hexdigest()
+
+
+def make_legacy_save(layers):
+    """
+    Make a fake `docker save` archive in the legacy layout.
+
+    :param layers: list of pairs (dir name, layer contents)
+    """
+    buf = io.BytesIO()
+    with tarfile.open(fileobj=buf, mode='w') as tar:
+        for dir_name, data in layers:
+            info = tarfile.TarInfo(f'{dir_name}/layer.tar')
+            info.size = len(data)
+            tar.addfile(info, io.BytesIO(data))
+        link = tarfile.TarInfo('dup/layer.tar')
+        link.type = tarfile.SYMTYPE
+        link.linkname = f'../{layers[0][0]}/layer.tar'
+        tar.addfile(link)
+        manifest = b'[]'
+        info = tarfile.TarInfo('manifest.json')
+        info.size = len(manifest)
+        tar.addfile(info, io.BytesIO(manifest))
+    buf.seek(0)
+    return buf
+
+
+def test_compute_chain_ids():
+    a, b = sha(b'a'), sha(b'b')
+    assert compute_chain_ids([a, b]) == [a, sha(f'{a} {b}'.encode())]
+
+
+def test_find_omittable_layers():
+    a, b, c = sha(b'a'), sha(b'b'), sha(b'c')
+    have = set(compute_chain_ids([a, b]))
+    assert find_omittable_layers([[a, b, c]], have) == {a, b}
+    # Same layer, but on a different base, so not omittable:
+    assert find_omittable_layers([[c, b]], have) == set()
+
+
+def test_filter_saved_images():
+    layers = [('base', b'base layer'), ('app', b'app layer')]
+    digests = hash_layer_members(make_legacy_save(layers))
+    assert digests == {'base/layer.tar': sha(b'base layer'), 'app/layer.tar': sha(b'app layer')}
+    out = io.BytesIO()
+    written, omitted = filter_saved_images(
+        make_legacy_save(layers), out, {sha(b'base layer')}, digests)
+    assert omitted == len(b'base layer')
+    out.seek(0)
+    names = tarfile.open(fileobj=out).getnames()
+    assert names == ['app/layer.tar', 'manifest.json']
@@ -0,0 +1,61 @@
+# --------------------------------------------------------------------------- #
+#   Proofscape Manage                                                         #
+#                                                                             #
+#   Copyright (c) 2021-2022 Proofscape contributors                           #
+#                                                                             #
+#   Licensed under the Apache License, Version 2.0 (the "License");           #
+#   you may not use this file except in compliance with the License.          #
+#   You may obtain a copy of the License at                                   #
+#                                                                             #
+#       http://www.apache.org/licenses/LICENSE-2.0                            #
+#                                                                             #
+#   Unless required by applicable law or agreed to in writing, software       #
+#   distributed under the License is distributed on an "AS IS" BASIS,         #
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.  #
+#   See the License for the specific language governing permissions and       #
+#   limitations under the License.                                            #
+# --------------------------------------------------------------------------- #
+
+import io
+import tarfile
+
+from tools.image_layers import analyze_layer_tars, find_duplicates, find_excessive_rewrites
+
+
+def make_layer(files):
+    """
+    :param files: dict mapping paths to contents (bytes)
+    """
+    buf = io.BytesIO()
+    with tarfile.open(fileobj=buf, mode='w') as tar:
+        for path, data in files.items():
+            info = tarfile.TarInfo(path)
+            info.size = len(data)
+            tar.addfile(info, io.BytesIO(data))
+    buf.seek(0)
+    return buf
+
+
+def test_analyze_layer_tars():
+    contents = {}
+    history = ['COPY app', 'COPY c', 'RUN chown -R', 'RUN rm', 'RUN x', 'COPY a']
+    layers = analyze_layer_tars([
+        make_layer({'app/a.py': b'a' * 100, 'app/b.py': b'b' * 50, 'tmp/x': b'x'}),
+        make_layer({'app/c.py': b'c' * 10}),
+        # A recursive chown rewrites everything:
+        make_layer({'app/a.py': b'a' * 100, 'app/b.py': b'b' * 50, 'app/c.py': b'c' * 10}),
+        # Deleted files no longer count as present:
+        make_layer({'tmp/.wh.x': b''}),
+        make_layer({'tmp/x': b'y', 'app/.wh..wh..opq': b''}),
+        make_layer({'app/a.py': b'new'}),
+    ], history=[(h, 2 * i) for i, h in enumerate(history)], dir_depth=1, contents=contents)
+    assert [layer.rewritten for layer in layers] == [0, 0, 160, 0, 0, 0]
+    assert layers[0].n_files == 3 and layers[0].size == 151
+    assert layers[2].created_by == 'RUN chown -R'
+    assert layers[2].history_index == 4
+    assert layers[0].largest_dirs(1) == [('/app', 150)]
+    assert find_excessive_rewrites(layers, 100) == [layers[2]]
+    assert find_excessive_rewrites(layers, 100, skip=3) == []
+    dups = find_duplicates(contents)
+    assert dups[0] == (100, [(0, 'app/a.py'), (2, 'app/a.py')])
+    assert len(dups) == 3
@@ -0,0 +1,76 @@
+# --------------------------------------------------------------------------- #
+#   Proofscape Manage                                                         #
+#                                                                             #
+#   Copyright (c) 2021-2022 Proofscape contributors                           #
+#                                                                             #
+#   Licensed under the Apache License, Version 2.0 (the "License");           #
+#   you may not use this file except in compliance with the License.          #
+#   You may obtain a copy of the License at                                   #
+#                                                                             #
+#       http://www.apache.org/licenses/LICENSE-2.0                            #
+#                                                                             #
+#   Unless required by applicable law or agreed to in writing, software       #
+#   distributed under the License is distributed on an "AS IS" BASIS,         #
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.  #
+#   See the License for the specific language governing permissions and       #
+#   limitations under the License.                                            #
+# --------------------------------------------------------------------------- #
+
+import json
+
+from tools.license_assembly import (
+    PYTHON_PACKAGES_SLOT, OTHER_LICENSES_SLOT,
+    assemble, list_installed_packages, main,
+)
+
+
+def pkg(name, license_text):
+    return {
+        'name': name, 'row': f'{name}  MIT',
+        'src_url': f'https://github.com/x/{name}', 'license_text': license_text,
+    }
+
+
+BUNDLE = {
+    'text': f'PY:\n{PYTHON_PACKAGES_SLOT}\nOTHER:\n{OTHER_LICENSES_SLOT}',
+    'python_packages': [
+        pkg('Flask', 'MIT text'), pkg('pytest', 'MIT text'),
+        pkg('sympy', 'BSD text'), pkg('Jinja2', 'BSD text\n'),
+    ],
+    'incomplete_python_packages': ['some_dev_tool'],
+    'pyodide_python_packages': [pkg('Jinja2', 'old'), pkg('mpmath', 'BSD text')],
+    'javascript_packages': [pkg('dojo', 'AFL text')],
+}
+
+
+def test_assemble():
+    text = assemble(BUNDLE, installed={'flask', 'sympy', 'jinja2'})
+    py, other = text.split('OTHER:\n')
+    # Only installed packages are listed, sympy is not repeated:
+    assert 'Flask' in py and 'Jinja2' in py
+    assert 'pytest' not in py and 'sympy' not in py
+    # Packages with the same license text are grouped:
+    blocks = other.split('~' * 79)
+    blocks = [b for b in blocks if b.strip()]
+    assert len(blocks) == 3
+    assert 'Jinja2' in blocks[0] and 'mpmath' in blocks[0] and 'sympy' in blocks[0]
+    assert 'Flask' in blocks[1]
+    assert 'pytest' not in other
+
+
+def test_assemble_incomplete():
+    try:
+        assemble(BUNDLE, installed={'some-dev-tool'})
+    except ValueError as e:
+        assert 'some_dev_tool' in str(e)
+    else:
+        assert False
+
+
+def test_main(tmp_path):
+    assert 'pytest' in list_installed_packages()
+    bundle_path = tmp_path / 'bundle.json'
+    bundle_path.write_text(json.dumps(BUNDLE))
+    out_path = tmp_path / 'LICENSES.txt'
+    main(str(bundle_path), str(out_path))
+    assert 'pytest  MIT' in out_path.read_text()
@@ -0,0 +1,50 @@
+# --------------------------------------------------------------------------- #
+#   Proofscape Manage                                                         #
+#                                                                             #
+#   Copyright (c) 2021-2022 Proofscape contributors                           #
+#                                                                             #
+#   Licensed under the Apache License, Version 2.0 (the "License");           #
+#   you may not use this file except in compliance with the License.          #
+#   You may obtain a copy of the License at                                   #
+#                                                                             #
+#       http://www.apache.org/licenses/LICENSE-2.0                            #
+#                                                                             #
+#   Unless required by applicable law or agreed to in writing, software       #
+#   distributed under the License is distributed on an "AS IS" BASIS,         #
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.  #
+#   See the License for the specific language governing permissions and       #
+#   limitations under the License.                                            #
+# --------------------------------------------------------------------------- #
+
+import os
+
+from tools.resolved import ResolvedConf, get_mtime
+
+
+def test_memoize_recomputes_on_new_stamp():
+    rc = ResolvedConf()
+    calls = []
+
+    def compute():
+        calls.append(1)
+        return len(calls)
+
+    assert rc.memoize('k', 1, compute) == 1
+    assert rc.memoize('k', 1, compute) == 1
+    assert rc.memoize('k', 2, compute) == 2
+    assert len(calls) == 2
+
+
+def test_file_stamp_follows_mtime(tmp_path):
+    path = tmp_path / 'version.txt'
+    assert get_mtime(path) is None
+
+    def read():
+        return path.read_text()
+
+    rc = ResolvedConf()
+    path.write_text('1.0')
+    assert rc.memoize('v', get_mtime(path), read) == '1.0'
+    path.write_text('2.0')
+    os.utime(path, ns=(0, get_mtime(path) + 10**9))
+    assert rc.memoize('v', get_mtime(path), read) == '2.0'
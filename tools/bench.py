@@ -0,0 +1,268 @@
+# --------------------------------------------------------------------------- #
+#   Proofscape Manage                                                         #
+#                                                                             #
+#   Copyright (c) 2021-2022 Proofscape contributors                           #
+#                                                                             #
+#   Licensed under the Apache License, Version 2.0 (the "License");           #
+#   you may not use this file except in compliance with the License.          #
+#   You may obtain a copy of the License at                                   #
+#                                                                             #
+#       http://www.apache.org/licenses/LICENSE-2.0                            #
+#                                                                             #
+#   Unless required by applicable law or agreed to in writing, software       #
+#   distributed under the License is distributed on an "AS IS" BASIS,         #
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.  #
+#   See the License for the specific language governing permissions and       #
+#   limitations under the License.                                            #
+# --------------------------------------------------------------------------- #
+
+import gzip
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+import click
+import requests
+
+from manage import cli, PFSC_ROOT, PFSC_MANAGE_ROOT
+from conf import DOCKER_CMD
+
+
+@cli.group()
+def bench():
+    """
+    Benchmarks for the pfsc tool, and the images it builds.
+    """
+    pass
+
+
+# Python snippets that start the `pfsc` CLI in a fresh interpreter, either
+# with lazy loading of subcommand modules (the normal behavior), or with
+# eager loading of all of them (the way it used to be).
+LAZY_STARTUP = "import manage; manage.cli(prog_name='pfsc')"
+EAGER_STARTUP = "import manage; manage.load_all_commands(); manage.cli(prog_name='pfsc')"
+
+# We use `deploy local --help` instead of a real `deploy local DIRNAME`, since
+# it resolves (and so imports) the `deploy` subcommand, but has no side effects.
+STARTUP_CASES = {
+    'pfsc --help': ['--help'],
+    'pfsc deploy local': ['deploy', 'local', '--help'],
+}
+
+
+def time_cold_startup(snippet, args, repeat):
+    """
+    Time `repeat` runs of a `pfsc` command, each in a fresh interpreter.
+
+    :param snippet: Python code that starts the CLI.
+    :param args: list of command line args to pass.
+    :param repeat: number of runs.
+    :return: list of wall times in seconds.
+    """
+    times = []
+    for i in range(repeat):
+        t0 = time.perf_counter()
+        subprocess.run(
+            [sys.executable, '-c', snippet] + args,
+            cwd=PFSC_MANAGE_ROOT,
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+        )
+        times.append(time.perf_counter() - t0)
+    return times
+
+
+@bench.command()
+@click.option('-n', '--repeat', type=int, default=10, help="Number of runs per case. Default 10.")
+def startup(repeat):
+    """
+    Measure cold startup time of the `pfsc` command.
+
+    Each case is run in a fresh Python interpreter, both with lazy loading of
+    subcommand modules and with eager loading of all of them, so that the two
+    can be compared.
+    """
+    header = f'{"case":24s} {"loading":8s} {"min (ms)":>10s} {"median (ms)":>12s} {"mean (ms)":>10s}'
+    click.echo(header)
+    click.echo('-' * len(header))
+    for name, args in STARTUP_CASES.items():
+        for loading, snippet in [('eager', EAGER_STARTUP), ('lazy', LAZY_STARTUP)]:
+            times = [1000 * t for t in time_cold_startup(snippet, args, repeat)]
+            click.echo(
+                f'{name:24s} {loading:8s} {min(times):10.1f} '
+                f'{statistics.median(times):12.1f} {statistics.mean(times):10.1f}'
+            )
+
+
+def time_container_cold_start(image, port, path, timeout):
+    """
+    Start a container from an image, and time how long it takes until the app
+    on port 7372 answers an HTTP request with status 200.
+
+    :return: seconds, or `None` if we gave up after `timeout` seconds.
+    """
+    cmd = f'{DOCKER_CMD} run -d --rm -p {port}:7372 {image}'
+    t0 = time.perf_counter()
+    container_id = subprocess.check_output(cmd.split(), text=True).strip()
+    try:
+        url = f'http://localhost:{port}{path}'
+        while time.perf_counter() - t0 < timeout:
+            try:
+                if requests.get(url, timeout=1).status_code == 200:
+                    return time.perf_counter() - t0
+            except requests.RequestException:
+                pass
+            time.sleep(0.05)
+        return None
+    finally:
+        cmd = f'{DOCKER_CMD} rm -f {container_id}'
+        subprocess.run(cmd.split(), stdout=subprocess.DEVNULL)
+
+
+@bench.command()
+@click.option('-n', '--repeat', type=int, default=5, help="Number of runs per image. Default 5.")
+@click.option('--port', type=int, default=7372, help="Host port on which to publish the app. Default 7372.")
+@click.option('--path', default='/', help="URL path to request. Default `/`.")
+@click.option('--timeout', type=float, default=120, help="Seconds after which to give up on a run. Default 120.")
+@click.argument('images', nargs=-1, required=True)
+def coldstart(repeat, port, path, timeout, images):
+    """
+    Measure container cold-start time, to the first HTTP 200, for IMAGES.
+
+    The images should run the app on port 7372, as e.g. `pise` images do. For
+    example, to compare bytecode strategies (see `BYTECODE_STRATEGY` in
+    `conf.py`), build the OCA under each one, with different tags, and pass
+    both.
+    """
+    header = f'{"image":32s} {"failed":>6s} {"min (s)":>9s} {"median (s)":>11s} {"mean (s)":>9s}'
+    click.echo(header)
+    click.echo('-' * len(header))
+    for image in images:
+        results = [time_container_cold_start(image, port, path, timeout) for i in range(repeat)]
+        times = [t for t in results if t is not None]
+        failed = len(results) - len(times)
+        if times:
+            click.echo(
+                f'{image:32s} {failed:6d} {min(times):9.2f} '
+                f'{statistics.median(times):11.2f} {statistics.mean(times):9.2f}'
+            )
+        else:
+            click.echo(f'{image:32s} {failed:6d}')
+
+
+def precompressed_size(path, brotli=None):
+    """
+    Compute the number of bytes a client downloads to fetch a file, raw, and
+    with the precompressed siblings `pfsc build static` would make for it.
+
+    :param brotli: the `brotli` module, if available
+    :return: triple (raw bytes, bytes with gzip, bytes with brotli), where the
+      last is `None` if `brotli` is not given
+    """
+    from topics.static import (
+        PRECOMPRESS_EXTENSIONS, PRECOMPRESS_MAX_RATIO_PCT, PRECOMPRESS_MIN_SIZE,
+    )
+    raw = os.path.getsize(path)
+    ext = os.path.splitext(path)[1][1:]
+    if ext not in PRECOMPRESS_EXTENSIONS or raw <= PRECOMPRESS_MIN_SIZE:
+        return raw, raw, (raw if brotli else None)
+    with open(path, 'rb') as f:
+        data = f.read()
+
+    def best(compressed_size):
+        return compressed_size if compressed_size < raw * PRECOMPRESS_MAX_RATIO_PCT // 100 else raw
+
+    gz = best(len(gzip.compress(data, compresslevel=9, mtime=0)))
+    br = best(len(brotli.compress(data, quality=11))) if brotli else None
+    return raw, gz, br
+
+
+@bench.command()
+def precompress():
+    """
+    Measure the transfer size of static assets, with and without precompression.
+
+    For each group of static assets in the `pfsc-static-nginx` image (the
+    image `pfsc build static` precompresses), we total the bytes a client
+    downloads to fetch every file once: raw, with gzip, and with brotli (if
+    the `brotli` Python package is installed). This is an upper bound on the
+    transfer size of a cold load of these assets.
+    """
+    from topics.static import STATIC_IMAGE_ASSETS
+    try:
+        import brotli
+    except ImportError:
+        brotli = None
+    src_root = os.path.join(PFSC_ROOT, 'src')
+    header = f'{"assets":40s} {"files":>6s} {"raw (MB)":>9s} {"gzip (MB)":>10s} {"brotli (MB)":>12s}'
+    click.echo(header)
+    click.echo('-' * len(header))
+    totals = [0, 0, 0, 0]
+    for src, dst in STATIC_IMAGE_ASSETS:
+        path = os.path.join(src_root, src)
+        if os.path.isdir(path):
+            paths = [os.path.join(d, f) for d, _, fs in os.walk(path) for f in fs]
+        else:
+            paths = [path] if os.path.exists(path) else []
+        sizes = [precompressed_size(p, brotli) for p in paths]
+        row = [len(sizes)] + [sum(s[i] or 0 for s in sizes) for i in range(3)]
+        totals = [t + r for t, r in zip(totals, row)]
+        click.echo(format_precompress_row(dst, row, brotli))
+    click.echo('-' * len(header))
+    click.echo(format_precompress_row('total', totals, brotli))
+
+
+def format_precompress_row(label, row, brotli):
+    n, raw, gz, br = row
+    mb = 1024 * 1024
+    br = f'{br / mb:12.2f}' if brotli else f'{"n/a":>12s}'
+    return f'{label[:40]:40s} {n:6d} {raw / mb:9.2f} {gz / mb:10.2f} {br}'
+
+
+# Accept-Encoding values under which `bench compression` requests each path:
+COMPRESSION_ENCODINGS = ['identity', 'gzip', 'br']
+
+
+def measure_response(url, encoding, repeat):
+    """
+    Request a URL several times, under a given Accept-Encoding.
+
+    :return: triple (bytes on the wire, Content-Encoding of the response,
+      median latency in seconds to the end of the body)
+    """
+    latencies = []
+    for i in range(repeat):
+        t0 = time.perf_counter()
+        r = requests.get(url, headers={'Accept-Encoding': encoding}, stream=True)
+        # Read the body undecoded, to count the bytes actually sent.
+        body = r.raw.read(decode_content=False)
+        latencies.append(time.perf_counter() - t0)
+    return len(body), r.headers.get('Content-Encoding', '-'), statistics.median(latencies)
+
+
+@bench.command()
+@click.option('-n', '--repeat', type=int, default=10, help="Number of requests per path and encoding. Default 10.")
+@click.option('--url', default=None,
+              help="Base URL of the site. Default `http://localhost:PFSC_ISE_MCA_PORT`.")
+@click.argument('paths', nargs=-1)
+def compression(repeat, url, paths):
+    """
+    Measure response bytes and latency of PATHS, with and without compression.
+
+    Each path (default just `/`) is requested with Accept-Encoding identity,
+    gzip, and br, so you can see what `NGINX_PROXY_COMPRESS` in `conf.py` saves,
+    and what it costs. For example, run it against a dummy deployment
+    (`pfsc deploy generate --dummy`), or against a real one, passing paths of
+    large JSON responses.
+    """
+    from conf import PFSC_ISE_MCA_PORT
+    url = url or f'http://localhost:{PFSC_ISE_MCA_PORT}'
+    paths = paths or ['/']
+    header = f'{"path":40s} {"accept":>8s} {"encoding":>8s} {"bytes":>10s} {"median (ms)":>12s}'
+    click.echo(header)
+    click.echo('-' * len(header))
+    for path in paths:
+        for encoding in COMPRESSION_ENCODINGS:
+            n, used, latency = measure_response(url + path, encoding, repeat)
+            click.echo(f'{path[:40]:40s} {encoding:>8s} {used:>8s} {n:10d} {1000 * latency:12.1f}')
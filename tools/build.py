@@ -16,8 +16,15 @@
 #   limitations under the License.                                            #
 # --------------------------------------------------------------------------- #
 
+from contextlib import contextmanager
+from itertools import zip_longest
 import subprocess
 import tempfile
+import json
+import sys
+import threading
+import time
+import shutil
 import os
 import re
 
@@ -25,11 +32,56 @@ import click
 
 import conf
 from manage import cli, PFSC_ROOT, PFSC_MANAGE_ROOT
+from tools.util import simple_timestamp
 from conf import DOCKER_CMD
-import tools.license
+from tools import timing
+from tools.build_graph import BuildNode, run_build_graph, write_build_summary
+from tools.build_steps import StepTimer
+from tools.docker_api import get_docker_client, DockerAPIError
+from tools.build_context import (
+    BuildContext, CONTEXT_DOCKERFILE_NAME, format_bytes, measure_dir,
+    list_base_images, is_bytecode, find_final_base_image,
+    list_final_stage_instructions,
+)
+from tools.image_layers import (
+    analyze_saved_image, find_excessive_rewrites, find_duplicates,
+)
+from tools.image_bundle import (
+    compute_chain_ids, find_omittable_layers, hash_layer_members,
+    filter_saved_images,
+)
 
 SRC_ROOT = os.path.join(PFSC_ROOT, 'src')
 SRC_TMP_ROOT = os.path.join(SRC_ROOT, 'tmp')
+BUILD_LOG_ROOT = os.path.join(PFSC_ROOT, 'build-cache', 'logs')
+BUILDKIT_CACHE_ROOT = os.path.join(PFSC_ROOT, 'build-cache', 'buildkit')
+# Rendered Dockerfiles, saved under the build digests of the images built
+# from them, so that `pfsc build inspect` can map layers back to instructions:
+DOCKERFILE_CACHE_ROOT = os.path.join(PFSC_ROOT, 'build-cache', 'dockerfiles')
+INSPECT_ROOT = os.path.join(PFSC_ROOT, 'build-cache', 'inspect')
+# One JSON record per build, with the timing of each step:
+BUILD_HISTORY_PATH = os.path.join(PFSC_ROOT, 'build-cache', 'build-history.jsonl')
+# Number of slowest steps to report after each build:
+N_SLOWEST_STEPS = 5
+
+BUILDKIT_CACHE = getattr(conf, 'BUILDKIT_CACHE', False)
+BUILDKIT_CACHE_REGISTRY = getattr(conf, 'BUILDKIT_CACHE_REGISTRY', None)
+BUILDKIT_SYNTAX_DIRECTIVE = '# syntax=docker/dockerfile:1\n'
+
+LAYER_REWRITE_LIMIT_MB = getattr(conf, 'LAYER_REWRITE_LIMIT_MB', None)
+
+BYTECODE_STRATEGIES = ['strip', 'compile']
+BYTECODE_STRATEGY = getattr(conf, 'BYTECODE_STRATEGY', 'strip')
+
+REPRODUCIBLE_BUILDS = getattr(conf, 'REPRODUCIBLE_BUILDS', False)
+SOURCE_DATE_EPOCH = getattr(conf, 'SOURCE_DATE_EPOCH', None)
+
+# Every image we build is labeled with the content digest of its build:
+BUILD_DIGEST_LABEL = 'org.proofscape.build-digest'
+
+# Set by `pfsc build check-repro`, to force builds to run in full, without the
+# layer cache:
+force_fresh_builds = False
 
 
 @cli.group()
@@ -57,26 +109,488 @@ def strip_headers(text):
     return LICENSE_HEADER_PATTERN.sub('', text)
 
 
+def get_bytecode_strategy():
+    if BYTECODE_STRATEGY not in BYTECODE_STRATEGIES:
+        raise click.UsageError(
+            f'BYTECODE_STRATEGY in conf.py must be one of: {", ".join(BYTECODE_STRATEGIES)}')
+    return BYTECODE_STRATEGY
+
+
+def get_source_date_epoch():
+    """
+    In reproducible-build mode, get the time (in seconds since the epoch) to
+    which we set the times of all files in the images we build. This is
+    `SOURCE_DATE_EPOCH` from `conf.py` if set, else the time of the last commit
+    in pfsc-server.
+
+    :return: int, or `None` if not in reproducible-build mode
+    :raises: click.UsageError if we need, but cannot get, the time of the
+      last commit
+    """
+    if not REPRODUCIBLE_BUILDS:
+        return None
+    if SOURCE_DATE_EPOCH is not None:
+        return int(SOURCE_DATE_EPOCH)
+    repo_path = os.path.join(SRC_ROOT, "pfsc-server")
+    cmd = f'git -C {repo_path} log -1 --format=%ct'
+    try:
+        proc = subprocess.run(cmd.split(), capture_output=True, text=True)
+    except FileNotFoundError:
+        proc = None
+    out = proc.stdout.strip() if proc else ''
+    if not (proc and proc.returncode == 0 and out):
+        raise click.UsageError(
+            f'Could not get the time of the last commit in {repo_path}, for'
+            ' REPRODUCIBLE_BUILDS. Please set SOURCE_DATE_EPOCH in conf.py.')
+    return int(out)
+
+
+def write_build_command(image_name, tag, buildkit, digest=None, epoch=None, no_cache=False):
+    """
+    Write the docker command that builds an image from a context on stdin.
+
+    If a build digest is given, the image is labeled with it.
+
+    In BuildKit mode, we import and export a layer cache kept under
+    `BUILDKIT_CACHE_ROOT`, with a separate cache dir for each image, so that
+    concurrent builds of different images do not clobber one another's cache.
+    If `BUILDKIT_CACHE_REGISTRY` is set, the cache is kept in that registry
+    instead, so that it can be shared between machines.
+
+    If an epoch is given, we build reproducibly (which requires BuildKit): the
+    build gets `SOURCE_DATE_EPOCH`, and the times of all files in all layers,
+    including those made by `RUN` instructions, are clamped to the epoch.
+    """
+    label = f' --label {BUILD_DIGEST_LABEL}={digest}' if digest else ''
+    opts = ' --no-cache' if no_cache else ''
+    if not buildkit and epoch is None:
+        return f'{DOCKER_CMD} build{opts} -f {CONTEXT_DOCKERFILE_NAME} -t {image_name}:{tag}{label} -'
+    if epoch is not None:
+        opts += (f' --build-arg SOURCE_DATE_EPOCH={epoch}'
+                 f' --output type=docker,rewrite-timestamp=true')
+    else:
+        opts += ' --load'
+    cmd = (
+        f'{DOCKER_CMD} buildx build{opts} --progress=plain'
+        f' -f {CONTEXT_DOCKERFILE_NAME} -t {image_name}:{tag}{label}'
+    )
+    if buildkit:
+        if BUILDKIT_CACHE_REGISTRY:
+            ref = f'{BUILDKIT_CACHE_REGISTRY}/{image_name}:buildcache'
+            cmd += (f' --cache-from type=registry,ref={ref}'
+                    f' --cache-to type=registry,ref={ref},mode=max')
+        else:
+            cache_dir = os.path.join(BUILDKIT_CACHE_ROOT, image_name)
+            cmd += (f' --cache-from type=local,src={cache_dir}'
+                    f' --cache-to type=local,dest={cache_dir},mode=max')
+    return cmd + ' -'
+
+
+def inspect_images(images):
+    """
+    :param images: list of images
+    :return: list, parallel to `images`, of dicts of image metadata, as given
+      by `docker image inspect`
+    """
+    client = get_docker_client()
+    if client:
+        return [client.inspect_image(image) for image in images]
+    cmd = f'{DOCKER_CMD} image inspect {" ".join(images)}'
+    return json.loads(subprocess.check_output(cmd.split(), text=True))
+
+
+def get_local_image_id(image):
+    """
+    :return: the ID of a local image, or `None` if there is no such image
+    """
+    client = get_docker_client()
+    if client:
+        return client.image_id(image)
+    cmd = f'{DOCKER_CMD} image inspect --format {{{{.Id}}}} {image}'
+    proc = subprocess.run(cmd.split(), capture_output=True, text=True)
+    return proc.stdout.strip() if proc.returncode == 0 else None
+
+
+def find_image_with_digest(image_name, digest):
+    """
+    :return: the ID of a local image of the given name, bearing the given
+      build digest label, or `None` if there is no such image
+    """
+    client = get_docker_client()
+    if client:
+        images = client.list_images(filters={
+            'reference': [image_name], 'label': [f'{BUILD_DIGEST_LABEL}={digest}'],
+        })
+        return images[0]['Id'] if images else None
+    cmd = (f'{DOCKER_CMD} images -q --no-trunc'
+           f' --filter label={BUILD_DIGEST_LABEL}={digest} {image_name}')
+    proc = subprocess.run(cmd.split(), capture_output=True, text=True)
+    ids = proc.stdout.split()
+    return ids[0] if proc.returncode == 0 and ids else None
+
+
+def tag_image(image, image_name, tag):
+    """
+    :return: return code, as of the `docker tag` command
+    """
+    client = get_docker_client()
+    if client:
+        client.tag_image(image, image_name, tag)
+        return 0
+    cmd = f'{DOCKER_CMD} tag {image} {image_name}:{tag}'
+    print(cmd)
+    return subprocess.run(cmd.split()).returncode
+
+
+def count_image_layers(image):
+    return len(list_layer_digests([image])[0])
+
+
+def list_layer_digests(images):
+    """
+    :param images: list of images
+    :return: list, parallel to `images`, of lists of the diff IDs of the
+      layers of each image, bottom first
+    """
+    return [meta['RootFS']['Layers'] for meta in inspect_images(images)]
+
+
+def check_layer_rewrites(image, limit_mb, base=None):
+    """
+    Check that no layer of an image rewrites more than `limit_mb` megabytes of
+    files already present in earlier layers, as e.g. a `RUN chown -R` would.
+
+    :param base: optional name of the base image, whose layers are not checked
+    :raises: click.ClickException if the check fails
+    """
+    skip = 0
+    if base:
+        # The base may not be in the local store, e.g. after a BuildKit build
+        # on a `docker-container` builder. Then we check all layers.
+        try:
+            skip = count_image_layers(base)
+        except (subprocess.CalledProcessError, DockerAPIError):
+            print(f'WARNING: Base image {base} not found locally. Checking all layers of {image}.')
+    with tempfile.TemporaryDirectory() as tmp_dir_name:
+        path = os.path.join(tmp_dir_name, 'image.tar')
+        cmd = f'{DOCKER_CMD} save -o {path} {image}'
+        with timing.phase(cmd, 'subprocess'):
+            subprocess.run(cmd.split(), check=True)
+        with timing.phase('analyze image layers', 'compute'):
+            layers, _ = analyze_saved_image(path)
+    excessive = find_excessive_rewrites(layers, limit_mb * 1024 * 1024, skip=skip)
+    if excessive:
+        lines = [f'Layers of {image} rewriting more than {limit_mb} MB of existing files:']
+        for layer in excessive:
+            biggest = sorted(layer.rewritten_files, key=lambda f: -f[1])[:5]
+            lines.append(f'  layer {layer.index}: {format_bytes(layer.rewritten)} rewritten, by')
+            lines.append(f'    {layer.created_by[:200]}')
+            lines.extend(f'    {format_bytes(n):>10s}  {p}' for p, n in biggest)
+        raise click.ClickException('\n'.join(lines))
+    print(f'Layer check passed for {image}.')
+
+
+def compute_build_digest(context, dry_run, epoch=None):
+    """
+    Compute the content digest for a build.
+
+    Besides the context itself, we hash the base images. Those we build
+    ourselves (like pfsc-base) are hashed by ID, so that a rebuilt base image
+    means a new digest. Upstream images (like `python:...`) are hashed by
+    reference, since whether they have been pulled yet must not change the
+    digest: otherwise the first build on a clean machine would be stamped with
+    a digest that the next one does not reproduce. (Upstream images are
+    pinned by tag, so a change of upstream means a change of reference.) In
+    a dry run we do not consult docker, and hash only names. A reproducible
+    build also hashes its epoch.
+    """
+    extras = list_base_images(context.dockerfile)
+    if not dry_run:
+        ours = set(BUILD_IMAGE_NAMES.values())
+        extras = [
+            (get_local_image_id(b) or b) if split_image_name(b)[0] in ours else b
+            for b in extras
+        ]
+    if epoch is not None:
+        extras.append(f'SOURCE_DATE_EPOCH={epoch}')
+    with timing.phase('compute build digest', 'compute'):
+        return context.digest(extras=extras)
+
+
+def saved_dockerfile_path(digest):
+    return os.path.join(DOCKERFILE_CACHE_ROOT, digest.split(':')[-1] + '.Dockerfile')
+
+
+def save_dockerfile(df, digest):
+    os.makedirs(DOCKERFILE_CACHE_ROOT, exist_ok=True)
+    with open(saved_dockerfile_path(digest), 'w') as f:
+        f.write(df)
+
+
+def run_build_command(cmd, context, epoch=None):
+    """
+    Run a docker build command, streaming the build context to its stdin.
+
+    The build output is echoed as it arrives, and parsed into per-step
+    timings. (BuildKit chooses its plain progress output when, as here, its
+    output is not a terminal.)
+
+    :param epoch: if given, the times of all files in the context are set
+      to this, as in `BuildContext.write_tar()`
+    :return: triple (return code, `(n_files, n_bytes)` of the context,
+      `StepTimer`)
+    """
+    proc = subprocess.Popen(
+        cmd.split(), stdin=subprocess.PIPE,
+        stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    counts = []
+
+    def send_context():
+        try:
+            counts.append(context.write_tar(proc.stdin, mtime=epoch))
+            proc.stdin.close()
+        except BrokenPipeError:
+            pass
+
+    # Send the context in a thread, so that the pipes cannot fill up and
+    # deadlock while we read the output.
+    sender = threading.Thread(target=send_context)
+    sender.start()
+    steps = StepTimer()
+    for raw in proc.stdout:
+        line = raw.decode(errors='replace')
+        sys.stdout.write(line)
+        steps.feed(line)
+    sender.join()
+    proc.wait()
+    steps.finish()
+    return proc.returncode, (counts[0] if counts else context.measure()), steps
+
+
+def run_api_build(client, context, image, digest, no_cache=False):
+    """
+    Build an image through the Docker Engine API, streaming the build context
+    to the daemon. Progress events are echoed, and parsed into per-step
+    timings, as in `run_build_command()`.
+
+    :return: triple (return code, `(n_files, n_bytes)` of the context,
+      `StepTimer`)
+    """
+    counts = []
+    steps = StepTimer()
+    returncode = 0
+    events = client.build(
+        lambda f: counts.append(context.write_tar(f)), image,
+        dockerfile=CONTEXT_DOCKERFILE_NAME, labels={BUILD_DIGEST_LABEL: digest},
+        nocache=no_cache)
+    for event in events:
+        if 'stream' in event:
+            sys.stdout.write(event['stream'])
+            for line in event['stream'].splitlines():
+                steps.feed(line)
+        elif 'error' in event:
+            print(event['error'])
+            returncode = 1
+    steps.finish()
+    return returncode, (counts[0] if counts else context.measure()), steps
+
+
+def report_build_steps(steps, image, digest, returncode, seconds):
+    """
+    Print the slowest steps of a build, and where caching was lost, and
+    append a record of the build to the file at `BUILD_HISTORY_PATH`.
+    """
+    from topics import locate_template_line
+    slowest = steps.slowest(N_SLOWEST_STEPS)
+    if slowest:
+        print('Slowest build steps:')
+        for step in slowest:
+            flag = ' (cached)' if step.cached else ''
+            print(f'  {step.seconds:8.1f}s  {step.name[:100]}{flag}')
+    hits, total = steps.cache_counts()
+    miss = steps.first_cache_miss()
+    miss_template = locate_template_line(miss.instruction) if miss else None
+    print(f'Cache hits: {hits} of {total} instructions.')
+    if miss:
+        where = f' [{miss_template}]' if miss_template else ''
+        print(f'First cache miss: {miss.name[:100]}{where}')
+    os.makedirs(os.path.dirname(BUILD_HISTORY_PATH), exist_ok=True)
+    with open(BUILD_HISTORY_PATH, 'a') as f:
+        f.write(json.dumps({
+            'time': simple_timestamp(),
+            'image': image,
+            'build_digest': digest,
+            'returncode': returncode,
+            'seconds': round(seconds, 3),
+            'cache_hits': hits,
+            'cacheable': total,
+            'first_cache_miss': miss.name if miss else None,
+            'first_cache_miss_template': miss_template,
+            'steps': [step.as_dict() for step in steps.steps],
+        }) + '\n')
+
+
 def finalize(df, image_name, tag, dump, dry_run):
+    """
+    Build an image from a rendered Dockerfile.
+
+    The build context is not the whole `SRC_ROOT` dir, but a tar stream
+    containing only the paths the Dockerfile copies. In a dry run, we report
+    the size of this context, compared to that of the whole `SRC_ROOT` dir.
+
+    If a local image of the same name was already built with the same build
+    digest, we skip the build, and simply give that image the requested tag.
+
+    If the `BUILDKIT_CACHE` setting in `conf.py` is true, we build with
+    BuildKit and a local layer cache.
+
+    The build output is parsed into per-step timings. We report the slowest
+    steps, and the first cache miss, and append a record of the build to the
+    file at `BUILD_HISTORY_PATH`.
+
+    If the `REPRODUCIBLE_BUILDS` setting in `conf.py` is true, we build
+    reproducibly, as described under `write_build_command()`. File times and
+    permissions in the build context are normalized too, so that `COPY` layers
+    do not depend on the state of the files on this machine.
+
+    If the `LAYER_REWRITE_LIMIT_MB` setting in `conf.py` is not `None`, we
+    check each new image with `check_layer_rewrites()`.
+
+    :return: the return code of the docker command, or `None` in a dry run
+    """
+    buildkit = BUILDKIT_CACHE
     df = strip_headers(df)
+    if buildkit:
+        # Cache mounts need the Dockerfile frontend to be at least v1.2. The
+        # syntax directive must come before any comment or instruction.
+        df = BUILDKIT_SYNTAX_DIRECTIVE + df.lstrip()
     if dump:
         dump_text_with_title(df, 'Dockerfile')
-    cmd = f'{DOCKER_CMD} build -f- -t {image_name}:{tag} {SRC_ROOT}'
-    print(cmd)
+    context = BuildContext(df, SRC_ROOT)
+    for src in context.missing:
+        print(f'WARNING: Build context is missing {src}')
+    epoch = get_source_date_epoch()
+    digest = compute_build_digest(context, dry_run, epoch=epoch)
     if not dry_run:
-        args = cmd.split()
-        subprocess.run(args, input=df, text=True)
+        save_dockerfile(context.dockerfile, digest)
+    if not dry_run and not force_fresh_builds:
+        existing_id = find_image_with_digest(image_name, digest)
+        if existing_id:
+            print(f'Found {image_name} image with build digest {digest}. Skipping build.')
+            return tag_image(existing_id, image_name, tag)
+    client = get_docker_client()
+    if client and not buildkit and epoch is None:
+        cmd = f'build {image_name}:{tag} via Docker Engine API at {client.socket_path}'
+    else:
+        client = None
+        cmd = write_build_command(
+            image_name, tag, buildkit, digest=digest, epoch=epoch, no_cache=force_fresh_builds)
+    print(cmd)
+    if dry_run:
+        n_files, n_bytes = context.measure()
+        full_files, full_bytes = measure_dir(SRC_ROOT)
+        print(
+            f'Build context: {format_bytes(n_bytes)} in {n_files} files'
+            f' (whole src dir: {format_bytes(full_bytes)} in {full_files} files)'
+        )
+    else:
+        t0 = time.monotonic()
+        with timing.phase(cmd, 'subprocess'):
+            if client:
+                returncode, (n_files, n_bytes), steps = run_api_build(
+                    client, context, f'{image_name}:{tag}', digest, no_cache=force_fresh_builds)
+            else:
+                returncode, (n_files, n_bytes), steps = run_build_command(cmd, context, epoch=epoch)
+        seconds = time.monotonic() - t0
+        print(f'Build context: {format_bytes(n_bytes)} in {n_files} files')
+        report_build_steps(steps, f'{image_name}:{tag}', digest, returncode, seconds)
+        if returncode == 0 and LAYER_REWRITE_LIMIT_MB is not None:
+            check_layer_rewrites(
+                f'{image_name}:{tag}', LAYER_REWRITE_LIMIT_MB,
+                base=find_final_base_image(context.dockerfile))
+        return returncode
+
 
+PFSC_BASE_IMAGE_NAME = 'pfsc-base'
 
-PYC_DOCKERIGNORE = """\
-**/__pycache__
-**/*.pyc
-"""
 
+def write_pfsc_base_build():
+    """
+    Write the Dockerfile for the pfsc-base image, and compute its tag.
+
+    The tag is a hash of the Dockerfile and the files it copies, i.e. the
+    pfsc-server requirements files, so that it changes exactly when the image
+    would.
 
-def write_dockerignore_for_pyc():
-    with open(os.path.join(SRC_ROOT, '.dockerignore'), 'w') as f:
-        f.write(PYC_DOCKERIGNORE)
+    :return: pair (Dockerfile, tag)
+    """
+    from topics.pfsc import write_pfsc_base_dockerfile
+    df = write_pfsc_base_dockerfile(buildkit=BUILDKIT_CACHE, bytecode=get_bytecode_strategy())
+    digest = BuildContext(strip_headers(df), SRC_ROOT).digest()
+    tag = digest[len('sha256:'):][:12]
+    return df, tag
+
+
+def ensure_pfsc_base_image(dump, dry_run):
+    """
+    Make sure the pfsc-base image for the current requirements exists locally,
+    building it if not.
+
+    :return: the name:tag of the image
+    """
+    df, tag = write_pfsc_base_build()
+    image = f'{PFSC_BASE_IMAGE_NAME}:{tag}'
+    if dry_run or get_local_image_id(image) is None:
+        returncode = finalize(df, PFSC_BASE_IMAGE_NAME, tag, dump, dry_run)
+        if returncode:
+            raise click.ClickException(f'Failed to build {image}')
+    return image
+
+
+# Name of the stage into which we inline the pfsc-base Dockerfile, when
+# building with `docker buildx`:
+PFSC_BASE_STAGE_NAME = 'pfsc-base'
+
+
+def prepare_pfsc_base(dump, dry_run):
+    """
+    Prepare pfsc-base, for a `server` or `oca` build to build `FROM`.
+
+    Builds via `docker buildx` (under `BUILDKIT_CACHE` or `REPRODUCIBLE_BUILDS`)
+    generally use a builder with the `docker-container` driver, which cannot
+    see images in the local image store. So in that case, instead of building
+    a separate pfsc-base image, we inline its Dockerfile as a named stage, to
+    be put ahead of the Dockerfile that builds `FROM` it. The BuildKit layer
+    cache then saves rebuilding it, as the separate image otherwise would.
+
+    :return: pair (name of the image or stage to build `FROM`, Dockerfile
+      text to put ahead of the Dockerfile that does so)
+    """
+    if BUILDKIT_CACHE or REPRODUCIBLE_BUILDS:
+        df, _ = write_pfsc_base_build()
+        stage, n = re.subn(
+            r'^FROM (\S+)[ \t]*$', rf'FROM \1 AS {PFSC_BASE_STAGE_NAME}',
+            strip_headers(df), count=1, flags=re.M)
+        assert n == 1
+        return PFSC_BASE_STAGE_NAME, stage + '\n'
+    return ensure_pfsc_base_image(dump, dry_run), ''
+
+
+@build.command()
+@click.option('--dump', is_flag=True, help="Dump Dockerfile to stdout before building.")
+@click.option('--dry-run', is_flag=True, help="Do not actually build; just print docker command.")
+def base(dump, dry_run):
+    """
+    Build a `pfsc-base` docker image, if it does not already exist.
+
+    This image has the Python runtime and the pfsc-server requirements, and is
+    the base for both the `pfsc-server` and `pise` images. It is tagged with a
+    hash of the requirements files (and of its Dockerfile), so is only rebuilt
+    when these change. The `server` and `oca` build commands build it as
+    needed, so you never have to use this command, but you can.
+    """
+    image = ensure_pfsc_base_image(dump, dry_run)
+    print(f'Base image: {image}')
 
 
 @build.command()
@@ -94,7 +608,9 @@ def server(demos, dump, dry_run, tag):
             raise click.FileError(f'Could not find {venv_path}. Have you installed pfsc-server yet?')
 
     from topics.pfsc import write_single_service_dockerfile
-    df = write_single_service_dockerfile(demos=demos)
+    base_image, base_stage = prepare_pfsc_base(dump, dry_run)
+    df = base_stage + write_single_service_dockerfile(
+        base_image, demos=demos, bytecode=get_bytecode_strategy())
     finalize(df, 'pfsc-server', tag, dump, dry_run)
 
 
@@ -127,6 +643,239 @@ def oca_readiness_checks(release=False):
         raise click.UsageError(f'Could not find wheels. Did you run `{advice}`?')
 
 
+def copy_file_from_image(image, src, dst):
+    """
+    Copy a file out of an image, via a container that is created, but never
+    started.
+    """
+    cmd = f'{DOCKER_CMD} create {image}'
+    container_id = subprocess.check_output(cmd.split(), text=True).strip()
+    try:
+        cmd = f'{DOCKER_CMD} cp {container_id}:{src} {dst}'
+        print(cmd)
+        subprocess.run(cmd.split(), check=True)
+    finally:
+        cmd = f'{DOCKER_CMD} rm {container_id}'
+        subprocess.run(cmd.split(), stdout=subprocess.DEVNULL)
+
+
+@build.command(name='check-layers')
+@click.option('--limit', type=float, default=None,
+              help="Max megabytes any one layer may rewrite. Default: LAYER_REWRITE_LIMIT_MB from conf.py, or else 5.")
+@click.option('--base', help="Name of the base image. Its layers are not checked.")
+@click.argument('image')
+def check_layers(limit, base, image):
+    """
+    Check that no layer of IMAGE rewrites too many bytes of existing files.
+
+    Layers that rewrite existing files (e.g. by changing their owner) store
+    them a second time, needlessly increasing the size of the image.
+    """
+    if limit is None:
+        limit = LAYER_REWRITE_LIMIT_MB if LAYER_REWRITE_LIMIT_MB is not None else 5
+    check_layer_rewrites(image, limit, base=base)
+
+
+def attribute_history(history, instructions):
+    """
+    Match the entries of an image's history with the instructions of the
+    final stage of the Dockerfile from which it was built.
+
+    The instructions account for the final entries of the history, except
+    that the classic builder records our `--label` option as one more entry.
+    Earlier entries belong to the base image.
+
+    :param history: list of `created_by` strings, for all history entries
+    :param instructions: list of pairs (INSTRUCTION, args), as returned by
+      `list_final_stage_instructions()`
+    :return: list, parallel to `history`, of instruction pairs, or `None`
+      for entries not made by any of the given instructions
+    """
+    n = len(history)
+    while n > 0 and BUILD_DIGEST_LABEL in history[n - 1]:
+        n -= 1
+    k = min(n, len(instructions))
+    matched = [None] * len(history)
+    matched[n - k:n] = instructions[len(instructions) - k:]
+    return matched
+
+
+def split_image_name(image):
+    name, sep, tag = image.rpartition(':')
+    if not sep or '/' in tag:
+        return image, 'latest'
+    return name, tag
+
+
+@build.command(name='inspect')
+@click.option('--top', default=5, help="Number of largest dirs to show for each big layer.")
+@click.option('--depth', default=3, help="Depth of the dirs to which we attribute bytes.")
+@click.option('--dups', default=10, help="Number of duplicated files to show.")
+@click.option('--output', help="Path for the JSON results. Default: build-cache/inspect/NAME/TAG.json under PFSC_ROOT.")
+@click.argument('image')
+def inspect_image(top, depth, dups, output, image):
+    """
+    Report on the size of each layer of IMAGE.
+
+    Layers are mapped back to the Dockerfile instructions, and the template
+    lines, that produced them. For big layers, we list the dirs to which they
+    add the most bytes, and we list files duplicated across layers.
+
+    Results are also saved as JSON, by default under the image's name and tag,
+    so that sizes can be compared across releases.
+
+    Instructions are available only for images built by pfsc, with the same
+    PFSC_ROOT.
+    """
+    from topics import locate_template_line
+    meta = inspect_images([image])[0]
+    contents = {}
+    with tempfile.TemporaryDirectory() as tmp_dir_name:
+        path = os.path.join(tmp_dir_name, 'image.tar')
+        cmd = f'{DOCKER_CMD} save -o {path} {image}'
+        with timing.phase(cmd, 'subprocess'):
+            subprocess.run(cmd.split(), check=True)
+        with timing.phase('analyze image layers', 'compute'):
+            layers, history = analyze_saved_image(path, dir_depth=depth, contents=contents)
+
+    digest = (meta.get('Config', {}).get('Labels') or {}).get(BUILD_DIGEST_LABEL)
+    df_path = saved_dockerfile_path(digest) if digest else None
+    if df_path and os.path.exists(df_path):
+        with open(df_path) as f:
+            instructions = list_final_stage_instructions(f.read())
+    else:
+        df_path = None
+        print(f'WARNING: No saved Dockerfile for {image}. Cannot map layers to instructions.')
+        instructions = []
+    matched = attribute_history(history, instructions)
+
+    results = []
+    print(f'{"layer":>5s}  {"size":>10s}  {"rewritten":>10s}  instruction')
+    for layer in layers:
+        instr = matched[layer.history_index] if layer.history_index is not None else None
+        if instr:
+            text = f'{instr[0]} {instr[1]}'
+            template = locate_template_line(text)
+        else:
+            text = layer.created_by
+            template = None
+        text = ' '.join(text.split())
+        print(f'{layer.index:5d}  {format_bytes(layer.size):>10s}  '
+              f'{format_bytes(layer.rewritten):>10s}  {text[:80]}')
+        if template:
+            print(f'{"":31s}[{template}]')
+        if layer.size >= 1024 * 1024:
+            for dir_path, n in layer.largest_dirs(top):
+                print(f'{"":31s}{format_bytes(n):>10s}  {dir_path}')
+        results.append({
+            'index': layer.index,
+            'instruction': text if instr else None,
+            'created_by': layer.created_by,
+            'template': template,
+            'size': layer.size,
+            'files': layer.n_files,
+            'rewritten': layer.rewritten,
+            'top_dirs': layer.largest_dirs(top),
+        })
+    print(f'Total: {format_bytes(meta.get("Size", sum(r["size"] for r in results)))}')
+
+    duplicates = find_duplicates(contents)
+    if duplicates:
+        print('Files duplicated across layers:')
+        for size, copies in duplicates[:dups]:
+            layer_index, file_path = copies[0]
+            print(f'  {format_bytes(size):>10s} x {len(copies)}  {file_path} (layer {layer_index})'
+                  + ''.join(f'\n{"":20s}{p} (layer {i})' for i, p in copies[1:]))
+
+    if output is None:
+        name, tag = split_image_name(image)
+        output = os.path.join(INSPECT_ROOT, name, f'{tag}.json')
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w') as f:
+        json.dump({
+            'image': image,
+            'id': meta.get('Id'),
+            'created': meta.get('Created'),
+            'size': meta.get('Size'),
+            'build_digest': digest,
+            'dockerfile': df_path,
+            'layers': results,
+            'duplicates': [
+                {'size': size, 'copies': copies} for size, copies in duplicates[:1000]
+            ],
+        }, f, indent=4)
+    print(f'Wrote {output}')
+
+
+@contextmanager
+def staging_dir(name):
+    """
+    Provide a dir under `SRC_TMP_ROOT`, for staging files to be copied into an
+    image. The dir is emptied before use, and removed afterward.
+
+    The dir has a stable path, `SRC_TMP_ROOT/name`, so that the Dockerfiles
+    that copy from it (and hence the build digests and layer cache keys) do not
+    change from one build to the next, or from one machine to another.
+    """
+    path = os.path.join(SRC_TMP_ROOT, name)
+    shutil.rmtree(path, ignore_errors=True)
+    os.makedirs(path)
+    try:
+        yield path
+    finally:
+        shutil.rmtree(path, ignore_errors=True)
+
+
+def link_or_copy(src, dst):
+    """
+    Hard-link a file if possible (staging dirs are on the same filesystem as
+    the sources, so usually this is possible), else copy it.
+    """
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copy2(src, dst)
+    return dst
+
+
+def stage_files(assets, staging_dir, dry_run=False):
+    """
+    Stage files and directories under one directory, so that a Dockerfile can
+    copy them all in a single layer.
+
+    :param assets: list of pairs (src, dst), where src is a path relative to
+      `SRC_ROOT`, and dst is the desired path relative to `staging_dir`
+    :param staging_dir: the directory in which to stage the assets
+    :param dry_run: if true, a missing asset is only reported
+    :raises: click.UsageError if an asset is missing, and not a dry run
+    """
+    for src, dst in assets:
+        src_path = os.path.join(SRC_ROOT, src)
+        dst_path = os.path.join(staging_dir, dst)
+        if not os.path.exists(src_path):
+            if not dry_run:
+                raise click.UsageError(f'Cannot stage missing {src_path}')
+            print(f'WARNING: Cannot stage missing {src}')
+            continue
+        os.makedirs(os.path.dirname(dst_path), exist_ok=True)
+        if os.path.isdir(src_path):
+            shutil.copytree(
+                src_path, dst_path, copy_function=link_or_copy, dirs_exist_ok=True,
+                ignore=lambda d, names: [n for n in names if is_bytecode(n)]
+            )
+        else:
+            link_or_copy(src_path, dst_path)
+
+
+def stage_oca_static_assets(tmp_dir_name, dry_run=False):
+    """
+    Stage all the OCA's static assets under `{tmp_dir_name}/static`, laid out
+    as in the final static dir.
+    """
+    from topics.pfsc import list_oca_static_assets
+    stage_files(list_oca_static_assets(), os.path.join(tmp_dir_name, 'static'), dry_run=dry_run)
+
+
 @build.command()
 @click.option('--release', is_flag=True, help="Set true if this is a release build. Adds license file.")
 @click.option('--dump', is_flag=True, help="Dump Dockerfile to stdout before building.")
@@ -147,7 +896,7 @@ def oca(release, dump, dry_run, tag):
     from topics.pfsc import write_worker_and_web_supervisor_ini
     from topics.pfsc import write_proofscape_oca_dockerfile
     from topics.redis import write_redisgraph_ini
-    with tempfile.TemporaryDirectory(dir=SRC_TMP_ROOT) as tmp_dir_name:
+    with staging_dir('pise') as tmp_dir_name:
         with open(os.path.join(tmp_dir_name, 'eula.txt'), 'w') as f:
             eula = write_oca_eula_file(tag)
             f.write(eula)
@@ -161,52 +910,29 @@ def oca(release, dump, dry_run, tag):
         with open(os.path.join(tmp_dir_name, 'oca_version.txt'), 'w') as out:
             with open(os.path.join(PFSC_MANAGE_ROOT, 'topics', 'pfsc', 'oca_version.txt')) as f:
                 out.write(f.read())
+        stage_oca_static_assets(tmp_dir_name, dry_run=dry_run)
         tmp_dir_rel_path = os.path.relpath(tmp_dir_name, start=SRC_ROOT)
-        write_dockerignore_for_pyc()
-        df = write_proofscape_oca_dockerfile(tmp_dir_rel_path)
-
-        # We use a two-step process to help us write the combined license file.
-        # In Step 1 we build the whole image except for that file. Then we have
-        # a chance to read information out of that image, to help us generate
-        # the file. Then in Step 2 we build another image, which contains the file.
-        #
-        # Currently the only reason all this is needed is so that we can determine
-        # which python packages are run requirements, and not list license info
-        # for dev requirements that are not actually present in the image.
-        # It seems like there could be a better way to do this, especially if
-        # pip would be able to spit out the list of all recursive requirements
-        # based on our req/run.txt file. Maybe we can use `pip-tools` somehow?
-        #
-        # Maybe instead it should be a multi-stage build including a stage that
-        # copies pfsc-manage and pfsc-ise into the image, and generates the combined
-        # licence file in there, then simply copies this file into still another
-        # build stage (the final one).
-
-        step_1_tag = tag if (dry_run or not release) else tag + '-without-license-file'
-        step_2_tag = tag
-        # Step 1
-        finalize(df, 'pise', step_1_tag, dump, dry_run)
-        if release and not dry_run:
-            # Step 2
-            license_file_text = tools.license.oca.callback(f'pise:{step_1_tag}')
+        license_bundle_dir = None
+        if release:
+            # The combined license file is generated in a stage of the build
+            # itself, so that it can list just those Python packages that are
+            # actually installed in the image. See `tools.license_assembly`.
+            license_bundle_dir = f'{tmp_dir_rel_path}/licenses'
+            if not dry_run:
+                import tools.license
+                tools.license.write_oca_license_bundle_dir(
+                    os.path.join(tmp_dir_name, 'licenses'))
+        base_image, base_stage = prepare_pfsc_base(dump, dry_run)
+        df = base_stage + write_proofscape_oca_dockerfile(
+            tmp_dir_rel_path, base_image, buildkit=BUILDKIT_CACHE,
+            license_bundle_dir=license_bundle_dir,
+            bytecode=get_bytecode_strategy())
+        returncode = finalize(df, 'pise', tag, dump, dry_run)
+        if release and not dry_run and returncode == 0:
             # Update the copy under version control (which exists so there is
             # a linkable copy on the web):
             vc_clf = os.path.join(PFSC_MANAGE_ROOT, 'topics', 'pfsc', 'oca_combined_license_file.txt')
-            with open(vc_clf, 'w') as f:
-                f.write(license_file_text)
-            # Write it into the final Docker image:
-            clf_name = "LICENSES.txt"
-            tmp_clf = os.path.join(tmp_dir_name, clf_name)
-            with open(tmp_clf, 'w') as f:
-                f.write(license_file_text)
-            df2 = (
-                f'FROM pise:{step_1_tag}\n'
-                f'COPY {tmp_dir_rel_path}/{clf_name} ./\n'
-                f'USER root\n'
-                f'RUN chown pfsc:pfsc {clf_name}\n'
-                f'USER pfsc\n'
-            )
-            finalize(df2, 'pise', step_2_tag, False, False)
+            copy_file_from_image(f'pise:{tag}', '/home/pfsc/LICENSES.txt', vc_clf)
 
 
 @build.command()
@@ -224,20 +950,13 @@ def dummy(dump, dry_run, tag):
     See also: `--dummy` switch to `pfsc deploy generate`.
     """
     from topics.dummy import write_web_py, write_dummy_server_dockerfile
-    with tempfile.TemporaryDirectory(dir=SRC_TMP_ROOT) as tmp_dir_name:
+    with staging_dir('pfsc-dummy-server') as tmp_dir_name:
         with open(os.path.join(tmp_dir_name, 'web.py'), 'w') as f:
             py = write_web_py()
             f.write(py)
         tmp_dir_rel_path = os.path.relpath(tmp_dir_name, start=SRC_ROOT)
         df = write_dummy_server_dockerfile(tmp_dir_rel_path)
-        df = strip_headers(df)
-        if dump:
-            dump_text_with_title(df, 'Dockerfile')
-        cmd = f'{DOCKER_CMD} build -f- -t pfsc-dummy-server:{tag} {SRC_ROOT}'
-        print(cmd)
-        if not dry_run:
-            args = cmd.split()
-            subprocess.run(args, input=df, text=True)
+        finalize(df, 'pfsc-dummy-server', tag, dump, dry_run)
 
 
 @build.command()
@@ -252,22 +971,16 @@ def static(dump, dry_run, tag):
     production deployment of the Proofscape ISE.
     """
     from topics.static import write_static_nginx_dockerfile, write_nginx_conf
-    with tempfile.TemporaryDirectory(dir=SRC_TMP_ROOT) as tmp_dir_name:
+    with staging_dir('pfsc-static-nginx') as tmp_dir_name:
         nc = write_nginx_conf()
         nc_path = os.path.join(tmp_dir_name, 'nginx.conf')
         with open(nc_path, 'w') as f:
             f.write(nc)
         tmp_dir_rel_path = os.path.relpath(tmp_dir_name, start=SRC_ROOT)
         df = write_static_nginx_dockerfile(tmp_dir_rel_path)
-        df = strip_headers(df)
         if dump:
-            dump_text_with_title(df, 'Dockerfile')
             dump_text_with_title(nc, nc_path)
-        cmd = f'{DOCKER_CMD} build -f- -t pfsc-static-nginx:{tag} {SRC_ROOT}'
-        print(cmd)
-        if not dry_run:
-            args = cmd.split()
-            subprocess.run(args, input=df, text=True)
+        finalize(df, 'pfsc-static-nginx', tag, dump, dry_run)
 
 
 #@build.command()
@@ -301,17 +1014,10 @@ def elkjs_builder(dump, dry_run, tag):
     This image can be used to build elkjs, based on our custom ELK code.
     """
     from topics.elk import write_elk_build_env_dockerfile
-    with tempfile.TemporaryDirectory(dir=SRC_TMP_ROOT) as tmp_dir_name:
+    with staging_dir('elkjs-build-env') as tmp_dir_name:
         tmp_dir_rel_path = os.path.relpath(tmp_dir_name, start=SRC_ROOT)
         df = write_elk_build_env_dockerfile(tmp_dir_rel_path)
-        df = strip_headers(df)
-        if dump:
-            dump_text_with_title(df, 'Dockerfile')
-        cmd = f'{DOCKER_CMD} build -f- -t elkjs-build-env:{tag} {SRC_ROOT}'
-        print(cmd)
-        if not dry_run:
-            args = cmd.split()
-            subprocess.run(args, input=df, text=True)
+        finalize(df, 'elkjs-build-env', tag, dump, dry_run)
 
 
 @build.command()
@@ -325,21 +1031,14 @@ def redis(dump, dry_run, tag):
     This image runs Redis with our custom redis.conf.
     """
     from topics.redis import write_redis_conf, write_pfsc_redis_dockerfile
-    with tempfile.TemporaryDirectory(dir=SRC_TMP_ROOT) as tmp_dir_name:
+    with staging_dir('pfsc-redis') as tmp_dir_name:
         rc = write_redis_conf()
         rc_path = os.path.join(tmp_dir_name, 'redis.conf')
         with open(rc_path, 'w') as f:
             f.write(rc)
         tmp_dir_rel_path = os.path.relpath(tmp_dir_name, start=SRC_ROOT)
         df = write_pfsc_redis_dockerfile(tmp_dir_rel_path)
-        df = strip_headers(df)
-        if dump:
-            dump_text_with_title(df, 'Dockerfile')
-        cmd = f'{DOCKER_CMD} build -f- -t pfsc-redis:{tag} {SRC_ROOT}'
-        print(cmd)
-        if not dry_run:
-            args = cmd.split()
-            subprocess.run(args, input=df, text=True)
+        finalize(df, 'pfsc-redis', tag, dump, dry_run)
 
 @build.command()
 @click.option('--dump', is_flag=True, help="Dump Dockerfile to stdout before building.")
@@ -354,18 +1053,213 @@ def redisgraph(dump, dry_run, tag):
     background dumps of the database.
     """
     from topics.redis import write_redisgraph_conf, write_pfsc_redisgraph_dockerfile
-    with tempfile.TemporaryDirectory(dir=SRC_TMP_ROOT) as tmp_dir_name:
+    with staging_dir('pfsc-redisgraph') as tmp_dir_name:
         rc = write_redisgraph_conf()
         rc_path = os.path.join(tmp_dir_name, 'redisgraph.conf')
         with open(rc_path, 'w') as f:
             f.write(rc)
         tmp_dir_rel_path = os.path.relpath(tmp_dir_name, start=SRC_ROOT)
         df = write_pfsc_redisgraph_dockerfile(tmp_dir_rel_path)
-        df = strip_headers(df)
-        if dump:
-            dump_text_with_title(df, 'Dockerfile')
-        cmd = f'{DOCKER_CMD} build -f- -t pfsc-redisgraph:{tag} {SRC_ROOT}'
-        print(cmd)
-        if not dry_run:
-            args = cmd.split()
-            subprocess.run(args, input=df, text=True)
+        finalize(df, 'pfsc-redisgraph', tag, dump, dry_run)
+
+
+# The images built by `pfsc build all`, named by their build commands, and for
+# each one, the list of images it depends on. An image depends on any of our
+# own images that it is built `FROM`.
+BUILD_ALL_DEPS = {
+    'base': [],
+    'server': ['base'],
+    'static': [],
+    'redis': [],
+    'redisgraph': [],
+    'dummy': [],
+    'oca': ['base'],
+}
+# The names of the images made by these build commands:
+BUILD_IMAGE_NAMES = {
+    'base': PFSC_BASE_IMAGE_NAME,
+    'server': 'pfsc-server',
+    'static': 'pfsc-static-nginx',
+    'redis': 'pfsc-redis',
+    'redisgraph': 'pfsc-redisgraph',
+    'dummy': 'pfsc-dummy-server',
+    'oca': 'pise',
+}
+# Images whose build commands take no TAG, since they compute their own:
+BUILD_ALL_SELF_TAGGED = ['base']
+
+
+@build.command(name='check-repro')
+@click.argument('target', type=click.Choice(
+    [name for name in BUILD_ALL_DEPS if name not in BUILD_ALL_SELF_TAGGED]))
+@click.argument('tag')
+@click.pass_context
+def check_repro(ctx, target, tag):
+    """
+    Check that an image builds reproducibly.
+
+    TARGET is one of our build commands, e.g. `server`. We run it with the
+    given TAG, then run it again without the layer cache, and compare the
+    digests of the layers of the two images. Identical layers can be shared
+    between machines, e.g. through BUILDKIT_CACHE_REGISTRY.
+
+    Builds are reproducible only if REPRODUCIBLE_BUILDS is set in conf.py.
+    """
+    global force_fresh_builds
+    if not REPRODUCIBLE_BUILDS:
+        print('WARNING: REPRODUCIBLE_BUILDS is not set in conf.py. Expect differences.')
+    command = build.get_command(ctx, target)
+    ctx.invoke(command, tag=tag)
+    image = f'{BUILD_IMAGE_NAMES[target]}:{tag}'
+    first = list_layer_digests([image])[0]
+    force_fresh_builds = True
+    try:
+        ctx.invoke(command, tag=tag)
+    finally:
+        force_fresh_builds = False
+    second = list_layer_digests([image])[0]
+    different = [
+        (i, a, b) for i, (a, b) in enumerate(zip_longest(first, second)) if a != b
+    ]
+    if different:
+        lines = [f'Build of {image} is not reproducible. Layers differing:']
+        lines.extend(f'  layer {i}: {a} != {b}' for i, a, b in different)
+        lines.append(f'See `pfsc build inspect {image}` to map layers to instructions.')
+        raise click.ClickException('\n'.join(lines))
+    print(f'Build of {image} is reproducible: all {len(first)} layers are identical.')
+
+
+def check_build_failures(nodes):
+    failed = [name for name, node in nodes.items() if node.status != 'ok']
+    if failed:
+        raise click.ClickException(f'Builds did not succeed: {", ".join(failed)}')
+
+
+@build.command(name='all')
+@click.option('-j', '--jobs', type=click.IntRange(min=1), default=2, help="Max number of builds to run at once. Default 2.")
+@click.option('--skip', default='', help="Comma-delimited list of images not to build, e.g. `dummy,redis`.")
+@click.option('--dry-run', is_flag=True, help="Do not actually build; just print docker commands (in the logs).")
+@click.argument('tag')
+def build_all(jobs, skip, dry_run, tag):
+    """
+    Build all our docker images, and give them all the same TAG.
+
+    Builds run concurrently, except where one image depends on another.
+    Each build writes its output to a log file under PFSC_ROOT/build-cache/logs.
+    If you skip an image, images depending on it will use the existing one.
+    """
+    skipped = {s.strip() for s in skip.split(',') if s.strip()}
+    unknown = skipped - set(BUILD_ALL_DEPS)
+    if unknown:
+        raise click.UsageError(f'Unknown images: {", ".join(sorted(unknown))}')
+    nodes = {}
+    for name, deps in BUILD_ALL_DEPS.items():
+        if name in skipped:
+            continue
+        args = ['build', name] + (['--dry-run'] if dry_run else [])
+        if name not in BUILD_ALL_SELF_TAGGED:
+            args.append(tag)
+        nodes[name] = BuildNode(name, args, [d for d in deps if d not in skipped])
+    log_dir = os.path.join(BUILD_LOG_ROOT, simple_timestamp())
+    wall_seconds = run_build_graph(nodes, jobs, log_dir)
+    click.echo(write_build_summary(nodes, wall_seconds))
+    check_build_failures(nodes)
+
+
+def require_zstd():
+    if shutil.which('zstd') is None:
+        raise click.UsageError('Image bundles require the `zstd` command. Please install it.')
+
+
+@build.command(name='have')
+@click.option('-o', '--output', default='-', help="Path for the list. Default: stdout.")
+def have_layers(output):
+    """
+    List the image layers this host has, for `pfsc build export --have`.
+
+    Run this on a host to which you want to transfer images, and copy the
+    output to the host where the images are built.
+    """
+    client = get_docker_client()
+    if client:
+        ids = sorted({image['Id'] for image in client.list_images()})
+    else:
+        cmd = f'{DOCKER_CMD} images -q --no-trunc'
+        ids = sorted(set(subprocess.check_output(cmd.split(), text=True).split()))
+    chain_ids = set()
+    if ids:
+        for diff_ids in list_layer_digests(ids):
+            chain_ids.update(compute_chain_ids(diff_ids))
+    with click.open_file(output, 'w') as f:
+        json.dump({
+            'time': simple_timestamp(),
+            'chain_ids': sorted(chain_ids),
+        }, f, indent=4)
+
+
+@build.command(name='export')
+@click.option('--have', 'have_path', type=click.Path(exists=True, dir_okay=False),
+              help="File written by `pfsc build have` on the target host. Layers it lists are omitted.")
+@click.option('-o', '--output', required=True, help="Path for the bundle, or `-` for stdout.")
+@click.option('--level', type=click.IntRange(1, 19), default=10, help="zstd compression level. Default 10.")
+@click.argument('images', nargs=-1, required=True)
+def export_images(have_path, output, level, images):
+    """
+    Write a compressed bundle of IMAGES, for `pfsc build import`.
+
+    With `--have`, layers the target host already has are left out, so that
+    e.g. an update of `pise` that changes only pfsc-server code carries only
+    the layers that changed.
+    """
+    require_zstd()
+    have = set()
+    if have_path:
+        with open(have_path) as f:
+            have = set(json.load(f)['chain_ids'])
+    omit = find_omittable_layers(list_layer_digests(images), have)
+    save_cmd = f'{DOCKER_CMD} save {" ".join(images)}'
+    digests = None
+    if omit:
+        with timing.phase(f'{save_cmd} (hash layers)', 'subprocess'):
+            save = subprocess.Popen(save_cmd.split(), stdout=subprocess.PIPE)
+            digests = hash_layer_members(save.stdout)
+            save.stdout.close()
+            # For the OCI layout we stop reading early, and `docker save` may
+            # then fail with a broken pipe. Otherwise it must succeed.
+            if save.wait() and digests is not None:
+                raise click.ClickException(f'Failed: {save_cmd}')
+    zstd_cmd = f'zstd -q -T0 -{level} -c'
+    with click.open_file(output, 'wb') as out:
+        with timing.phase(f'{save_cmd} | {zstd_cmd}', 'subprocess'):
+            save = subprocess.Popen(save_cmd.split(), stdout=subprocess.PIPE)
+            zstd = subprocess.Popen(zstd_cmd.split(), stdin=subprocess.PIPE, stdout=out)
+            written, omitted = filter_saved_images(save.stdout, zstd.stdin, omit, digests)
+            zstd.stdin.close()
+            if save.wait() or zstd.wait():
+                raise click.ClickException(f'Failed: {save_cmd} | {zstd_cmd}')
+    click.echo(
+        f'Bundled {", ".join(images)}: {format_bytes(written)} uncompressed,'
+        f' omitting {len(omit)} layer(s) ({format_bytes(omitted)}) the target has.',
+        err=True)
+
+
+@build.command(name='import')
+@click.argument('bundle')
+def import_images(bundle):
+    """
+    Load the images in a BUNDLE written by `pfsc build export`.
+
+    BUNDLE may be `-` for stdin, so that a bundle can be piped in, e.g.
+    over ssh. The bundle is decompressed straight into `docker load`, without
+    temporary files.
+    """
+    require_zstd()
+    zstd_cmd = f'zstd -q -dc {bundle}'
+    load_cmd = f'{DOCKER_CMD} load'
+    with timing.phase(f'{zstd_cmd} | {load_cmd}', 'subprocess'):
+        zstd = subprocess.Popen(zstd_cmd.split(), stdout=subprocess.PIPE)
+        load = subprocess.Popen(load_cmd.split(), stdin=zstd.stdout)
+        # Let `docker load` be the only reader, so zstd sees it if it exits.
+        zstd.stdout.close()
+        if load.wait() or zstd.wait():
+            raise click.ClickException(f'Failed: {zstd_cmd} | {load_cmd}')
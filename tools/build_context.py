@@ -0,0 +1,361 @@
+# --------------------------------------------------------------------------- #
+#   Proofscape Manage                                                         #
+#                                                                             #
+#   Copyright (c) 2021-2022 Proofscape contributors                           #
+#                                                                             #
+#   Licensed under the Apache License, Version 2.0 (the "License");           #
+#   you may not use this file except in compliance with the License.          #
+#   You may obtain a copy of the License at                                   #
+#                                                                             #
+#       http://www.apache.org/licenses/LICENSE-2.0                            #
+#                                                                             #
+#   Unless required by applicable law or agreed to in writing, software       #
+#   distributed under the License is distributed on an "AS IS" BASIS,         #
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.  #
+#   See the License for the specific language governing permissions and       #
+#   limitations under the License.                                            #
+# --------------------------------------------------------------------------- #
+
+"""
+Minimal build contexts for `docker build`.
+
+Instead of sending the whole `PFSC_ROOT/src` dir to the docker daemon as the
+build context, we read the rendered Dockerfile, determine exactly which paths
+it copies from the context (via `COPY` or `ADD`), and stream a tar archive
+containing just those paths, plus the Dockerfile itself.
+
+As always, Python bytecode files are excluded from the context.
+
+The same analysis gives us a content digest for a build: a hash of the
+Dockerfile together with everything it copies from the context. Two builds
+with the same digest produce equivalent images.
+"""
+
+import glob
+import hashlib
+import io
+import json
+import os
+import tarfile
+
+# Name under which the Dockerfile is stored in the context archive:
+CONTEXT_DOCKERFILE_NAME = 'Dockerfile.pfsc-manage'
+
+
+def iter_instructions(df):
+    """
+    Iterate over the instructions in a Dockerfile, joining continuation lines,
+    and skipping comments and blank lines.
+
+    :param df: the text of the Dockerfile
+    :return: generator of pairs (INSTRUCTION, args), where INSTRUCTION is in
+      upper case, and args is the remainder of the instruction, as a string.
+    """
+    pending = ''
+    for line in df.split('\n'):
+        stripped = line.strip()
+        if not pending and (not stripped or stripped.startswith('#')):
+            continue
+        if stripped.endswith('\\'):
+            pending += stripped[:-1] + ' '
+            continue
+        full = (pending + stripped).strip()
+        pending = ''
+        if full:
+            parts = full.split(None, 1)
+            yield parts[0].upper(), (parts[1] if len(parts) > 1 else '')
+    if pending.strip():
+        parts = pending.strip().split(None, 1)
+        yield parts[0].upper(), (parts[1] if len(parts) > 1 else '')
+
+
+def parse_copy_args(args):
+    """
+    Parse the args of a `COPY` or `ADD` instruction.
+
+    :return: triple (flags, sources, dest), where flags is a dict mapping flag
+      names (without leading `--`) to values (or `True` if valueless).
+    """
+    flags = {}
+    tokens = args.split()
+    while tokens and tokens[0].startswith('--'):
+        flag = tokens.pop(0)[2:]
+        name, eq, value = flag.partition('=')
+        flags[name] = value if eq else True
+    rest = ' '.join(tokens)
+    if rest.startswith('['):
+        tokens = json.loads(rest)
+    return flags, tokens[:-1], tokens[-1] if tokens else None
+
+
+def list_context_sources(df):
+    """
+    List the paths, relative to the build context, that a Dockerfile copies
+    from the context.
+
+    Paths copied from other build stages (`--from`) and URLs passed to `ADD`
+    are skipped.
+    """
+    sources = []
+    for instr, args in iter_instructions(df):
+        if instr not in ['COPY', 'ADD']:
+            continue
+        flags, srcs, _ = parse_copy_args(args)
+        if 'from' in flags:
+            continue
+        for src in srcs:
+            if '://' in src:
+                continue
+            src = os.path.normpath(src.lstrip('/'))
+            if src not in sources:
+                sources.append(src)
+    return sources
+
+
+def list_base_images(df):
+    """
+    List the images named in a Dockerfile's `FROM` instructions, skipping
+    references to earlier build stages.
+    """
+    images, stages = [], set()
+    for instr, args in iter_instructions(df):
+        if instr != 'FROM':
+            continue
+        tokens = [t for t in args.split() if not t.startswith('--')]
+        if not tokens:
+            continue
+        image = tokens[0]
+        if image not in stages and image not in images:
+            images.append(image)
+        if len(tokens) >= 3 and tokens[1].upper() == 'AS':
+            stages.add(tokens[2])
+    return images
+
+
+def find_final_base_image(df):
+    """
+    Find the image on which the final stage of a Dockerfile is based, following
+    references to earlier stages back to an actual image.
+    """
+    stages, image = {}, None
+    for instr, args in iter_instructions(df):
+        if instr != 'FROM':
+            continue
+        tokens = [t for t in args.split() if not t.startswith('--')]
+        if not tokens:
+            continue
+        image = stages.get(tokens[0], tokens[0])
+        if len(tokens) >= 3 and tokens[1].upper() == 'AS':
+            stages[tokens[2]] = image
+    return image
+
+
+def list_final_stage_instructions(df):
+    """
+    List the instructions that make up the final stage of a Dockerfile. When
+    that stage is based on an earlier stage, the instructions of the latter
+    come first, and so on back to an actual image. `FROM` instructions are
+    not included.
+
+    These are the instructions that, in order, produce the final entries in
+    the history of the image that is built.
+
+    :return: list of pairs (INSTRUCTION, args), as in `iter_instructions()`.
+    """
+    stages, current = {}, []
+    for instr, args in iter_instructions(df):
+        if instr != 'FROM':
+            current.append((instr, args))
+            continue
+        tokens = [t for t in args.split() if not t.startswith('--')]
+        current = list(stages.get(tokens[0], [])) if tokens else []
+        if len(tokens) >= 3 and tokens[1].upper() == 'AS':
+            stages[tokens[2]] = current
+    return current
+
+
+def is_bytecode(name):
+    base = os.path.basename(name)
+    return base == '__pycache__' or base.endswith('.pyc')
+
+
+def normalize_tarinfo(tarinfo, mtime):
+    tarinfo.mtime = mtime
+    tarinfo.uid = tarinfo.gid = 0
+    tarinfo.uname = tarinfo.gname = 'root'
+    executable = tarinfo.isdir() or tarinfo.mode & 0o111
+    tarinfo.mode = 0o755 if executable else 0o644
+
+
+def prune_nested(paths):
+    """
+    Given a list of relative paths, drop any that lie under another one.
+    """
+    kept = []
+    for p in sorted(paths):
+        if not any(p == k or p.startswith(k + os.sep) for k in kept):
+            kept.append(p)
+    return kept
+
+
+def format_bytes(n):
+    if n < 1024:
+        return f'{n} B'
+    for unit in ['KB', 'MB', 'GB']:
+        n /= 1024
+        if n < 1024 or unit == 'GB':
+            return f'{n:.1f} {unit}'
+
+
+def measure_dir(root):
+    """
+    Count the files and bytes under a directory, as `docker build` would send
+    them, i.e. excluding Python bytecode files.
+
+    :return: pair (number of files, number of bytes)
+    """
+    n_files, n_bytes = 0, 0
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames[:] = [d for d in dirnames if not is_bytecode(d)]
+        for name in filenames:
+            if is_bytecode(name):
+                continue
+            path = os.path.join(dirpath, name)
+            if os.path.islink(path):
+                continue
+            n_files += 1
+            n_bytes += os.path.getsize(path)
+    return n_files, n_bytes
+
+
+class BuildContext:
+    """
+    The minimal build context for a Dockerfile.
+    """
+
+    def __init__(self, dockerfile, root):
+        """
+        :param dockerfile: the text of the Dockerfile
+        :param root: the directory relative to which the Dockerfile's
+          `COPY` sources are to be resolved
+        """
+        self.dockerfile = dockerfile
+        self.root = root
+        self.sources = []
+        self.missing = []
+        expanded = []
+        for src in list_context_sources(dockerfile):
+            matches = glob.glob(os.path.join(root, src))
+            if matches:
+                expanded.extend(os.path.relpath(m, start=root) for m in matches)
+            else:
+                self.missing.append(src)
+        self.sources = prune_nested(expanded)
+
+    def measure(self):
+        """
+        :return: pair (number of files, number of bytes) in the context, not
+          counting the Dockerfile
+        """
+        n_files, n_bytes = 0, 0
+        for src in self.sources:
+            path = os.path.join(self.root, src)
+            if os.path.isdir(path) and not os.path.islink(path):
+                f, b = measure_dir(path)
+                n_files += f
+                n_bytes += b
+            elif not os.path.islink(path):
+                n_files += 1
+                n_bytes += os.path.getsize(path)
+        return n_files, n_bytes
+
+    def iter_files(self):
+        """
+        Iterate over the files in the context, in a deterministic order.
+
+        :return: generator of pairs (relative path, absolute path). Symlinks
+          are included (but not followed), while bytecode files are skipped.
+        """
+        for src in self.sources:
+            path = os.path.join(self.root, src)
+            if not os.path.isdir(path) or os.path.islink(path):
+                yield src, path
+                continue
+            for dirpath, dirnames, filenames in os.walk(path):
+                dirnames[:] = sorted(d for d in dirnames if not is_bytecode(d))
+                for name in sorted(filenames):
+                    if not is_bytecode(name):
+                        full = os.path.join(dirpath, name)
+                        yield os.path.relpath(full, start=self.root), full
+
+    def digest(self, extras=None, normalize=None):
+        """
+        Compute a content digest for the build.
+
+        The digest covers the Dockerfile, and the path, executable bit, and
+        contents of every file in the context.
+
+        :param extras: optional list of further strings to be hashed, e.g. the
+          IDs of the base images
+        :param normalize: optional function to be applied to the Dockerfile
+          text and to each relative path before hashing, e.g. in order to
+          erase the names of temporary directories
+        :return: hex digest string, prefixed with `sha256:`
+        """
+        normalize = normalize or (lambda text: text)
+        h = hashlib.sha256()
+
+        def update(text):
+            data = text.encode()
+            h.update(len(data).to_bytes(8, 'big'))
+            h.update(data)
+
+        update(normalize(self.dockerfile))
+        for extra in extras or []:
+            update(extra)
+        for rel, path in self.iter_files():
+            if os.path.islink(path):
+                update(f'L {normalize(rel)} {os.readlink(path)}')
+                continue
+            executable = os.access(path, os.X_OK)
+            update(f'{"X" if executable else "F"} {normalize(rel)} {os.path.getsize(path)}')
+            with open(path, 'rb') as f:
+                for chunk in iter(lambda: f.read(1 << 20), b''):
+                    h.update(chunk)
+        return 'sha256:' + h.hexdigest()
+
+    def write_tar(self, fileobj, mtime=None):
+        """
+        Write the context as an uncompressed tar stream.
+
+        :param fileobj: a writable binary file object, e.g. the stdin of a
+          `docker build -` process
+        :param mtime: optional time (in seconds since the epoch). If given, we
+          normalize the metadata of every entry, for reproducible builds: its
+          time is set to this, its owner to root, and its permissions to 755
+          or 644, according to whether it is a dir or executable, or not.
+        :return: pair (number of files, number of bytes) in the context, not
+          counting the Dockerfile
+        """
+        counts = [0, 0]
+
+        def exclude_bytecode(tarinfo):
+            if is_bytecode(tarinfo.name):
+                return None
+            if tarinfo.isreg():
+                counts[0] += 1
+                counts[1] += tarinfo.size
+            if mtime is not None:
+                normalize_tarinfo(tarinfo, mtime)
+            return tarinfo
+
+        with tarfile.open(fileobj=fileobj, mode='w|') as tar:
+            data = self.dockerfile.encode()
+            info = tarfile.TarInfo(CONTEXT_DOCKERFILE_NAME)
+            info.size = len(data)
+            info.mode = 0o644
+            tar.addfile(info, io.BytesIO(data))
+            for src in self.sources:
+                tar.add(os.path.join(self.root, src), arcname=src,
+                        filter=exclude_bytecode)
+        return tuple(counts)
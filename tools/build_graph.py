@@ -0,0 +1,159 @@
+# --------------------------------------------------------------------------- #
+#   Proofscape Manage                                                         #
+#                                                                             #
+#   Copyright (c) 2021-2022 Proofscape contributors                           #
+#                                                                             #
+#   Licensed under the Apache License, Version 2.0 (the "License");           #
+#   you may not use this file except in compliance with the License.          #
+#   You may obtain a copy of the License at                                   #
+#                                                                             #
+#       http://www.apache.org/licenses/LICENSE-2.0                            #
+#                                                                             #
+#   Unless required by applicable law or agreed to in writing, software       #
+#   distributed under the License is distributed on an "AS IS" BASIS,         #
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.  #
+#   See the License for the specific language governing permissions and       #
+#   limitations under the License.                                            #
+# --------------------------------------------------------------------------- #
+
+"""
+Run several `pfsc` build commands concurrently, respecting dependencies.
+
+Each build is run as a `pfsc` subprocess, with its output going to its own log
+file, so that concurrent builds do not interleave their output, and do not
+share any state.
+"""
+
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+import os
+import subprocess
+import sys
+import time
+
+import click
+
+from manage import PFSC_MANAGE_ROOT
+
+
+def pfsc_command_args(args):
+    """
+    Make the argument list for running a `pfsc` command in a subprocess,
+    using the same Python interpreter as the current process.
+
+    :param args: list of args for the `pfsc` command, e.g. ['build', 'redis', 'latest']
+    """
+    return [sys.executable, '-c', "import manage; manage.cli(prog_name='pfsc')"] + args
+
+
+class BuildNode:
+    """
+    One build in a build graph.
+    """
+
+    def __init__(self, name, args, deps=None):
+        """
+        :param name: a name for the build, e.g. 'server'
+        :param args: list of args for the `pfsc` command that does the build
+        :param deps: list of names of builds that must succeed before this one
+          can start
+        """
+        self.name = name
+        self.args = args
+        self.deps = deps or []
+        self.status = 'pending'
+        self.seconds = None
+        self.log_path = None
+
+    def run(self, log_dir):
+        self.log_path = os.path.join(log_dir, f'{self.name}.log')
+        t0 = time.perf_counter()
+        with open(self.log_path, 'w') as log:
+            log.write(f'$ pfsc {" ".join(self.args)}\n')
+            log.flush()
+            proc = subprocess.run(
+                pfsc_command_args(self.args), cwd=PFSC_MANAGE_ROOT,
+                stdin=subprocess.DEVNULL, stdout=log, stderr=subprocess.STDOUT,
+            )
+        self.seconds = time.perf_counter() - t0
+        self.status = 'ok' if proc.returncode == 0 else 'failed'
+        return self
+
+
+def check_build_graph(nodes):
+    """
+    Check that all deps are known, and that there are no cycles.
+
+    :param nodes: dict mapping names to `BuildNode`s
+    :raises: click.UsageError
+    """
+    for node in nodes.values():
+        for dep in node.deps:
+            if dep not in nodes:
+                raise click.UsageError(f'Build {node.name} depends on unknown build {dep}.')
+    visiting, done = set(), set()
+
+    def visit(name):
+        if name in done:
+            return
+        if name in visiting:
+            raise click.UsageError(f'Cycle in build graph, at {name}.')
+        visiting.add(name)
+        for dep in nodes[name].deps:
+            visit(dep)
+        visiting.remove(name)
+        done.add(name)
+
+    for name in nodes:
+        visit(name)
+
+
+def run_build_graph(nodes, jobs, log_dir):
+    """
+    Run the builds in a graph, running at most `jobs` at once, and starting each
+    as soon as all its deps have succeeded. Builds whose deps fail are skipped.
+
+    :param nodes: dict mapping names to `BuildNode`s
+    :param jobs: max number of concurrent builds
+    :param log_dir: directory where a log file for each build should be written
+    :return: the total wall time, in seconds
+    """
+    check_build_graph(nodes)
+    os.makedirs(log_dir, exist_ok=True)
+    t0 = time.perf_counter()
+    running = {}
+    with ThreadPoolExecutor(max_workers=jobs) as pool:
+        while True:
+            for node in nodes.values():
+                if node.status != 'pending':
+                    continue
+                if len(running) >= jobs:
+                    break
+                dep_statuses = {nodes[d].status for d in node.deps}
+                if dep_statuses & {'failed', 'skipped'}:
+                    node.status = 'skipped'
+                    click.echo(f'Skipping {node.name}, since a dependency did not succeed.')
+                elif dep_statuses <= {'ok'}:
+                    node.status = 'running'
+                    click.echo(f'Starting {node.name}: pfsc {" ".join(node.args)}')
+                    running[pool.submit(node.run, log_dir)] = node
+            if not running:
+                break
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                node = running.pop(future)
+                future.result()
+                click.echo(f'Finished {node.name} ({node.status}) in {node.seconds:.1f}s. Log: {node.log_path}')
+    return time.perf_counter() - t0
+
+
+def write_build_summary(nodes, wall_seconds):
+    lines = [f'{"build":16s} {"status":8s} {"seconds":>9s}', '-' * 35]
+    serial_seconds = 0
+    for node in nodes.values():
+        secs = f'{node.seconds:9.1f}' if node.seconds is not None else f'{"-":>9s}'
+        lines.append(f'{node.name:16s} {node.status:8s} {secs}')
+        serial_seconds += node.seconds or 0
+    lines.append('-' * 35)
+    lines.append(f'Wall time:          {wall_seconds:9.1f}s')
+    lines.append(f'Summed build time:  {serial_seconds:9.1f}s')
+    return '\n'.join(lines)
@@ -0,0 +1,161 @@
+# --------------------------------------------------------------------------- #
+#   Proofscape Manage                                                         #
+#                                                                             #
+#   Copyright (c) 2021-2022 Proofscape contributors                           #
+#                                                                             #
+#   Licensed under the Apache License, Version 2.0 (the "License");           #
+#   you may not use this file except in compliance with the License.          #
+#   You may obtain a copy of the License at                                   #
+#                                                                             #
+#       http://www.apache.org/licenses/LICENSE-2.0                            #
+#                                                                             #
+#   Unless required by applicable law or agreed to in writing, software       #
+#   distributed under the License is distributed on an "AS IS" BASIS,         #
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.  #
+#   See the License for the specific language governing permissions and       #
+#   limitations under the License.                                            #
+# --------------------------------------------------------------------------- #
+
+"""
+Per-step timing of `docker build`, parsed from its progress output.
+
+We understand both the classic builder's output ("Step 3/12 : RUN ...",
+" ---> Using cache") and BuildKit's plain progress output ("#5 [2/7] RUN ...",
+"#5 CACHED", "#5 DONE 12.3s"). BuildKit reports the duration of each step
+itself; for the classic builder we time each step from its "Step" line to the
+next one.
+"""
+
+import re
+import time
+
+CLASSIC_STEP = re.compile(r'^Step (\d+)/(\d+) : (.*)$')
+CLASSIC_USING_CACHE = '---> Using cache'
+CLASSIC_SUCCESS = re.compile(r'^Successfully (built|tagged) ')
+BUILDKIT_VERTEX = re.compile(r'^#(\d+) (.*)$')
+BUILDKIT_DONE = re.compile(r'^DONE (\d+(?:\.\d+)?)s$')
+# Name of a BuildKit vertex for a Dockerfile instruction, e.g. "[2/7] RUN ..."
+# or, in a multi-stage build, "[oca 2/7] RUN ...":
+BUILDKIT_INSTRUCTION = re.compile(r'^\[(?:\S+ )?\d+/\d+\] (.*)$')
+
+
+class BuildStep:
+    """
+    One step of a build: an instruction, or some other work the builder
+    reports, like exporting the image.
+    """
+
+    def __init__(self, name, instruction=None, started=None):
+        self.name = name
+        # The Dockerfile instruction, if this step is one:
+        self.instruction = instruction
+        self.started = started
+        self.seconds = None
+        self.cached = False
+        self.error = False
+
+    @property
+    def cacheable(self):
+        return bool(self.instruction) and not self.instruction.upper().startswith('FROM ')
+
+    def as_dict(self):
+        return {
+            'name': self.name,
+            'seconds': None if self.seconds is None else round(self.seconds, 3),
+            'cached': self.cached,
+            'error': self.error,
+        }
+
+
+class StepTimer:
+    """
+    Feed this the lines of output of a `docker build`, and it records the
+    steps of the build.
+    """
+
+    def __init__(self):
+        # List of `BuildStep` instances, in the order in which they started:
+        self.steps = []
+        # BuildKit vertices, by number:
+        self.vertices = {}
+        # The step the classic builder is currently running:
+        self.current = None
+
+    def feed(self, line, t=None):
+        """
+        :param line: one line of output
+        :param t: the time (by `time.monotonic()`) at which we got the line
+        """
+        t = time.monotonic() if t is None else t
+        line = line.strip()
+        m = CLASSIC_STEP.match(line)
+        if m:
+            self.end_current(t)
+            self.current = BuildStep(line, instruction=m.group(3), started=t)
+            self.steps.append(self.current)
+            return
+        if self.current:
+            if line == CLASSIC_USING_CACHE:
+                self.current.cached = True
+            elif CLASSIC_SUCCESS.match(line):
+                self.end_current(t)
+            return
+        m = BUILDKIT_VERTEX.match(line)
+        if m:
+            self.feed_vertex(int(m.group(1)), m.group(2), t)
+
+    def feed_vertex(self, number, text, t):
+        step = self.vertices.get(number)
+        if step is None:
+            m = BUILDKIT_INSTRUCTION.match(text)
+            step = BuildStep(text, instruction=m.group(1) if m else None, started=t)
+            self.vertices[number] = step
+            self.steps.append(step)
+            return
+        m = BUILDKIT_DONE.match(text)
+        if m:
+            step.seconds = float(m.group(1))
+        elif text == 'CACHED':
+            step.cached = True
+            step.seconds = step.seconds or 0.0
+        elif text.startswith('ERROR') or text == 'CANCELED':
+            step.error = True
+
+    def end_current(self, t):
+        if self.current:
+            self.current.seconds = t - self.current.started
+            self.current = None
+
+    def finish(self, t=None):
+        """
+        Call when the build has finished.
+        """
+        t = time.monotonic() if t is None else t
+        self.end_current(t)
+        for step in self.steps:
+            if step.seconds is None and step.started is not None:
+                step.seconds = t - step.started
+
+    def slowest(self, n):
+        timed = [s for s in self.steps if s.seconds is not None]
+        return sorted(timed, key=lambda s: -s.seconds)[:n]
+
+    def cache_counts(self):
+        """
+        :return: pair (hits, total), counting only the instructions that
+          could have been cached
+        """
+        cacheable = [s for s in self.steps if s.cacheable]
+        return sum(s.cached for s in cacheable), len(cacheable)
+
+    def first_cache_miss(self):
+        """
+        Find the first instruction that was not cached. Since a cache miss
+        invalidates the cache for all later instructions in the same stage,
+        this is usually the one to look at, when a build was slower than
+        expected.
+        """
+        for step in self.steps:
+            if step.cacheable and not step.cached:
+                return step
+        return None
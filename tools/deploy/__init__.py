@@ -18,22 +18,26 @@
 
 import os
 import re
+import json
 import secrets
+import subprocess
+import time
 import copy
 import pathlib
 
 import click
-import jinja2
 
 import conf
 from manage import cli, PFSC_ROOT
 import tools.deploy.services as services
 from tools.deploy.services import GdbCode
-from tools import simple_yaml
-from tools.util import (
-    simple_timestamp, trymakedirs, check_app_url_prefix,
-    resolve_fs_path,
+from tools.deploy.budget import (
+    detect_host_resources, compute_budget, apply_budget, write_budget_table,
 )
+from tools import simple_yaml
+from tools.util import simple_timestamp, trymakedirs
+from tools.resolved import resolved_conf
+from topics import inline_template
 from topics.nginx import write_nginx_conf, write_maintenance_nginx_conf
 import conf as pfsc_conf
 
@@ -52,13 +56,18 @@ def deploy():
               prompt='Graph database',
               help='The graph DB you are using. re=RedisGraph, nj=Neo4j, tk=TinkerGraph, ja=JanusGraph, np=Neptune')
 @click.option('-n', '--workers', type=int, default=1, prompt='How many RQ workers', help='Number of worker containers you want to run')
+@click.option('-m', '--math-workers', type=int, default=0, prompt='How many math workers',
+              help='Number of math worker containers you want to run. These serve only the math job queue.')
+@click.option('-r', '--web-replicas', type=int, default=1, prompt='How many web server replicas',
+              help='Number of web server containers you want to run, behind the Nginx front end.'
+                   ' More than one requires NGINX_IMAGE_TAG 1.27.3 or later.')
 @click.option('--demos/--no-demos', is_flag=True, prompt='Serving demo repos', help="Are you serving demo repos?")
 @click.option('--dump-dc', is_flag=True,
               help='Print the generated docker-compose YAML to stdout.')
 @click.option('--dirname',
               help='Directory name under which to save. Use "production_" + random word/name + timestamp if unspecified.')
 @click.argument('pfsc-tag')
-def production(gdb, workers, demos, dump_dc, dirname, pfsc_tag):
+def production(gdb, workers, math_workers, web_replicas, demos, dump_dc, dirname, pfsc_tag):
     """
     Generate a deployment directory for a production MCA deployment, using
     pfsc-server image of tag PFSC_TAG.
@@ -89,7 +98,7 @@ def production(gdb, workers, demos, dump_dc, dirname, pfsc_tag):
     static_redir = None
     static_acao = False
     dummy = False
-    generate.callback(gdb, pfsc_tag, oca_tag, workers, demos, mount_code, mount_pkg, dump_dc,
+    generate.callback(gdb, pfsc_tag, oca_tag, workers, math_workers, web_replicas, demos, mount_code, mount_pkg, dump_dc,
              dirname, no_local, flask_config, static_redir, static_acao, dummy,
              production_mode=True)
 
@@ -103,6 +112,11 @@ def production(gdb, workers, demos, dump_dc, dirname, pfsc_tag):
 @click.option('--oca-tag', default='latest', prompt='proofscape (OCA) image tag',
               help='Use `proofscape:TEXT` docker image. Default `latest`.')
 @click.option('-n', '--workers', type=int, default=1, prompt='How many RQ workers', help='Number of worker containers you want to run')
+@click.option('-m', '--math-workers', type=int, default=0, prompt='How many math workers',
+              help='Number of math worker containers you want to run. These serve only the math job queue.')
+@click.option('-r', '--web-replicas', type=int, default=1, prompt='How many web server replicas',
+              help='Number of web server containers you want to run, behind the Nginx front end.'
+                   ' More than one requires NGINX_IMAGE_TAG 1.27.3 or later.')
 @click.option('--demos', is_flag=True, default=True, prompt='Serve demo repos', help="Serve demo repos.")
 @click.option('--mount-code', is_flag=True, default=True, prompt='Volume-mount pfsc-server code for development',
               help='Volume-mount pfsc-server code for live updates during development.')
@@ -120,7 +134,7 @@ def production(gdb, workers, demos, dump_dc, dirname, pfsc_tag):
 @click.option('--static-redir', default=None, help='Redirect all static requests to domain TEXT.')
 @click.option('--static-acao', is_flag=True, default=False, help='Serve all static assets with `Access-Control-Allow-Origin *` header.')
 @click.option('--dummy', is_flag=True, default=False, help='Write a docker compose yml for a dummy deployment (Hello World web app).')
-def generate(gdb, pfsc_tag, oca_tag, workers, demos, mount_code, mount_pkg, dump_dc,
+def generate(gdb, pfsc_tag, oca_tag, workers, math_workers, web_replicas, demos, mount_code, mount_pkg, dump_dc,
              dirname, no_local, flask_config, static_redir, static_acao, dummy,
              production_mode=False):
     """
@@ -149,6 +163,14 @@ def generate(gdb, pfsc_tag, oca_tag, workers, demos, mount_code, mount_pkg, dump
 
     if not gdb:
         raise click.UsageError('Must select at least one graph database.')
+    if web_replicas < 1:
+        raise click.UsageError('Must run at least one web server replica.')
+    if web_replicas > 1 and not nginx_supports_upstream_resolve():
+        raise click.UsageError(
+            'Multiple web server replicas need an upstream whose servers nginx'
+            f' re-resolves, which needs nginx {".".join(map(str, NGINX_UPSTREAM_RESOLVE_VERSION))}'
+            ' or later. Please set NGINX_IMAGE_TAG in conf.py accordingly.'
+        )
     gdb = re.split(r'[,\s]+', gdb)
     s = set(gdb)
     if not s.issubset(set(GdbCode.all)):
@@ -173,11 +195,15 @@ def generate(gdb, pfsc_tag, oca_tag, workers, demos, mount_code, mount_pkg, dump
     click.echo(f'Wrote admin.sh')
 
     # mca-docker-compose.yml
+    host_resources = get_budget_host_resources() if getattr(pfsc_conf, 'RESOURCE_BUDGET', False) else None
     y = write_docker_compose_yaml(new_dir_name, new_dir_path,
-                                  gdb, pfsc_tag, workers, demos,
-                                  mount_code, mount_pkg, flask_config)
+                                  gdb, pfsc_tag, workers, math_workers, web_replicas, demos,
+                                  mount_code, mount_pkg, flask_config,
+                                  host_resources=host_resources)
     y_full = y['full']
     y_layers = y['layers']
+    if y['budget']:
+        click.echo(write_budget_table(y['budget'], *host_resources))
 
     if dump_dc:
         click.echo(y_full)
@@ -251,7 +277,7 @@ def generate(gdb, pfsc_tag, oca_tag, workers, demos, mount_code, mount_pkg, dump
         click.echo('Wrote maintenance-docker-compose.yml')
 
     # nginx.conf
-    root_url, app_url_prefix = check_app_url_prefix()
+    root_url, app_url_prefix = resolved_conf().url_prefixes
     nginx_conf = write_nginx_conf(
         listen_on=443 if pfsc_conf.SSL else 80,
         server_name=pfsc_conf.SERVER_NAME,
@@ -263,7 +289,12 @@ def generate(gdb, pfsc_tag, oca_tag, workers, demos, mount_code, mount_pkg, dump
         hsts_seconds=pfsc_conf.HSTS_SECONDS,
         app_url_prefix=app_url_prefix, root_url=root_url,
         use_docker_ns=True,
-        pfsc_web_hostname='pfscweb'
+        pfsc_web_hostname='pfscweb',
+        pfsc_web_servers=(
+            [f'{name}:7372' for name in services.web_service_names(web_replicas)]
+            if web_replicas > 1 else None
+        ),
+        static_caching=(flask_config == 'production'),
     )
     nc_path = os.path.join(new_dir_path, 'nginx.conf')
     with open(nc_path, 'w') as f:
@@ -328,6 +359,119 @@ def local(dirname):
     You do not have to spell out DIRNAME completely, but may supply any prefix
     that uniquely determines it among all existing dirs under PFSC_ROOT/deploy.
     """
+    full_deploy_path = find_deployment_dir(dirname)
+    try:
+        activate_local_dot_env(full_deploy_path)
+    except FileExistsError:
+        msg = 'ERROR: Could not activate local.env since'
+        msg += ' pfsc-server/instance/.env already exists and is not a symlink.'
+        click.echo(msg)
+    else:
+        click.echo(f'Activated {full_deploy_path}')
+
+
+@deploy.command()
+@click.option('--wait', is_flag=True, default=False,
+              help='Wait until every service is ready, and report the time-to-ready of each.')
+@click.option('--timeout', type=int, default=600,
+              help='With --wait, give up after this many seconds.')
+@click.argument('dirname')
+def up(wait, timeout, dirname):
+    """
+    Bring up the MCA defined in DIRNAME/mca-docker-compose.yml, in detached mode.
+
+    You do not have to spell out DIRNAME completely, but may supply any prefix
+    that uniquely determines it among all existing dirs under PFSC_ROOT/deploy.
+
+    Services start as soon as the services they depend on are healthy. With
+    --wait, we watch the containers until every service is ready (healthy if
+    it has a healthcheck, else running), and report how long each took.
+    """
+    full_deploy_path = find_deployment_dir(dirname)
+    compose_cmd = getattr(pfsc_conf, 'DOCKER_COMPOSE_CMD', 'docker-compose').split()
+    compose_cmd += ['-f', os.path.join(full_deploy_path, 'mca-docker-compose.yml')]
+
+    t0 = time.perf_counter()
+    proc = subprocess.Popen(compose_cmd + ['up', '-d'])
+    if not wait:
+        proc.wait()
+        return
+
+    ready_times = {}
+    failed = {}
+    while True:
+        up_done = proc.poll() is not None
+        ids = subprocess.run(
+            compose_cmd + ['ps', '-q'], capture_output=True, text=True
+        ).stdout.split()
+        infos = json.loads(subprocess.run(
+            [*pfsc_conf.DOCKER_CMD.split(), 'inspect', *ids],
+            capture_output=True, text=True
+        ).stdout or '[]') if ids else []
+        elapsed = time.perf_counter() - t0
+        for info in infos:
+            service = info['Config']['Labels'].get('com.docker.compose.service', info['Name'])
+            state = container_readiness(info)
+            if state == 'ready' and service not in ready_times:
+                ready_times[service] = elapsed
+                click.echo(f'{elapsed:8.1f}s  {service} ready')
+            elif state == 'failed' and service not in failed:
+                failed[service] = elapsed
+                click.echo(f'{elapsed:8.1f}s  {service} FAILED')
+        # `up` returns only after all containers have been started, so once
+        # it is done, the list of containers is complete.
+        if up_done and infos and len(ready_times) + len(failed) >= len(infos):
+            break
+        if up_done and proc.returncode != 0:
+            raise click.ClickException(f'{" ".join(compose_cmd)} up failed.')
+        if elapsed > timeout:
+            waiting = sorted(
+                set(i['Config']['Labels'].get('com.docker.compose.service', i['Name']) for i in infos)
+                - set(ready_times) - set(failed)
+            )
+            raise click.ClickException(f'Timed out waiting for: {", ".join(waiting)}')
+        time.sleep(UP_POLL_INTERVAL)
+
+    click.echo('')
+    click.echo(f'{"seconds":>9s}  service')
+    click.echo('-' * 40)
+    for service, seconds in sorted(ready_times.items(), key=lambda p: p[1]):
+        click.echo(f'{seconds:9.1f}  {service}')
+    click.echo('-' * 40)
+    if failed:
+        raise click.ClickException(f'Failed to become ready: {", ".join(sorted(failed))}')
+    click.echo(f'{max(ready_times.values()):9.1f}  all ready')
+
+
+UP_POLL_INTERVAL = 0.5
+
+
+def container_readiness(info):
+    """
+    Say whether a container is ready, given its metadata, as given by
+    `docker inspect`.
+
+    :return: 'ready' if the container is healthy, or is running and has no
+      healthcheck; 'failed' if it is unhealthy, or has stopped; else 'starting'.
+    """
+    state = info['State']
+    health = state.get('Health')
+    if state['Status'] in ('exited', 'dead'):
+        return 'failed'
+    if health:
+        return {'healthy': 'ready', 'unhealthy': 'failed'}.get(health['Status'], 'starting')
+    return 'ready' if state['Status'] == 'running' else 'starting'
+
+
+def find_deployment_dir(dirname):
+    """
+    Find an existing deployment dir.
+
+    :param dirname: any prefix that uniquely determines the name of an
+      existing dir under PFSC_ROOT/deploy
+    :return: the full path of the deployment dir
+    :raises: click.UsageError if there is not exactly one match
+    """
     deploy_dir_path = os.path.join(PFSC_ROOT, 'deploy')
     existing_names = os.listdir(deploy_dir_path)
     full_dirname = None
@@ -343,15 +487,7 @@ def local(dirname):
     elif count > 1:
         raise click.UsageError(f'Found multiple existing deployment dirs with "{dirname}" as prefix.')
     assert full_dirname in existing_names
-    full_deploy_path = os.path.join(deploy_dir_path, full_dirname)
-    try:
-        activate_local_dot_env(full_deploy_path)
-    except FileExistsError:
-        msg = 'ERROR: Could not activate local.env since'
-        msg += ' pfsc-server/instance/.env already exists and is not a symlink.'
-        click.echo(msg)
-    else:
-        click.echo(f'Activated {full_deploy_path}')
+    return os.path.join(deploy_dir_path, full_dirname)
 
 ##############################################################################
 
@@ -439,7 +575,7 @@ def write_local_dot_env(app_url_prefix, gdb, demos, secret=None):
     write_wheels_dot_env(d, for_local=True)
 
     if conf.EMAIL_TEMPLATE_DIR:
-        d["EMAIL_TEMPLATE_DIR"] = resolve_fs_path("EMAIL_TEMPLATE_DIR")
+        d["EMAIL_TEMPLATE_DIR"] = resolved_conf().fs_path("EMAIL_TEMPLATE_DIR")
 
     update_with_class_vars(d, pfsc_conf.CommonVars)
     update_with_class_vars(d, pfsc_conf.LocalVars)
@@ -533,6 +669,15 @@ def list_wheel_filenames():
     Return a list, in topological order, with an exact filename for each of the
     projects, from the PFSC_ROOT/src/whl directory. For each project, we select
     the filename with the latest version number.
+
+    The selection is memoized; see `tools.resolved`.
+    """
+    return list(resolved_conf().wheel_filenames)
+
+
+def select_wheel_filenames():
+    """
+    Do the work of `list_wheel_filenames()`, without memoization.
     """
     def raise_missing_wheels():
         raise click.UsageError("Asked for local wheels, but they're not all present. Did you use `pfsc get wheels` yet?")
@@ -591,7 +736,7 @@ def write_gdb_dot_env(d, gdb, uri_lookup_method, comment=False):
         d['post-gdb-block'] = {'comment': ''}
 
 
-DC_SCRIPT_TPLT = jinja2.Template("""\
+DC_SCRIPT_TPLT = inline_template('deploy/dc_script', """\
 #!/bin/sh
 
 # Use this script instead of docker-compose to take the various layers
@@ -635,7 +780,7 @@ def write_dc_script(deploy_dir_name):
     return DC_SCRIPT_TPLT.render(deploy_dir_name=deploy_dir_name)
 
 
-ADMIN_SH_SCRIPT_TPLT = jinja2.Template(r"""#!/usr/bin/env sh
+ADMIN_SH_SCRIPT_TPLT = inline_template('deploy/admin_sh_script', r"""#!/usr/bin/env sh
 
 # Run this script in order to enter a Docker container where you can use
 #
@@ -683,7 +828,7 @@ def write_admin_sh_script(
     ) + '\n'
 
 
-RUN_OCA_SH_SCRIPT_TPLT = jinja2.Template(r"""#!/usr/bin/env sh
+RUN_OCA_SH_SCRIPT_TPLT = inline_template('deploy/run_oca_sh_script', r"""#!/usr/bin/env sh
 
 # Run this script in order to test the OCA without any bind
 # mounts, i.e. to verify that it actually runs properly on its own.
@@ -705,8 +850,50 @@ def write_run_oca_sh_script(oca_tag):
     )
 
 
+# First nginx version supporting the `resolve` parameter of upstream servers:
+NGINX_UPSTREAM_RESOLVE_VERSION = (1, 27, 3)
+
+
+def nginx_supports_upstream_resolve():
+    """
+    Say whether the nginx image set by `NGINX_IMAGE_TAG` can re-resolve the
+    servers of an upstream. Tags we cannot parse as versions, like 'latest'
+    or 'mainline', are assumed to be recent.
+    """
+    M = re.match(r'(\d+)\.(\d+)\.(\d+)', pfsc_conf.NGINX_IMAGE_TAG)
+    if not M:
+        return True
+    return tuple(int(g) for g in M.groups()) >= NGINX_UPSTREAM_RESOLVE_VERSION
+
+
+def get_budget_host_resources():
+    """
+    Get the number of cores and the memory (in MiB) of the host for which we
+    are budgeting resources, from conf if set, else by detecting those of this
+    machine.
+    """
+    cpus, mem_mb = detect_host_resources()
+    cpus = getattr(pfsc_conf, 'RESOURCE_BUDGET_CPUS', None) or cpus
+    mem_mb = getattr(pfsc_conf, 'RESOURCE_BUDGET_MEM_MB', None) or mem_mb
+    if not cpus or not mem_mb:
+        raise click.UsageError(
+            'Could not detect host cores and memory.'
+            ' Please set RESOURCE_BUDGET_CPUS and RESOURCE_BUDGET_MEM_MB in conf.py.'
+        )
+    return cpus, mem_mb
+
+
 def write_docker_compose_yaml(deploy_dir_name, deploy_dir_path, gdb, pfsc_tag,
-                              workers, demos, mount_code, mount_pkg, flask_config):
+                              workers, math_workers, web_replicas, demos, mount_code, mount_pkg, flask_config,
+                              host_resources=None):
+    """
+    :param host_resources: optional pair (cpus, mem_mb) giving the cores and
+      memory of the host. If given, these are budgeted among the services,
+      and the limits are written into the compose files.
+    :return: dict with the full yaml under 'full', the layer yamls under
+      'layers', and the budget (see `budget.compute_budget()`) under
+      'budget', or None if no budget was made.
+    """
     svc_redis = services.redis()
     s_full = {
         'redis': svc_redis,
@@ -739,28 +926,47 @@ def write_docker_compose_yaml(deploy_dir_name, deploy_dir_path, gdb, pfsc_tag,
     s_app = {}
     def write_pfsc_service(cmd):
         return services.pfsc_server(deploy_dir_path, cmd, flask_config,
-            tag=pfsc_tag, gdb=gdb, workers=workers, demos=demos,
-            mount_code=mount_code, mount_pkg=mount_pkg)
-
-    for n in range(workers):
-        svc_pfscwork = write_pfsc_service('worker')
-        s_full[f'pfscwork{n}'] = svc_pfscwork
-        s_app[f'pfscwork{n}'] = copy.deepcopy(svc_pfscwork)
-        del s_app[f'pfscwork{n}']['depends_on']
-
-    svc_pfscweb = write_pfsc_service('websrv')
-    s_full['pfscweb'] = svc_pfscweb
-    s_app['pfscweb'] = copy.deepcopy(svc_pfscweb)
-    s_app['pfscweb']['depends_on'] = [
-        d for d in s_app['pfscweb']['depends_on'] if d.startswith('pfscwork')
+            tag=pfsc_tag, gdb=gdb, workers=workers, math_workers=math_workers,
+            demos=demos, mount_code=mount_code, mount_pkg=mount_pkg)
+
+    # General workers and math workers are separate services, serving separate
+    # job queues, so that each pool can be scaled on its own, and long builds
+    # cannot starve interactive math jobs.
+    worker_pools = [
+        ('pfscwork', 'worker', workers),
+        ('pfscmath', 'math', math_workers),
     ]
+    for prefix, mode, count in worker_pools:
+        for n in range(count):
+            name = f'{prefix}{n}'
+            svc_worker = write_pfsc_service(mode)
+            s_full[name] = svc_worker
+            s_app[name] = copy.deepcopy(svc_worker)
+            del s_app[name]['depends_on']
+
+    web_names = services.web_service_names(web_replicas)
+    for name in web_names:
+        svc_pfscweb = write_pfsc_service('websrv')
+        s_full[name] = svc_pfscweb
+        s_app[name] = copy.deepcopy(svc_pfscweb)
+        s_app[name]['depends_on'] = {
+            k: v for k, v in s_app[name]['depends_on'].items() if k.startswith(('pfscwork', 'pfscmath'))
+        }
+        if not s_app[name]['depends_on']:
+            del s_app[name]['depends_on']
 
     s_front = {}
-    svc_nginx = services.nginx(deploy_dir_path)
+    svc_nginx = services.nginx(deploy_dir_path, web_services=web_names)
     s_full['nginx'] = svc_nginx
     s_front['nginx'] = copy.deepcopy(svc_nginx)
     del s_front['nginx']['depends_on']
 
+    budget = None
+    if host_resources:
+        budget = compute_budget(list(s_full.keys()), *host_resources)
+        for s in [s_full, s_db, s_aux, s_app, s_front]:
+            apply_budget(s, budget)
+
     network_name = f'layers-{deploy_dir_name}'
     make_network = {
         'default': {
@@ -803,6 +1009,7 @@ def write_docker_compose_yaml(deploy_dir_name, deploy_dir_path, gdb, pfsc_tag,
     }
     if not s_aux:
         del y['layers']['150_aux']
+    y['budget'] = budget
     return y
 
 
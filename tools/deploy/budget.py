@@ -0,0 +1,186 @@
+# --------------------------------------------------------------------------- #
+#   Proofscape Manage                                                         #
+#                                                                             #
+#   Copyright (c) 2021-2022 Proofscape contributors                           #
+#                                                                             #
+#   Licensed under the Apache License, Version 2.0 (the "License");           #
+#   you may not use this file except in compliance with the License.          #
+#   You may obtain a copy of the License at                                   #
+#                                                                             #
+#       http://www.apache.org/licenses/LICENSE-2.0                            #
+#                                                                             #
+#   Unless required by applicable law or agreed to in writing, software       #
+#   distributed under the License is distributed on an "AS IS" BASIS,         #
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.  #
+#   See the License for the specific language governing permissions and       #
+#   limitations under the License.                                            #
+# --------------------------------------------------------------------------- #
+
+"""
+Resource budgeting for the services in a generated docker-compose file.
+
+The host's cores and memory (less a reserve for the host itself) are divided
+among the services according to role weights. The graph database and the
+workers are moreover pinned to disjoint sets of cores, so that a busy pool of
+workers cannot starve the database, or vice versa.
+"""
+
+import math
+import os
+
+from tools.deploy.services import GdbCode
+
+# Cores and memory (in MiB) to leave for the host itself:
+HOST_RESERVED_CPUS = 1
+HOST_RESERVED_MEM_MB = 1024
+
+# Pairs (cpu weight, memory weight), per role:
+ROLE_WEIGHTS = {
+    'redis': (1, 2),
+    'gdb': (4, 8),
+    'worker': (2, 3),
+    'web': (2, 3),
+    'front': (1, 1),
+    'aux': (0.5, 1),
+}
+
+# Roles that get pinned to cores of their own:
+PINNED_ROLES = ['gdb', 'worker']
+
+# Open file limits, for the roles that hold many connections:
+NOFILE_LIMITS = {
+    'redis': 65536,
+    'gdb': 65536,
+    'web': 65536,
+    'front': 65536,
+}
+
+MIN_MEM_MB = 128
+
+
+def service_role(name):
+    """
+    Determine the role of a service, given its name in the compose file.
+    """
+    if name == 'redis':
+        return 'redis'
+    if name in [GdbCode.service_name(code) for code in GdbCode.via_container]:
+        return 'gdb'
+    if name.startswith(('pfscwork', 'pfscmath')):
+        return 'worker'
+    if name.startswith('pfscweb'):
+        return 'web'
+    if name == 'nginx':
+        return 'front'
+    return 'aux'
+
+
+def detect_host_resources():
+    """
+    Detect the number of cores and the total memory (in MiB) of this machine.
+
+    :return: pair (cpus, mem_mb). Either may be None, if it could not be
+      determined.
+    """
+    cpus = os.cpu_count()
+    try:
+        mem_mb = os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES') // 2**20
+    except (ValueError, OSError, AttributeError):
+        mem_mb = None
+    return cpus, mem_mb
+
+
+def compute_budget(service_names, cpus, mem_mb,
+                   reserved_cpus=HOST_RESERVED_CPUS,
+                   reserved_mem_mb=HOST_RESERVED_MEM_MB):
+    """
+    Divide a host's resources among a list of services.
+
+    :param service_names: the names of the services, as in the compose file.
+    :param cpus: the number of cores on the host.
+    :param mem_mb: the total memory of the host, in MiB.
+    :return: dict mapping each service name to a dict with keys `role`,
+      `cpus` (float), `mem_mb` (int), and `cpuset` (string, or None if
+      not pinned).
+    """
+    usable_cpus = max(cpus - reserved_cpus, 1)
+    usable_mem_mb = max(mem_mb - reserved_mem_mb, MIN_MEM_MB * len(service_names))
+
+    roles = {name: service_role(name) for name in service_names}
+    total_cpu_weight = sum(ROLE_WEIGHTS[r][0] for r in roles.values())
+    total_mem_weight = sum(ROLE_WEIGHTS[r][1] for r in roles.values())
+
+    budget = {}
+    for name, role in roles.items():
+        cpu_weight, mem_weight = ROLE_WEIGHTS[role]
+        budget[name] = {
+            'role': role,
+            'cpus': round(max(usable_cpus * cpu_weight / total_cpu_weight, 0.1), 2),
+            'mem_mb': max(int(usable_mem_mb * mem_weight / total_mem_weight), MIN_MEM_MB),
+            'cpuset': None,
+        }
+
+    # Pin each pinned role to its own block of cores, counting down from the
+    # highest-numbered core, so that the low cores are left to the host. All
+    # services of one role share that role's block.
+    blocks = []
+    for role in PINNED_ROLES:
+        members = [name for name, r in roles.items() if r == role]
+        if members:
+            share = sum(budget[name]['cpus'] for name in members)
+            blocks.append((members, max(math.floor(share), 1)))
+    if sum(n for _, n in blocks) <= usable_cpus:
+        top = cpus
+        for members, n in blocks:
+            cpuset = str(top - 1) if n == 1 else f'{top - n}-{top - 1}'
+            for name in members:
+                budget[name]['cpuset'] = cpuset
+                budget[name]['cpus'] = min(budget[name]['cpus'], float(n))
+            top -= n
+
+    return budget
+
+
+def apply_budget(service_defns, budget):
+    """
+    Write resource limits into service definitions.
+
+    :param service_defns: dict mapping service names to service definitions,
+      as for the `services` section of a compose file. Services not named in
+      the budget are left alone.
+    :param budget: as returned by `compute_budget()`.
+    """
+    for name, defn in service_defns.items():
+        alloc = budget.get(name)
+        if alloc is None:
+            continue
+        defn['cpus'] = alloc['cpus']
+        defn['mem_limit'] = f'{alloc["mem_mb"]}m'
+        if alloc['cpuset'] is not None:
+            defn['cpuset'] = alloc['cpuset']
+        nofile = NOFILE_LIMITS.get(alloc['role'])
+        if nofile:
+            defn['ulimits'] = {
+                'nofile': {
+                    'soft': nofile,
+                    'hard': nofile,
+                },
+            }
+
+
+def write_budget_table(budget, cpus, mem_mb):
+    """
+    Write a table showing a resource budget.
+    """
+    header = f'{"service":16s} {"role":7s} {"cpus":>6s} {"mem (MiB)":>10s}  cpuset'
+    lines = [f'Host: {cpus} cores, {mem_mb} MiB', header, '-' * 60]
+    for name, alloc in budget.items():
+        lines.append(
+            f'{name:16s} {alloc["role"]:7s} {alloc["cpus"]:6.2f} '
+            f'{alloc["mem_mb"]:10d}  {alloc["cpuset"] or "-"}'
+        )
+    lines.append('-' * 60)
+    total_cpus = sum(a['cpus'] for a in budget.values())
+    total_mem = sum(a['mem_mb'] for a in budget.values())
+    lines.append(f'{"total":16s} {"":7s} {total_cpus:6.2f} {total_mem:10d}')
+    return '\n'.join(lines)
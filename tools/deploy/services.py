@@ -18,7 +18,7 @@
 
 from manage import PFSC_ROOT
 import conf
-from tools.util import resolve_fs_path
+from tools.resolved import resolved_conf
 
 
 class GdbCode:
@@ -123,9 +123,72 @@ class GdbCode:
         return False
 
 
+# Healthchecks are run often, so that dependents can start as soon as the
+# services they depend on are ready.
+HEALTHCHECK_INTERVAL = '2s'
+HEALTHCHECK_TIMEOUT = '5s'
+HEALTHCHECK_RETRIES = 30
+
+
+def healthcheck(test, start_period=None):
+    """
+    Write a healthcheck for a service.
+
+    :param test: the test command, as a list, e.g. `["CMD", "redis-cli", "ping"]`
+    :param start_period: optional duration string, e.g. '60s', during which
+      failures do not count toward the retries
+    """
+    d = {
+        'test': test,
+        'interval': HEALTHCHECK_INTERVAL,
+        'timeout': HEALTHCHECK_TIMEOUT,
+        'retries': HEALTHCHECK_RETRIES,
+    }
+    if start_period:
+        d['start_period'] = start_period
+    return d
+
+
+def http_healthcheck(port, start_period=None):
+    """
+    Healthcheck for a service running Python, and serving HTTP on a port.
+    Any HTTP response counts as healthy.
+    """
+    probe = (
+        "import http.client as h; "
+        f"c = h.HTTPConnection('localhost', {port}, timeout=4); "
+        "c.request('HEAD', '/'); c.getresponse()"
+    )
+    return healthcheck(["CMD", "python", "-c", probe], start_period=start_period)
+
+
+def tcp_healthcheck(port, start_period=None):
+    """
+    Healthcheck for a service accepting TCP connections on a port.
+    """
+    return healthcheck(
+        ["CMD", "bash", "-c", f"exec 3<>/dev/tcp/localhost/{port}"],
+        start_period=start_period
+    )
+
+
+def depends_on(healthy=(), started=()):
+    """
+    Write a `depends_on` section.
+
+    :param healthy: names of services that must be healthy before this one
+      is started. Each must have a healthcheck.
+    :param started: names of services that need only have been started.
+    """
+    d = {name: {'condition': 'service_healthy'} for name in healthy}
+    d.update({name: {'condition': 'service_started'} for name in started})
+    return d
+
+
 def redis(host=conf.REDIS_HOST, port=conf.REDIS_PORT, tag=conf.REDIS_IMAGE_TAG):
     d = {
         'image': f'redis:{tag}',
+        'healthcheck': healthcheck(["CMD", "redis-cli", "ping"]),
     }
     if port is not None:
         d['ports'] = [
@@ -143,6 +206,7 @@ def redisgraph(tag=conf.REDISGRAPH_IMAGE_TAG):
         'ports': [
             f'{conf.REDISGRAPH_MCA_HOST}:{conf.REDISGRAPH_MCA_PORT}:6379',
         ],
+        'healthcheck': healthcheck(["CMD", "redis-cli", "ping"]),
     }
 
 
@@ -166,7 +230,11 @@ def neo4j(hosts=(conf.NEO4J_BROWSE_HOST, conf.NEO4J_BOLT_HOST),
         ],
         'environment': {
             'NEO4J_AUTH': 'none',
-        }
+        },
+        'healthcheck': healthcheck(
+            ["CMD-SHELL", "cypher-shell -a bolt://localhost:7687 'RETURN 1' || exit 1"],
+            start_period='60s'
+        ),
     }
     if ports is not None:
         d['ports'] = [
@@ -182,6 +250,7 @@ def tinkergraph(tag=conf.GREMLIN_SERVER_IMAGE_TAG):
         'ports': [
             f'{conf.TINKERGRAPH_HOST}:{conf.TINKERGRAPH_PORT}:8182',
         ],
+        'healthcheck': tcp_healthcheck(8182, start_period='30s'),
     }
 
 
@@ -191,6 +260,7 @@ def janusgraph(tag=conf.JANUSGRAPH_IMAGE_TAG):
         'ports': [
             f'{conf.JANUSGRAPH_HOST}:{conf.JANUSGRAPH_PORT}:8182',
         ],
+        'healthcheck': tcp_healthcheck(8182, start_period='60s'),
     }
 
 
@@ -211,22 +281,20 @@ def get_proofscape_subdir_abs_fs_path_on_host(subdir_name):
     path for that directory on the host.
     """
     if subdir_name == 'lib' and conf.PFSC_LIB_ROOT:
-        return resolve_fs_path("PFSC_LIB_ROOT")
+        return resolved_conf().fs_path("PFSC_LIB_ROOT")
     elif subdir_name == 'build' and conf.PFSC_BUILD_ROOT:
-        return resolve_fs_path("PFSC_BUILD_ROOT")
+        return resolved_conf().fs_path("PFSC_BUILD_ROOT")
     elif subdir_name == 'graphdb' and conf.PFSC_GRAPHDB_ROOT:
-        return resolve_fs_path("PFSC_GRAPHDB_ROOT")
+        return resolved_conf().fs_path("PFSC_GRAPHDB_ROOT")
     else:
         return f'{PFSC_ROOT}/{subdir_name}'
 
 
 def pfsc_server(deploy_dir_path, mode, flask_config, tag='latest',
-                gdb=None, workers=1, demos=False, mount_code=False, mount_pkg=None):
+                gdb=None, workers=1, math_workers=0, demos=False, mount_code=False, mount_pkg=None):
     d = {
         'image': f"pfsc-server:{tag}",
-        'depends_on': [
-            'redis',
-        ],
+        'depends_on': depends_on(healthy=['redis']),
         'volumes': [
             f'{get_proofscape_subdir_abs_fs_path_on_host(direc)}:/proofscape/{direc}'
             for direc in [ 'lib', 'build', 'PDFLibrary' ]
@@ -244,12 +312,16 @@ def pfsc_server(deploy_dir_path, mode, flask_config, tag='latest',
     }
     gdb = gdb or [GdbCode.RE]
     if mode == 'websrv':
-        d['depends_on'].extend(GdbCode.service_name(code) for code in gdb if code in GdbCode.via_container)
-        d['depends_on'].extend([f'pfscwork{n}' for n in range(workers)])
+        # Workers have no healthcheck, so we can only ask that they be started.
+        d['depends_on'].update(depends_on(
+            healthy=[GdbCode.service_name(code) for code in gdb if code in GdbCode.via_container],
+            started=[f'pfscwork{n}' for n in range(workers)] + [f'pfscmath{n}' for n in range(math_workers)]
+        ))
+        d['healthcheck'] = http_healthcheck(7372, start_period='60s')
     if demos:
         d['volumes'].append(f'{PFSC_ROOT}/src/pfsc-demo-repos:/home/pfsc/demos:ro')
     if conf.EMAIL_TEMPLATE_DIR:
-        d['volumes'].append(f'{resolve_fs_path("EMAIL_TEMPLATE_DIR")}:/home/pfsc/proofscape/src/_email_templates:ro')
+        d['volumes'].append(f'{resolved_conf().fs_path("EMAIL_TEMPLATE_DIR")}:/home/pfsc/proofscape/src/_email_templates:ro')
     if mount_code:
         d['volumes'].append(f'{PFSC_ROOT}/src/pfsc-server/pfsc:/home/pfsc/proofscape/src/pfsc-server/pfsc:ro')
         d['volumes'].append(f'{PFSC_ROOT}/src/pfsc-server/config.py:/home/pfsc/proofscape/src/pfsc-server/config.py:ro')
@@ -260,6 +332,16 @@ def pfsc_server(deploy_dir_path, mode, flask_config, tag='latest',
     return d
 
 
+def web_service_names(replicas=1):
+    """
+    List the names of the web server services. A single replica is simply
+    called `pfscweb`.
+    """
+    if replicas == 1:
+        return ['pfscweb']
+    return [f'pfscweb{n}' for n in range(replicas)]
+
+
 def proofscape_oca(deploy_dir_path, tag='latest', mount_code=False, mount_pkg=None):
     d = {
         'image': f"pise:{tag}",
@@ -271,6 +353,7 @@ def proofscape_oca(deploy_dir_path, tag='latest', mount_code=False, mount_pkg=No
             f'{get_proofscape_subdir_abs_fs_path_on_host(direc)}:/proofscape/{direc}'
             for direc in ['lib', 'build', 'graphdb', 'deploy', 'PDFLibrary']
         ],
+        'healthcheck': http_healthcheck(7372, start_period='60s'),
     }
 
     if mount_code:
@@ -291,23 +374,28 @@ def proofscape_oca(deploy_dir_path, tag='latest', mount_code=False, mount_pkg=No
 
 
 def nginx(deploy_dir_path, tag=conf.NGINX_IMAGE_TAG,
-          host=conf.PFSC_ISE_MCA_HOST, port=conf.PFSC_ISE_MCA_PORT, dummy=False):
+          host=conf.PFSC_ISE_MCA_HOST, port=conf.PFSC_ISE_MCA_PORT, dummy=False,
+          web_services=('pfscweb',)):
+    # The dummy server has no healthcheck.
     d = {
         'image': f"nginx:{tag}",
-        'depends_on': [
-            'pfscweb',
-        ],
+        'depends_on': depends_on(started=web_services) if dummy else depends_on(healthy=web_services),
         'ports': [
             f"{host}:{port}:{443 if conf.SSL else 80}"
         ],
         'volumes': [
             f'{deploy_dir_path}/nginx.conf:/etc/nginx/conf.d/default.conf:ro',
         ],
+        # Any HTTP response (even e.g. 401 under basic auth) counts as healthy.
+        'healthcheck': healthcheck([
+            "CMD", "curl", "-sk", "-o", "/dev/null",
+            "https://localhost:443/" if conf.SSL else "http://localhost:80/"
+        ]),
     }
     if not dummy:
         if conf.TWIN_ROOT_DIR:
             d['volumes'].append(
-                f'{resolve_fs_path("TWIN_ROOT_DIR")}:/usr/share/nginx/twin-site:ro'
+                f'{resolved_conf().fs_path("TWIN_ROOT_DIR")}:/usr/share/nginx/twin-site:ro'
             )
         d['volumes'].extend([
             f'{PFSC_ROOT}/PDFLibrary:/usr/share/nginx/PDFLibrary:ro',
@@ -325,8 +413,8 @@ def nginx(deploy_dir_path, tag=conf.NGINX_IMAGE_TAG,
     if conf.REDIRECT_HTTP_FROM:
         d['ports'].append(f"{host}:{conf.REDIRECT_HTTP_FROM}:80")
     if conf.SSL:
-        d['volumes'].append(f'{resolve_fs_path("SSL_CERT")}:/etc/nginx/ssl/cert')
-        d['volumes'].append(f'{resolve_fs_path("SSL_KEY")}:/etc/nginx/ssl/key')
+        d['volumes'].append(f'{resolved_conf().fs_path("SSL_CERT")}:/etc/nginx/ssl/cert')
+        d['volumes'].append(f'{resolved_conf().fs_path("SSL_KEY")}:/etc/nginx/ssl/key')
     if conf.AUTH_BASIC_PASSWORD:
         d['volumes'].append(f'{deploy_dir_path}/htpasswd:/etc/nginx/.htpasswd')
     return d
@@ -341,14 +429,14 @@ def maintenance_nginx(deploy_dir_path, tag=conf.NGINX_IMAGE_TAG,
         ],
         'volumes': [
             f'{deploy_dir_path}/maintenance_nginx.conf:/etc/nginx/conf.d/default.conf:ro',
-            f'{resolve_fs_path("MAINTENANCE_SITE_DIR")}:/usr/share/nginx/html/maintenance:ro',
+            f'{resolved_conf().fs_path("MAINTENANCE_SITE_DIR")}:/usr/share/nginx/html/maintenance:ro',
         ],
     }
     if conf.REDIRECT_HTTP_FROM:
         d['ports'].append(f"{host}:{conf.REDIRECT_HTTP_FROM}:80")
     if conf.SSL:
-        d['volumes'].append(f'{resolve_fs_path("SSL_CERT")}:/etc/nginx/ssl/cert')
-        d['volumes'].append(f'{resolve_fs_path("SSL_KEY")}:/etc/nginx/ssl/key')
+        d['volumes'].append(f'{resolved_conf().fs_path("SSL_CERT")}:/etc/nginx/ssl/cert')
+        d['volumes'].append(f'{resolved_conf().fs_path("SSL_KEY")}:/etc/nginx/ssl/key')
     if conf.AUTH_BASIC_PASSWORD:
         d['volumes'].append(f'{deploy_dir_path}/htpasswd:/etc/nginx/.htpasswd')
     return d
@@ -0,0 +1,340 @@
+# --------------------------------------------------------------------------- #
+#   Proofscape Manage                                                         #
+#                                                                             #
+#   Copyright (c) 2021-2022 Proofscape contributors                           #
+#                                                                             #
+#   Licensed under the Apache License, Version 2.0 (the "License");           #
+#   you may not use this file except in compliance with the License.          #
+#   You may obtain a copy of the License at                                   #
+#                                                                             #
+#       http://www.apache.org/licenses/LICENSE-2.0                            #
+#                                                                             #
+#   Unless required by applicable law or agreed to in writing, software       #
+#   distributed under the License is distributed on an "AS IS" BASIS,         #
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.  #
+#   See the License for the specific language governing permissions and       #
+#   limitations under the License.                                            #
+# --------------------------------------------------------------------------- #
+
+"""
+A thin client for the Docker Engine HTTP API, over its unix socket.
+
+Unlike calls to the `docker` CLI, this gives us structured results (image
+metadata, build progress events, exit codes), lets us stream build contexts
+that we generate on the fly, and lets us run several commands in one container
+via `exec`, instead of starting a container per command.
+
+Set `DOCKER_SOCKET` in `conf.py` to use the API wherever we support it. See
+`get_docker_client()`.
+
+API reference: <https://docs.docker.com/engine/api/>
+"""
+
+from contextlib import contextmanager
+import http.client
+import json
+import socket
+import struct
+from urllib.parse import quote, urlencode
+
+import conf
+
+DEFAULT_SOCKET = '/var/run/docker.sock'
+# Docker Engine 20.10 and later support this version:
+API_VERSION = '1.41'
+
+# Stream types in multiplexed container output:
+STDOUT, STDERR = 1, 2
+
+
+class DockerAPIError(Exception):
+
+    def __init__(self, status, message):
+        super().__init__(f'Docker API error {status}: {message}')
+        self.status = status
+        self.message = message
+
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+
+    def __init__(self, socket_path, timeout=None):
+        super().__init__('localhost', timeout=timeout)
+        self.socket_path = socket_path
+
+    def connect(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        if self.timeout is not None:
+            sock.settimeout(self.timeout)
+        sock.connect(self.socket_path)
+        self.sock = sock
+
+
+class ChunkedWriter:
+    """
+    A writable file object that sends what is written to it as the chunks
+    of a request body, e.g. so that `tarfile` can write a build context
+    straight to the daemon.
+    """
+
+    def __init__(self, conn):
+        self.conn = conn
+
+    def write(self, data):
+        if data:
+            self.conn.send(b'%x\r\n' % len(data) + bytes(data) + b'\r\n')
+        return len(data)
+
+    def close(self):
+        self.conn.send(b'0\r\n\r\n')
+
+
+def iter_json_lines(response):
+    """
+    Iterate over the JSON objects in a streamed response, one per line.
+    """
+    for line in response:
+        line = line.strip()
+        if line:
+            yield json.loads(line)
+
+
+def demultiplex(response):
+    """
+    Iterate over the frames of a multiplexed stream of container output.
+
+    :return: generator of pairs (stream type, bytes)
+    """
+    while True:
+        header = response.read(8)
+        if len(header) < 8:
+            return
+        stream_type, size = struct.unpack('>BxxxL', header)
+        yield stream_type, response.read(size)
+
+
+class DockerClient:
+
+    def __init__(self, socket_path=DEFAULT_SOCKET, api_version=API_VERSION, timeout=None):
+        self.socket_path = socket_path
+        self.api_version = api_version
+        self.timeout = timeout
+
+    def path(self, path, params=None):
+        query = {k: v for k, v in (params or {}).items() if v is not None}
+        path = f'/v{self.api_version}{path}'
+        return f'{path}?{urlencode(query)}' if query else path
+
+    def open(self, method, path, params=None, body=None, headers=None, write_body=None):
+        """
+        Make a request, and return the response, for the caller to read.
+
+        :param body: optional JSON-serializable request body
+        :param write_body: optional function that accepts a writable file
+          object, and writes the request body to it. The body is sent with
+          chunked transfer encoding.
+        :return: pair (connection, response). The caller should close the
+          connection when done with the response.
+        :raises: DockerAPIError if the status is not 2xx
+        """
+        conn = UnixHTTPConnection(self.socket_path, timeout=self.timeout)
+        headers = dict(headers or {})
+        url = self.path(path, params)
+        if write_body is not None:
+            conn.putrequest(method, url)
+            headers['Transfer-Encoding'] = 'chunked'
+            for k, v in headers.items():
+                conn.putheader(k, v)
+            conn.endheaders()
+            writer = ChunkedWriter(conn)
+            write_body(writer)
+            writer.close()
+        else:
+            data = None
+            if body is not None:
+                data = json.dumps(body).encode()
+                headers['Content-Type'] = 'application/json'
+            conn.request(method, url, body=data, headers=headers)
+        response = conn.getresponse()
+        if not 200 <= response.status < 300:
+            text = response.read().decode(errors='replace')
+            conn.close()
+            try:
+                text = json.loads(text).get('message', text)
+            except ValueError:
+                pass
+            raise DockerAPIError(response.status, text)
+        return conn, response
+
+    def request(self, method, path, params=None, body=None):
+        """
+        Make a request, and return the decoded JSON response, or `None` if the
+        response is empty.
+        """
+        conn, response = self.open(method, path, params=params, body=body)
+        try:
+            data = response.read()
+        finally:
+            conn.close()
+        return json.loads(data) if data.strip() else None
+
+    def ping(self):
+        conn, response = self.open('GET', '/_ping')
+        try:
+            return response.read() == b'OK'
+        finally:
+            conn.close()
+
+    # Images
+
+    def inspect_image(self, name):
+        return self.request('GET', f'/images/{quote(name, safe="")}/json')
+
+    def image_id(self, name):
+        """
+        :return: the ID of a local image, or `None` if there is no such image
+        """
+        try:
+            return self.inspect_image(name)['Id']
+        except DockerAPIError as e:
+            if e.status == 404:
+                return None
+            raise
+
+    def list_images(self, filters=None):
+        """
+        :param filters: optional dict mapping filter names to lists of values,
+          e.g. `{'reference': ['pise'], 'label': ['a=b']}`
+        """
+        params = {'filters': json.dumps(filters)} if filters else None
+        return self.request('GET', '/images/json', params=params)
+
+    def tag_image(self, image, repo, tag):
+        self.request('POST', f'/images/{quote(image, safe="")}/tag', params={'repo': repo, 'tag': tag})
+
+    def build(self, write_context, tag, dockerfile='Dockerfile', labels=None,
+              buildargs=None, nocache=False):
+        """
+        Build an image with the classic builder. (BuildKit builds need a
+        session with the client, which we do not support.)
+
+        :param write_context: function that accepts a writable binary file
+          object, and writes the build context to it, as a tar archive
+        :return: generator of progress events, as dicts. The classic builder's
+          output is under 'stream'. The ID of the new image comes under
+          'aux', and failures under 'error'.
+        """
+        params = {
+            't': tag,
+            'dockerfile': dockerfile,
+            'labels': json.dumps(labels) if labels else None,
+            'buildargs': json.dumps(buildargs) if buildargs else None,
+            'nocache': 'true' if nocache else None,
+        }
+        conn, response = self.open(
+            'POST', '/build', params=params,
+            headers={'Content-Type': 'application/x-tar'}, write_body=write_context)
+        try:
+            yield from iter_json_lines(response)
+        finally:
+            conn.close()
+
+    # Containers
+
+    def create_container(self, image, cmd=None, entrypoint=None, binds=None):
+        """
+        :param binds: optional list of bind mounts, like `['/host/dir:/dir:rw']`
+        :return: the ID of the new container
+        """
+        body = {'Image': image}
+        if cmd is not None:
+            body['Cmd'] = cmd
+        if entrypoint is not None:
+            body['Entrypoint'] = entrypoint
+        if binds:
+            body['HostConfig'] = {'Binds': binds}
+        return self.request('POST', '/containers/create', body=body)['Id']
+
+    def start_container(self, container_id):
+        self.request('POST', f'/containers/{container_id}/start')
+
+    def wait_container(self, container_id):
+        """
+        :return: the exit code of the container
+        """
+        return self.request('POST', f'/containers/{container_id}/wait')['StatusCode']
+
+    def remove_container(self, container_id, force=True):
+        self.request('DELETE', f'/containers/{container_id}', params={'force': 'true' if force else None})
+
+    def container_logs(self, container_id, follow=True):
+        """
+        :return: generator of pairs (stream type, bytes)
+        """
+        params = {'stdout': 1, 'stderr': 1, 'follow': 1 if follow else 0}
+        conn, response = self.open('GET', f'/containers/{container_id}/logs', params=params)
+        try:
+            yield from demultiplex(response)
+        finally:
+            conn.close()
+
+    def run(self, image, cmd=None, binds=None, output=None):
+        """
+        Run a command in a new container, which is removed afterward.
+
+        :param output: optional writable binary file object, to which the
+          output of the container is written as it arrives
+        :return: the exit code
+        """
+        container_id = self.create_container(image, cmd=cmd, binds=binds)
+        try:
+            self.start_container(container_id)
+            for _, data in self.container_logs(container_id):
+                if output is not None:
+                    output.write(data)
+                    output.flush()
+            return self.wait_container(container_id)
+        finally:
+            self.remove_container(container_id)
+
+    @contextmanager
+    def running_container(self, image):
+        """
+        Keep a container of an image running, in which commands can be run by
+        `exec_run()`. The container is removed afterward.
+
+        :return: the ID of the container
+        """
+        container_id = self.create_container(image, entrypoint=['sleep', 'infinity'])
+        try:
+            self.start_container(container_id)
+            yield container_id
+        finally:
+            self.remove_container(container_id)
+
+    def exec_run(self, container_id, cmd):
+        """
+        Run a command in a running container.
+
+        :return: triple (exit code, stdout bytes, stderr bytes)
+        """
+        exec_id = self.request('POST', f'/containers/{container_id}/exec', body={
+            'Cmd': cmd, 'AttachStdout': True, 'AttachStderr': True,
+        })['Id']
+        conn, response = self.open('POST', f'/exec/{exec_id}/start', body={'Detach': False, 'Tty': False})
+        out = {STDOUT: [], STDERR: []}
+        try:
+            for stream_type, data in demultiplex(response):
+                out.get(stream_type, out[STDOUT]).append(data)
+        finally:
+            conn.close()
+        exit_code = self.request('GET', f'/exec/{exec_id}/json')['ExitCode']
+        return exit_code, b''.join(out[STDOUT]), b''.join(out[STDERR])
+
+
+def get_docker_client():
+    """
+    :return: a `DockerClient` for the `DOCKER_SOCKET` set in `conf.py`, or
+      `None` if it is not set, in which case we use the `docker` CLI
+    """
+    socket_path = getattr(conf, 'DOCKER_SOCKET', None)
+    return DockerClient(socket_path) if socket_path else None
@@ -0,0 +1,140 @@
+# --------------------------------------------------------------------------- #
+#   Proofscape Manage                                                         #
+#                                                                             #
+#   Copyright (c) 2021-2022 Proofscape contributors                           #
+#                                                                             #
+#   Licensed under the Apache License, Version 2.0 (the "License");           #
+#   you may not use this file except in compliance with the License.          #
+#   You may obtain a copy of the License at                                   #
+#                                                                             #
+#       http://www.apache.org/licenses/LICENSE-2.0                            #
+#                                                                             #
+#   Unless required by applicable law or agreed to in writing, software       #
+#   distributed under the License is distributed on an "AS IS" BASIS,         #
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.  #
+#   See the License for the specific language governing permissions and       #
+#   limitations under the License.                                            #
+# --------------------------------------------------------------------------- #
+
+"""
+Transfer of docker images to hosts that do not pull from a registry.
+
+A bundle is a `docker save` archive, compressed with zstd, from which we
+omit the layers the target host already has. The target describes the layers
+it has with a "have" file, listing the chain IDs of the layers of all its
+images. (A layer's chain ID identifies it together with all the layers below
+it, which is what `docker load` looks up, before deciding whether it needs the
+layer's contents.) A bundle can then be piped straight into `docker load`.
+
+Layers are matched by content: by their diff IDs, i.e. the sha256 digests of
+their uncompressed tar archives. In the OCI layout written by newer versions
+of docker, layer archives are named by their digests. In the older layout,
+they are not, so we make a first pass over the `docker save` stream to hash
+them.
+"""
+
+import hashlib
+import posixpath
+import tarfile
+
+OCI_BLOB_PREFIX = 'blobs/sha256/'
+LEGACY_LAYER_NAME = 'layer.tar'
+
+
+def compute_chain_ids(diff_ids):
+    """
+    Compute the chain IDs of the layers of an image.
+
+    :param diff_ids: the diff IDs of the layers, bottom first, as listed under
+      `RootFS.Layers` by `docker image inspect`
+    :return: list of chain IDs, parallel to `diff_ids`
+    """
+    chain_ids = []
+    for diff_id in diff_ids:
+        if chain_ids:
+            text = f'{chain_ids[-1]} {diff_id}'
+            diff_id = 'sha256:' + hashlib.sha256(text.encode()).hexdigest()
+        chain_ids.append(diff_id)
+    return chain_ids
+
+
+def find_omittable_layers(images_diff_ids, have):
+    """
+    Determine which layers can be omitted from a bundle.
+
+    :param images_diff_ids: list of lists of diff IDs, one for each image to
+      be bundled
+    :param have: set of chain IDs that the target host has
+    :return: set of diff IDs that can be omitted. Since the same diff ID can
+      occur in several images (or positions), a diff ID is omittable only if
+      every one of its occurrences has a chain ID the target has.
+    """
+    omit, keep = set(), set()
+    for diff_ids in images_diff_ids:
+        for diff_id, chain_id in zip(diff_ids, compute_chain_ids(diff_ids)):
+            (omit if chain_id in have else keep).add(diff_id)
+    return omit - keep
+
+
+def is_layer_member(name):
+    return name.startswith(OCI_BLOB_PREFIX) or posixpath.basename(name) == LEGACY_LAYER_NAME
+
+
+def hash_layer_members(fileobj):
+    """
+    Make a first pass over a `docker save` stream, to find the digest of each
+    layer archive in it.
+
+    :return: dict mapping member names to digests (`sha256:...`), or `None`
+      if the archive uses the OCI layout, and so needs no hashing
+    """
+    digests = {}
+    with tarfile.open(fileobj=fileobj, mode='r|') as tar:
+        for member in tar:
+            if member.name.startswith(OCI_BLOB_PREFIX):
+                return None
+            if member.isreg() and is_layer_member(member.name):
+                h = hashlib.sha256()
+                f = tar.extractfile(member)
+                for chunk in iter(lambda: f.read(1 << 20), b''):
+                    h.update(chunk)
+                digests[member.name] = 'sha256:' + h.hexdigest()
+    return digests
+
+
+def member_digest(member, digests):
+    """
+    :param digests: as returned by `hash_layer_members()`
+    :return: the digest of a layer member, or `None` if unknown
+    """
+    name = member.name
+    if member.issym():
+        name = posixpath.normpath(posixpath.join(posixpath.dirname(name), member.linkname))
+    if name.startswith(OCI_BLOB_PREFIX):
+        return 'sha256:' + name[len(OCI_BLOB_PREFIX):]
+    return (digests or {}).get(name)
+
+
+def filter_saved_images(src, dst, omit, digests=None):
+    """
+    Copy a `docker save` stream, omitting some layer archives.
+
+    :param src: readable binary file object giving the `docker save` stream
+    :param dst: writable binary file object
+    :param omit: set of diff IDs of layers to be omitted
+    :param digests: as returned by `hash_layer_members()`
+    :return: pair (bytes written, bytes omitted), counting file contents
+    """
+    written, omitted = 0, 0
+    with tarfile.open(fileobj=src, mode='r|') as tar_in, \
+            tarfile.open(fileobj=dst, mode='w|') as tar_out:
+        for member in tar_in:
+            if is_layer_member(member.name) and member_digest(member, digests) in omit:
+                omitted += member.size
+                continue
+            if member.isreg():
+                tar_out.addfile(member, tar_in.extractfile(member))
+                written += member.size
+            else:
+                tar_out.addfile(member)
+    return written, omitted
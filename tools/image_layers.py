@@ -0,0 +1,205 @@
+# --------------------------------------------------------------------------- #
+#   Proofscape Manage                                                         #
+#                                                                             #
+#   Copyright (c) 2021-2022 Proofscape contributors                           #
+#                                                                             #
+#   Licensed under the Apache License, Version 2.0 (the "License");           #
+#   you may not use this file except in compliance with the License.          #
+#   You may obtain a copy of the License at                                   #
+#                                                                             #
+#       http://www.apache.org/licenses/LICENSE-2.0                            #
+#                                                                             #
+#   Unless required by applicable law or agreed to in writing, software       #
+#   distributed under the License is distributed on an "AS IS" BASIS,         #
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.  #
+#   See the License for the specific language governing permissions and       #
+#   limitations under the License.                                            #
+# --------------------------------------------------------------------------- #
+
+"""
+Analysis of the layers of a docker image, as written by `docker save`.
+
+For each layer we find its size, the directories to which it adds the most
+bytes, and how many bytes it "rewrites", i.e. how much of its content consists
+of files already present in earlier layers. A layer that merely changes
+ownership or permissions of existing files (e.g. a `RUN chown -R`) rewrites
+every file it touches, and so duplicates it in the image. Such layers can
+usually be avoided, e.g. by using `COPY --chown`.
+
+Optionally, we also hash file contents, to find files duplicated across layers
+under any paths.
+"""
+
+from collections import defaultdict
+import hashlib
+import json
+import posixpath
+import tarfile
+
+WHITEOUT_PREFIX = '.wh.'
+OPAQUE_WHITEOUT = '.wh..wh..opq'
+
+
+class Layer:
+    """
+    Summary of one layer of an image.
+    """
+
+    def __init__(self, index, created_by='', history_index=None):
+        self.index = index
+        # The instruction that created the layer, from the image history:
+        self.created_by = created_by
+        # The index of that instruction in the (full) image history:
+        self.history_index = history_index
+        # Number of files, and bytes, in the layer:
+        self.n_files = 0
+        self.size = 0
+        # Bytes in files that were already present in earlier layers:
+        self.rewritten = 0
+        # List of pairs (path, bytes), of the rewritten files:
+        self.rewritten_files = []
+        # Map from directory path to bytes added under it (see `dir_depth`
+        # arg to `analyze_layer_tars()`):
+        self.dir_sizes = defaultdict(int)
+
+    def largest_dirs(self, n):
+        """
+        :return: list of up to `n` pairs (dir path, bytes), largest first
+        """
+        return sorted(self.dir_sizes.items(), key=lambda d: -d[1])[:n]
+
+
+def normalize_member_path(name):
+    path = posixpath.normpath(name)
+    return '' if path == '.' else path.lstrip('/')
+
+
+def remove_subtree(present, path):
+    prefix = path + '/' if path else ''
+    for p in [p for p in present if p == path or p.startswith(prefix)]:
+        del present[p]
+
+
+def file_dir(path, depth):
+    """
+    The directory containing a file, truncated to at most `depth` components.
+    """
+    parts = path.split('/')[:-1]
+    return '/' + '/'.join(parts[:depth])
+
+
+def hash_member(tar, member):
+    h = hashlib.sha1()
+    f = tar.extractfile(member)
+    for chunk in iter(lambda: f.read(1 << 20), b''):
+        h.update(chunk)
+    return h.hexdigest()
+
+
+def analyze_layer_tars(layer_tars, history=None, dir_depth=3, contents=None):
+    """
+    Analyze the layers of an image.
+
+    :param layer_tars: iterable of readable binary file objects, each giving
+      a layer tar archive, in order from the bottom of the image to the top
+    :param history: optional list of pairs (created_by, history_index), for
+      the instructions that created the layers
+    :param dir_depth: we record the bytes added under directories at this
+      depth (or the containing dir, for files at lesser depth)
+    :param contents: optional dict, into which we record a list of triples
+      (layer index, path, size) under the hash of the contents of each
+      non-empty regular file
+    :return: list of `Layer` instances
+    """
+    history = history or []
+    # Map from path to size, for all regular files present so far:
+    present = {}
+    layers = []
+    for i, fileobj in enumerate(layer_tars):
+        layer = Layer(i, *(history[i] if i < len(history) else ('', None)))
+        added = {}
+        with tarfile.open(fileobj=fileobj, mode='r|*') as tar:
+            for member in tar:
+                path = normalize_member_path(member.name)
+                dirname, basename = posixpath.split(path)
+                if basename == OPAQUE_WHITEOUT:
+                    remove_subtree(present, dirname)
+                    continue
+                if basename.startswith(WHITEOUT_PREFIX):
+                    remove_subtree(present, posixpath.join(dirname, basename[len(WHITEOUT_PREFIX):]))
+                    continue
+                if not member.isreg():
+                    continue
+                layer.n_files += 1
+                layer.size += member.size
+                layer.dir_sizes[file_dir(path, dir_depth)] += member.size
+                if contents is not None and member.size > 0:
+                    contents.setdefault(hash_member(tar, member), []).append((i, path, member.size))
+                if path in present:
+                    layer.rewritten += member.size
+                    layer.rewritten_files.append((path, member.size))
+                added[path] = member.size
+        present.update(added)
+        layers.append(layer)
+    return layers
+
+
+def read_layer_history(config):
+    """
+    From an image config, get the instructions that created the image's
+    (non-empty) layers.
+
+    :return: list of pairs (created_by, index in the full history)
+    """
+    return [
+        (h.get('created_by', ''), i) for i, h in enumerate(config.get('history', []))
+        if not h.get('empty_layer')
+    ]
+
+
+def analyze_saved_image(path, dir_depth=3, contents=None):
+    """
+    Analyze the layers of an image saved (by `docker save`) at a given path.
+
+    See `analyze_layer_tars()` for the args.
+
+    :return: pair (layers, history), where layers is a list of `Layer`
+      instances, and history is the list of `created_by` strings for all
+      entries in the image's history, including those that made no layer
+    """
+    with tarfile.open(path) as archive:
+        manifest = json.load(archive.extractfile('manifest.json'))[0]
+        config = json.load(archive.extractfile(manifest['Config']))
+        layer_tars = (archive.extractfile(name) for name in manifest['Layers'])
+        layers = analyze_layer_tars(
+            layer_tars, read_layer_history(config), dir_depth=dir_depth, contents=contents)
+    history = [h.get('created_by', '') for h in config.get('history', [])]
+    return layers, history
+
+
+def find_duplicates(contents):
+    """
+    Find files duplicated across layers.
+
+    :param contents: dict as recorded by `analyze_layer_tars()`
+    :return: list of pairs (size, copies), where copies is a list of pairs
+      (layer index, path), for all file contents occurring in more than one
+      layer, in decreasing order of wasted bytes
+    """
+    dups = []
+    for occurrences in contents.values():
+        if len({layer for layer, _, _ in occurrences}) > 1:
+            size = occurrences[0][2]
+            dups.append((size, [(layer, path) for layer, path, _ in occurrences]))
+    dups.sort(key=lambda d: -d[0] * (len(d[1]) - 1))
+    return dups
+
+
+def find_excessive_rewrites(layers, limit, skip=0):
+    """
+    Find the layers that rewrite more than `limit` bytes.
+
+    :param skip: number of layers at the bottom of the image to be ignored,
+      e.g. because they belong to a base image that is not ours
+    """
+    return [layer for layer in layers[skip:] if layer.rewritten > limit]
@@ -25,18 +25,19 @@ import subprocess
 import urllib.parse
 
 import click
-import jinja2
 import requests
 
 from manage import cli, PFSC_ROOT, PFSC_MANAGE_ROOT
+from tools import timing
+from tools.docker_api import get_docker_client
+from tools.license_assembly import (
+    PYTHON_PACKAGES_SLOT, OTHER_LICENSES_SLOT, assemble, normalize_name, package_info,
+)
+from topics import topic_templates, inline_template
 PFSC_MANAGE_ROOT = Path(PFSC_MANAGE_ROOT)
 PFSC_ROOT = Path(PFSC_ROOT)
 
-this_dir = os.path.dirname(__file__)
-templates_dir = os.path.join(this_dir, 'templates')
-jinja_env = jinja2.Environment(loader=jinja2.FileSystemLoader(
-    PFSC_MANAGE_ROOT / 'topics' / 'pfsc' / 'templates'
-))
+templates = topic_templates('pfsc')
 
 GITHUB_REPO_URL = re.compile(r'[^:]+://github.com/[^/]+/[^/]+/?$')
 
@@ -173,7 +174,7 @@ def about(project, dry_run):
         print(f'Wrote {len(code)} bytes to {dst}.')
 
 
-HTML_TABLE_ROW_TEMPLATE = jinja2.Template("""
+HTML_TABLE_ROW_TEMPLATE = inline_template('license/html_table_row', """
 
 <!-- {{proj_name}} -->
 <tr><td><a target="_blank"
@@ -189,7 +190,7 @@ href="{{license_url}}">
 """)
 
 
-PFSC_ABOUT_ROWS_TEMPLATE = jinja2.Template("""\
+PFSC_ABOUT_ROWS_TEMPLATE = inline_template('license/about_rows', """\
 /* 
  * This file was generated by running
  *   $ pfsc license about {{ project }}
@@ -220,17 +221,39 @@ def oca(image, dump=False, verbose=False):
 
     This is mostly intended for internal usage. It can be useful to run it manually
     when altering the format or contents of the combined license file.
+    (Release builds of the OCA generate the file within the image build; see
+    `write_oca_license_bundle()`.)
     """
-    py_comp, py_incomp = gather_dep_info_for_python_project('pfsc-server', print_report=verbose, image=image)
-    js_comp, js_incomp = gather_dep_info_for_javascript_project('pfsc-ise', print_report=verbose)
-
-    if len(py_incomp) > 0:
+    bundle = write_oca_license_bundle(verbose=verbose)
+    installed = {normalize_name(name) for name in list_image_python_packages(image)}
+    try:
+        text = assemble(bundle, installed=installed)
+    except ValueError as e:
         raise click.FileError(
-            'Missing some info on Python packages.\n'
+            f'{e}\n'
             'Try running\n'
             '  $ pfsc license show server\n'
             'to learn more.'
         )
+    if dump:
+        print(text)
+    return text
+
+
+def write_oca_license_bundle(verbose=False):
+    """
+    Do all the work of writing the combined license file for the OCA, except
+    for selecting the Python packages, for which we need to know what is
+    installed in the image.
+
+    We take as candidates all Python packages in the pfsc-server venv.
+    Packages with incomplete info are not an error here, but only if they turn
+    out to be installed in the image. See `tools.license_assembly`.
+
+    :return: the bundle, a JSON-serializable dict
+    """
+    py_comp, py_incomp = gather_dep_info_for_python_project('pfsc-server', print_report=verbose)
+    js_comp, js_incomp = gather_dep_info_for_javascript_project('pfsc-ise', print_report=verbose)
 
     if len(js_incomp) > 0:
         raise click.FileError(
@@ -240,14 +263,6 @@ def oca(image, dump=False, verbose=False):
             'to learn more.'
         )
 
-    python_packages = '\n'.join(
-        f'{pkg.write_two_column_text_row()}\n  {pkg.get_src_url()}\n'
-        for pkg in py_comp if pkg.name not in [
-            # Don't repeat packages that already got special mention.
-            'sympy',
-        ]
-    )
-
     javascript_packages = '\n'.join(
         f'{pkg.write_two_column_text_row()}\n  {pkg.get_src_url()}\n'
         for pkg in js_comp if pkg.name not in [
@@ -257,7 +272,6 @@ def oca(image, dump=False, verbose=False):
         ]
     )
 
-    py_d = {pkg.name: pkg for pkg in py_comp}
     js_d = {pkg.name: pkg for pkg in js_comp}
 
     # Add other dependencies that aren't gathered by the above function calls.
@@ -267,7 +281,6 @@ def oca(image, dump=False, verbose=False):
         'lark-parser', 'typeguard',
         'pfsc-util',
     ]}
-    py_d = dict(py_other, **py_d)
 
     js_other = {
         'pdfjs': OTHER_PKG_INFO['pdfjs'],
@@ -275,52 +288,11 @@ def oca(image, dump=False, verbose=False):
     }
     js_d = dict(js_other, **js_d)
 
-    py_pkgs = list(py_d.values())
-    js_pkgs = list(js_d.values())
-
     pyodide_python_packages = '\n'.join(
         f'{pkg.write_two_column_text_row()}\n  {pkg.get_src_url()}\n'
         for pkg in py_other.values()
     )
 
-    # We try to group software having the same license text after stripping of
-    # exterior whitespace.
-    d = defaultdict(list)
-    all_pkgs = py_pkgs + js_pkgs
-    for p in all_pkgs:
-        t = p.get_license_text()
-        if t:
-            d[t.strip()].append(p)
-
-    # FIXME
-    #  I would have expected better grouping. We're getting 83 groups, for
-    #  103 software packages. Why, e.g. so many different versions of Apache?
-    #  Should try to do better. For now this is good enough.
-
-    # Examine grouping:
-    #print()
-    #print(f'{len(all_pkgs)} packages')
-    #print(f'{len(d.keys())} groups')
-    #print()
-    #v = sorted(list(d.values()), key=lambda a: len(a))
-    #for a in v:
-    #    print(f'{len(a)}: {" ".join([f"({p.license_name}/{p.name})" for p in a])}')
-
-    # Generate all the license blocks for all the packages:
-    other_license_list = []
-    for G in d.values():
-        header = ''
-        license = ''
-        for p in G:
-            header += f'  {p.name}\n    {p.get_src_url()}\n'
-            t = p.get_license_text()
-            if len(t) > len(license):
-                license = t
-        block = 'The license for:\n\n' + header + '\nis:\n\n' + license
-        other_license_list.append(block)
-    divider = '\n' + ("~"*79 + '\n')*2
-    other_licenses = divider.join(other_license_list)
-
     # These are the one-off cases:
     with open(PFSC_ROOT / 'src' / 'pfsc-server' / 'LICENSE') as f:
         pfsc_server_Apache = f.read()
@@ -350,25 +322,47 @@ def oca(image, dump=False, verbose=False):
     for name, license in top_credits:
         credits[name] = f'{name}{" " * (tab_stop - len(name))}{license}'
 
-    # Final rendering
-    template = jinja_env.get_template('combined_license_file.txt')
+    # Render everything except the parts that depend on the selection of
+    # Python packages. These are left as slots, to be filled at assembly time.
+    template = templates.get_template('combined_license_file.txt')
     text = template.render(
         credits=credits,
         pyodide_python_packages=pyodide_python_packages,
-        python_packages=python_packages,
+        python_packages=PYTHON_PACKAGES_SLOT,
         javascript_packages=javascript_packages,
         pfsc_server_Apache=pfsc_server_Apache,
         RSAL=RSAL,
         redis_BSD=redis_BSD,
         supervisor_license=supervisor_license,
         PSF_license = PSF_license,
-        other_licenses=other_licenses,
+        other_licenses=OTHER_LICENSES_SLOT,
         gcc_runtime=gcc_runtime,
         gpl3=gpl3
     )
-    if dump:
-        print(text)
-    return text
+
+    return {
+        'text': text,
+        'python_packages': [package_info(pkg) for pkg in py_comp],
+        'incomplete_python_packages': [pkg.name for pkg in py_incomp],
+        'pyodide_python_packages': [package_info(pkg) for pkg in py_other.values()],
+        'javascript_packages': [package_info(pkg) for pkg in js_d.values()],
+    }
+
+
+def write_oca_license_bundle_dir(dir_path, verbose=False):
+    """
+    Write a directory containing the OCA license bundle, as `bundle.json`,
+    along with the `license_assembly.py` script that completes it, ready to
+    be copied into the license stage of the OCA build.
+    """
+    os.makedirs(dir_path, exist_ok=True)
+    bundle = write_oca_license_bundle(verbose=verbose)
+    with open(os.path.join(dir_path, 'bundle.json'), 'w') as f:
+        json.dump(bundle, f)
+    with open(PFSC_MANAGE_ROOT / 'tools' / 'license_assembly.py') as f:
+        script = f.read()
+    with open(os.path.join(dir_path, 'license_assembly.py'), 'w') as f:
+        f.write(script)
 
 
 class PyNoDistInfo(Exception):
@@ -715,7 +709,8 @@ def gather_dep_info_for_javascript_project(proj_name, print_report=False, dedup=
     """
     dir_path = PFSC_ROOT / 'src' / proj_name
     cmd = f'cd {dir_path}; npm list -ap --prod'
-    out = subprocess.check_output(cmd, shell=True)
+    with timing.phase(cmd, 'subprocess'):
+        out = subprocess.check_output(cmd, shell=True)
     lines = out.decode().split('\n')
 
     seen = set()
@@ -760,6 +755,36 @@ def gather_dep_info_for_javascript_project(proj_name, print_report=False, dedup=
     return complete, incomplete
 
 
+PIP_FREEZE_LINE = re.compile(r'([-a-zA-Z0-9_]+)==(\d+(\.\d+)*)')
+
+
+def list_image_python_packages(image):
+    """
+    List the Python packages installed in a Docker image, by running
+    `pip freeze` in it.
+
+    @param image: (str) name:tag of Docker image
+    @return: set of package names
+    """
+    names = set()
+    client = get_docker_client()
+    if client:
+        with timing.phase(f'pip freeze in {image} via Docker Engine API', 'subprocess'):
+            with client.running_container(image) as container_id:
+                exit_code, out, err = client.exec_run(container_id, ['pip', 'freeze'])
+        if exit_code:
+            raise click.ClickException(f'pip freeze failed in {image}: {err.decode()}')
+    else:
+        cmd = f'docker run --rm --entrypoint=bash {image} -c "pip freeze"'
+        with timing.phase(cmd, 'subprocess'):
+            out = subprocess.check_output(cmd, shell=True)
+    lines = out.decode().split('\n')
+    for line in lines:
+        if (M := PIP_FREEZE_LINE.match(line)):
+            names.add(M.group(1))
+    return names
+
+
 def gather_dep_info_for_python_project(proj_name, print_report=False, image=None):
     """
     Find out what we know about all the dependencies of a given Python project.
@@ -773,21 +798,14 @@ def gather_dep_info_for_python_project(proj_name, print_report=False, image=None
         not occurring in this list will be rejected.
     @return: list of PyPackage instances
     """
-    pip_line = re.compile(r'([-a-zA-Z0-9_]+)==(\d+(\.\d+)*)')
-
     accepted_pkgs = None
     if image:
-        accepted_pkgs = set()
-        cmd = f'docker run --rm --entrypoint=bash {image} -c "pip freeze"'
-        out = subprocess.check_output(cmd, shell=True)
-        lines = out.decode().split('\n')
-        for line in lines:
-            if (M := pip_line.match(line)):
-                accepted_pkgs.add(M.group(1))
+        accepted_pkgs = list_image_python_packages(image)
 
     pip = PFSC_ROOT / 'src' / proj_name / 'venv' / 'bin' / 'pip'
     cmd = f'{pip} freeze'
-    out = subprocess.check_output(cmd, shell=True)
+    with timing.phase(cmd, 'subprocess'):
+        out = subprocess.check_output(cmd, shell=True)
     lines = out.decode().split('\n')
 
     abnormal_freeze_line = []
@@ -803,7 +821,7 @@ def gather_dep_info_for_python_project(proj_name, print_report=False, image=None
         if not line:
             continue
         total += 1
-        M = pip_line.match(line)
+        M = PIP_FREEZE_LINE.match(line)
         py_pkg = None
         if not M:
             info = get_manual_pkg_info(line, 'py')
@@ -902,7 +920,8 @@ def obtain_license_text(url):
         with open(cache_path, 'r') as f:
             text = f.read()
     else:
-        r = requests.get(url)
+        with timing.phase(url, 'download'):
+            r = requests.get(url)
         if r.status_code != 200:
             raise Exception(f'Could not obtain license from: {url}')
         text = r.text
@@ -0,0 +1,170 @@
+# --------------------------------------------------------------------------- #
+#   Proofscape Manage                                                         #
+#                                                                             #
+#   Copyright (c) 2021-2022 Proofscape contributors                           #
+#                                                                             #
+#   Licensed under the Apache License, Version 2.0 (the "License");           #
+#   you may not use this file except in compliance with the License.          #
+#   You may obtain a copy of the License at                                   #
+#                                                                             #
+#       http://www.apache.org/licenses/LICENSE-2.0                            #
+#                                                                             #
+#   Unless required by applicable law or agreed to in writing, software       #
+#   distributed under the License is distributed on an "AS IS" BASIS,         #
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.  #
+#   See the License for the specific language governing permissions and       #
+#   limitations under the License.                                            #
+# --------------------------------------------------------------------------- #
+
+"""
+Final assembly of the combined license file for the one-container app.
+
+Most of the work of writing the combined license file (gathering package info,
+obtaining license texts, rendering the template) is done by `tools.license`.
+The one thing it cannot know in advance is which of the Python packages in the
+pfsc-server venv are actually installed in the OCA image. So it writes a
+"bundle", i.e. a JSON file giving the partly rendered file, and info on all
+candidate packages, and we complete the file here, keeping only the packages
+that are installed.
+
+This module uses only the standard library, and must remain compatible with
+the Python version in the OCA image, since it is copied into the license stage
+of the OCA build, and run there as a script:
+
+    python license_assembly.py BUNDLE_JSON OUTPUT_FILE
+"""
+
+from collections import defaultdict
+import importlib.metadata
+import json
+import re
+import sys
+
+# Slots in the partly rendered file, to be filled in at assembly time:
+PYTHON_PACKAGES_SLOT = '@@PYTHON_PACKAGES@@'
+OTHER_LICENSES_SLOT = '@@OTHER_LICENSES@@'
+
+# Packages that get special mention, and so are not repeated in the list of
+# Python packages:
+PYTHON_PACKAGES_NOT_LISTED = ['sympy']
+
+
+def normalize_name(name):
+    """
+    Normalize a Python project name, as in PEP 503.
+    """
+    return re.sub(r'[-_.]+', '-', name).lower()
+
+
+def list_installed_packages():
+    """
+    :return: set of normalized names of all Python packages that are installed,
+      according to their dist-info metadata
+    """
+    return {
+        normalize_name(dist.metadata['Name'])
+        for dist in importlib.metadata.distributions()
+        if dist.metadata['Name']
+    }
+
+
+def package_info(pkg):
+    """
+    Reduce a package to the info we need for assembly.
+
+    :param pkg: a `tools.license.SoftwarePackage`
+    :return: dict
+    """
+    return {
+        'name': pkg.name,
+        'row': pkg.write_two_column_text_row(),
+        'src_url': pkg.get_src_url(),
+        'license_text': pkg.get_license_text() or '',
+    }
+
+
+def write_package_rows(pkgs):
+    return '\n'.join(f'{p["row"]}\n  {p["src_url"]}\n' for p in pkgs)
+
+
+def write_license_groups(pkgs):
+    """
+    Write license blocks for a list of packages, grouping together those
+    packages having the same license text (after stripping of exterior
+    whitespace).
+    """
+    d = defaultdict(list)
+    for p in pkgs:
+        t = p['license_text']
+        if t:
+            d[t.strip()].append(p)
+
+    # FIXME
+    #  I would have expected better grouping. We're getting 83 groups, for
+    #  103 software packages. Why, e.g. so many different versions of Apache?
+    #  Should try to do better. For now this is good enough.
+
+    other_license_list = []
+    for G in d.values():
+        header = ''
+        license = ''
+        for p in G:
+            header += f'  {p["name"]}\n    {p["src_url"]}\n'
+            t = p['license_text']
+            if len(t) > len(license):
+                license = t
+        block = 'The license for:\n\n' + header + '\nis:\n\n' + license
+        other_license_list.append(block)
+    divider = '\n' + ("~"*79 + '\n')*2
+    return divider.join(other_license_list)
+
+
+def assemble(bundle, installed=None):
+    """
+    Complete the combined license file.
+
+    :param bundle: dict, as written by `tools.license.write_oca_license_bundle()`
+    :param installed: set of normalized names of the Python packages that are
+      installed. If `None`, we accept all candidate packages.
+    :return: the text of the combined license file
+    """
+    python_packages = [
+        p for p in bundle['python_packages']
+        if installed is None or normalize_name(p['name']) in installed
+    ]
+    missing_info = [
+        name for name in bundle['incomplete_python_packages']
+        if installed is None or normalize_name(name) in installed
+    ]
+    if missing_info:
+        raise ValueError(
+            'Missing some info on Python packages: ' + ', '.join(missing_info)
+        )
+
+    # Packages installed in the image take precedence over the Pyodide
+    # packages of the same name, but the Pyodide packages come first.
+    py_d = {p['name']: p for p in bundle['pyodide_python_packages']}
+    py_d.update({p['name']: p for p in python_packages})
+    all_pkgs = list(py_d.values()) + bundle['javascript_packages']
+
+    text = bundle['text']
+    text = text.replace(PYTHON_PACKAGES_SLOT, write_package_rows([
+        p for p in python_packages if p['name'] not in PYTHON_PACKAGES_NOT_LISTED
+    ]))
+    text = text.replace(OTHER_LICENSES_SLOT, write_license_groups(all_pkgs))
+    return text
+
+
+def main(bundle_path, output_path):
+    with open(bundle_path) as f:
+        bundle = json.load(f)
+    try:
+        text = assemble(bundle, installed=list_installed_packages())
+    except ValueError as e:
+        sys.exit(str(e))
+    with open(output_path, 'w') as f:
+        f.write(text)
+
+
+if __name__ == '__main__':
+    main(*sys.argv[1:3])
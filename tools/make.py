@@ -20,11 +20,11 @@ import os
 import pathlib
 
 import click
-import jinja2
 
 from manage import cli, PFSC_ROOT
 from conf import DOCKER_CMD
 from tools.util import do_commands_in_directory
+from topics import inline_template
 
 
 @cli.group()
@@ -65,7 +65,7 @@ def whl(dry_run, project):
 
 elkjs_static_path = os.path.join(PFSC_ROOT, 'static', 'elkjs')
 
-MAKE_ELKJS_TPLT = jinja2.Template("""\
+MAKE_ELKJS_TPLT = inline_template('make/elkjs', """\
 {{docker_cmd}} run --rm \\
     -v {{static_dir}}:/usr/local/lib/elkjs:rw \\
     elkjs-build-env:{{existing_elkjs_build_env_image_tag}} \\
@@ -16,7 +16,6 @@
 #   limitations under the License.                                            #
 # --------------------------------------------------------------------------- #
 
-import json
 import os
 import re
 
@@ -25,10 +24,12 @@ import click
 import conf
 from manage import cli, PFSC_ROOT, PFSC_MANAGE_ROOT
 import tools.build
+from tools.build_graph import BuildNode, run_build_graph, write_build_summary
 from tools.util import (
     set_supporting_software_versions_for_server_in_conf,
-    get_server_version,
+    simple_timestamp,
 )
+from tools.resolved import resolved_conf
 
 SRC_ROOT = os.path.join(PFSC_ROOT, 'src')
 
@@ -41,6 +42,18 @@ def release():
     pass
 
 
+def get_oca_release_tag(seq_num):
+    """
+    The tag for a release of the OCA is generated from the current version
+    number of pfsc-ise, the current version number of pfsc-server, and an
+    optional sequence number.
+    """
+    ise_vers = resolved_conf().ise_package_version
+    server_vers = resolved_conf().server_version
+    seq_num_suffix = f'-{seq_num}' if seq_num > 0 else ''
+    return f'{ise_vers}-{server_vers}{seq_num_suffix}'
+
+
 @release.command()
 @click.option(
     '-n', '--seq-num', default=0, type=int,
@@ -71,15 +84,9 @@ def oca(seq_num, skip_check, dump, dry_run):
     # This ensures the pfsc-ise and pfsc-server repos exist:
     tools.build.oca_readiness_checks(release=True)
 
-    with open(os.path.join(SRC_ROOT, 'pfsc-ise', 'package.json')) as f:
-        d = json.load(f)
-    ise_vers = d["version"]
-
-    server_vers = get_server_version()
-
-    seq_num_suffix = f'-{seq_num}' if seq_num > 0 else ''
-
-    oca_tag = f'{ise_vers}-{server_vers}{seq_num_suffix}'
+    ise_vers = resolved_conf().ise_package_version
+    server_vers = resolved_conf().server_version
+    oca_tag = get_oca_release_tag(seq_num)
 
     set_supporting_software_versions_for_server_in_conf()
     print('Building with versions:')
@@ -130,7 +137,7 @@ def server(skip_check, demos, dump, dry_run):
     if not os.path.exists(venv_path):
         raise click.FileError(f'Could not find {venv_path}. Have you installed pfsc-server yet?')
 
-    server_vers = get_server_version()
+    server_vers = resolved_conf().server_version
 
     tag = server_vers
 
@@ -143,3 +150,46 @@ def server(skip_check, demos, dump, dry_run):
             return
 
     tools.build.server.callback(demos, dump, dry_run, tag)
+
+
+@release.command(name='all')
+@click.option(
+    '-n', '--seq-num', default=0, type=int,
+    help="Sequence number for the OCA. If positive n, will be appended on tag as `-n`."
+)
+@click.option(
+    '-y', '--skip-check', is_flag=True,
+    help="Skip tag check."
+)
+@click.option('-j', '--jobs', type=click.IntRange(min=1), default=2, help="Max number of builds to run at once. Default 2.")
+@click.option('--dry-run', is_flag=True, help="Do not actually build; just print docker commands (in the logs).")
+def release_all(seq_num, skip_check, jobs, dry_run):
+    """
+    Build `pfsc-server` and `pise` docker images for release, concurrently.
+
+    Tags are generated as for `pfsc release server` and `pfsc release oca`.
+    Unless you say to skip it, there will be one prompt to check both tags.
+    Each build writes its output to a log file under PFSC_ROOT/build-cache/logs.
+    """
+    tools.build.oca_readiness_checks(release=True)
+    server_tag = resolved_conf().server_version
+    oca_tag = get_oca_release_tag(seq_num)
+
+    if skip_check:
+        print(f'Using tags "pfsc-server:{server_tag}" and "pise:{oca_tag}".')
+    else:
+        ok = input(f'Will use tags: "pfsc-server:{server_tag}" and "pise:{oca_tag}". Okay? [y/N] ')
+        if ok != 'y':
+            print('Aborting')
+            return
+
+    dry = ['--dry-run'] if dry_run else []
+    nodes = {
+        'base': BuildNode('base', ['build', 'base'] + dry),
+        'server': BuildNode('server', ['release', 'server', '-y'] + dry, ['base']),
+        'oca': BuildNode('oca', ['release', 'oca', '-y', '-n', str(seq_num)] + dry, ['base']),
+    }
+    log_dir = os.path.join(tools.build.BUILD_LOG_ROOT, simple_timestamp())
+    wall_seconds = run_build_graph(nodes, jobs, log_dir)
+    click.echo(write_build_summary(nodes, wall_seconds))
+    tools.build.check_build_failures(nodes)
@@ -0,0 +1,140 @@
+# --------------------------------------------------------------------------- #
+#   Proofscape Manage                                                         #
+#                                                                             #
+#   Copyright (c) 2021-2022 Proofscape contributors                           #
+#                                                                             #
+#   Licensed under the Apache License, Version 2.0 (the "License");           #
+#   you may not use this file except in compliance with the License.          #
+#   You may obtain a copy of the License at                                   #
+#                                                                             #
+#       http://www.apache.org/licenses/LICENSE-2.0                            #
+#                                                                             #
+#   Unless required by applicable law or agreed to in writing, software       #
+#   distributed under the License is distributed on an "AS IS" BASIS,         #
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.  #
+#   See the License for the specific language governing permissions and       #
+#   limitations under the License.                                            #
+# --------------------------------------------------------------------------- #
+
+"""
+A single, process-wide object giving access to values derived from `conf.py`
+and from files in the source repos under `PFSC_ROOT/src`.
+
+Derived values are computed on first use, and memoized. Each memoized value
+is recorded together with a "stamp": the raw conf values it was derived from,
+or the mtimes of the files it was read from. A value is recomputed only when
+its stamp changes, so the object can also be used safely in a long-running
+process, or after `conf` has been altered, as in release builds.
+"""
+
+import json
+import os
+
+import conf as pfsc_conf
+from manage import PFSC_ROOT
+from tools.util import (
+    resolve_fs_path, check_app_url_prefix, get_server_version,
+    get_supporting_software_versions_for_server,
+)
+
+SERVER_DIR = os.path.join(PFSC_ROOT, 'src', 'pfsc-server')
+WHL_DIR = os.path.join(PFSC_ROOT, 'src', 'whl')
+
+
+def get_mtime(path):
+    """
+    Get the mtime of a file or directory, or `None` if it does not exist.
+    """
+    try:
+        return os.stat(path).st_mtime_ns
+    except OSError:
+        return None
+
+
+class ResolvedConf:
+    """
+    Use the `resolved_conf()` function to get the instance of this class.
+    """
+
+    def __init__(self):
+        self.memo = {}
+
+    def memoize(self, key, stamp, compute):
+        """
+        Return the memoized value under `key` if it was computed under the
+        same `stamp`; else compute it, memoize it, and return it.
+        """
+        entry = self.memo.get(key)
+        if entry is not None and entry[0] == stamp:
+            return entry[1]
+        value = compute()
+        self.memo[key] = (stamp, value)
+        return value
+
+    def clear(self):
+        self.memo.clear()
+
+    def fs_path(self, var_name):
+        """
+        Resolved filesystem path for a conf var. See `tools.util.resolve_fs_path()`.
+        """
+        raw = getattr(pfsc_conf, var_name)
+        return self.memoize(('fs_path', var_name), raw,
+                            lambda: resolve_fs_path(var_name))
+
+    @property
+    def url_prefixes(self):
+        """
+        The pair (root_url, app_url_prefix). See `tools.util.check_app_url_prefix()`.
+        """
+        raw = getattr(pfsc_conf, 'APP_URL_PREFIX', None)
+        return self.memoize('url_prefixes', raw, check_app_url_prefix)
+
+    @property
+    def server_version(self):
+        """
+        The version number of pfsc-server, as read from its source code.
+        """
+        stamp = get_mtime(os.path.join(SERVER_DIR, 'pfsc', '__init__.py'))
+        return self.memoize('server_version', stamp, get_server_version)
+
+    @property
+    def supporting_software_versions(self):
+        """
+        The default versions of supporting software, as read from
+        pfsc-server's `pfsc.ini`.
+        """
+        stamp = get_mtime(os.path.join(SERVER_DIR, 'pfsc.ini'))
+        return self.memoize('supporting_software_versions', stamp,
+                            get_supporting_software_versions_for_server)
+
+    @property
+    def ise_package_version(self):
+        """
+        The version number of pfsc-ise, as read from its `package.json`.
+        """
+        path = os.path.join(PFSC_ROOT, 'src', 'pfsc-ise', 'package.json')
+
+        def read_version():
+            with open(path) as f:
+                return json.load(f)["version"]
+
+        return self.memoize('ise_package_version', get_mtime(path), read_version)
+
+    @property
+    def wheel_filenames(self):
+        """
+        The wheel filenames selected from `PFSC_ROOT/src/whl`. See
+        `tools.deploy.select_wheel_filenames()`.
+        """
+        from tools.deploy import select_wheel_filenames
+        stamp = get_mtime(WHL_DIR)
+        return self.memoize('wheel_filenames', stamp,
+                            lambda: tuple(select_wheel_filenames()))
+
+
+RESOLVED_CONF = ResolvedConf()
+
+
+def resolved_conf():
+    return RESOLVED_CONF
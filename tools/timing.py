@@ -0,0 +1,113 @@
+# --------------------------------------------------------------------------- #
+#   Proofscape Manage                                                         #
+#                                                                             #
+#   Copyright (c) 2021-2022 Proofscape contributors                           #
+#                                                                             #
+#   Licensed under the Apache License, Version 2.0 (the "License");           #
+#   you may not use this file except in compliance with the License.          #
+#   You may obtain a copy of the License at                                   #
+#                                                                             #
+#       http://www.apache.org/licenses/LICENSE-2.0                            #
+#                                                                             #
+#   Unless required by applicable law or agreed to in writing, software       #
+#   distributed under the License is distributed on an "AS IS" BASIS,         #
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.  #
+#   See the License for the specific language governing permissions and       #
+#   limitations under the License.                                            #
+# --------------------------------------------------------------------------- #
+
+"""
+Instrumentation for the `pfsc` command.
+
+When the `--timings` option is passed to `pfsc`, phases of work marked with
+the `phase()` context manager (subprocesses, downloads, template rendering,
+etc.) are timed, and a table of the results is printed when the command
+finishes. Otherwise `phase()` does nothing beyond yielding.
+
+When the `--profile FILE` option is passed, the command is run under cProfile,
+and the stats are dumped to FILE, for examination with `pstats` or a viewer
+like `snakeviz`.
+"""
+
+import cProfile
+from contextlib import contextmanager
+import time
+
+import click
+
+enabled = False
+
+# List of triples (label, kind, seconds):
+records = []
+
+
+def record(label, kind, seconds):
+    if enabled:
+        records.append((label, kind, seconds))
+
+
+@contextmanager
+def phase(label, kind='phase'):
+    """
+    Time a phase of work.
+
+    :param label: a description of the work, e.g. the command being run.
+    :param kind: a short word classifying the work, e.g. 'subprocess',
+      'download', 'template'.
+    """
+    if not enabled:
+        yield
+        return
+    t0 = time.perf_counter()
+    try:
+        yield
+    finally:
+        record(label, kind, time.perf_counter() - t0)
+
+
+def write_timing_table(total_seconds):
+    """
+    Write a table of all recorded phases, slowest first.
+    """
+    header = f'{"seconds":>9s} {"%":>6s}  {"kind":10s}  label'
+    lines = [header, '-' * 79]
+    for label, kind, seconds in sorted(records, key=lambda r: -r[2]):
+        pct = 100 * seconds / total_seconds if total_seconds else 0
+        lines.append(f'{seconds:9.3f} {pct:6.1f}  {kind:10s}  {label}')
+    lines.append('-' * 79)
+    lines.append(f'{total_seconds:9.3f} {100.0:6.1f}  total')
+    return '\n'.join(lines)
+
+
+def start_session(ctx, timings=False, profile_path=None):
+    """
+    Start timing and/or profiling, and arrange for results to be reported when
+    the click context `ctx` is closed, i.e. after the invoked command is done.
+    """
+    global enabled
+    t0 = time.perf_counter()
+
+    if timings:
+        enabled = True
+        # Imports happen before the session starts, so we count them
+        # separately, and add them to the total.
+        import manage
+        record('import conf', 'import', manage.CONF_IMPORT_SECONDS)
+        for module_name, seconds in manage.cli.import_seconds.items():
+            record(f'import {module_name}', 'import', seconds)
+        t0 -= sum(r[2] for r in records)
+
+    profiler = None
+    if profile_path:
+        profiler = cProfile.Profile()
+        profiler.enable()
+
+    def finish():
+        if profiler is not None:
+            profiler.disable()
+            profiler.dump_stats(profile_path)
+            click.echo(f'Wrote profile stats to {profile_path}', err=True)
+        if timings:
+            click.echo(write_timing_table(time.perf_counter() - t0), err=True)
+
+    ctx.call_on_close(finish)
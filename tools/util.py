@@ -26,6 +26,7 @@ import click
 
 import conf as pfsc_conf
 from manage import PFSC_ROOT
+from tools import timing
 
 def simple_timestamp():
     return datetime.now().strftime('%y%m%d_%H%M%S')
@@ -119,7 +120,8 @@ def do_commands_in_directory(cmds, path, dry_run=True, quiet=False):
         if not quiet:
             print(full_cmd)
         if not dry_run:
-            os.system(full_cmd)
+            with timing.phase(full_cmd, 'subprocess'):
+                os.system(full_cmd)
 
 
 def get_supporting_software_versions_for_server():
@@ -139,7 +141,8 @@ def set_supporting_software_versions_for_server_in_conf():
     whatever we may have set in our current conf.py.
     This is important in release builds.
     """
-    versions = get_supporting_software_versions_for_server()
+    from tools.resolved import resolved_conf
+    versions = resolved_conf().supporting_software_versions
     pfsc_conf.CommonVars.ISE_VERSION = versions['ise']
     pfsc_conf.CommonVars.ELKJS_VERSION = versions['elkjs']
     pfsc_conf.CommonVars.MATHJAX_VERSION = versions['mathjax']
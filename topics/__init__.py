@@ -0,0 +1,182 @@
+# --------------------------------------------------------------------------- #
+#   Proofscape Manage                                                         #
+#                                                                             #
+#   Copyright (c) 2021-2022 Proofscape contributors                           #
+#                                                                             #
+#   Licensed under the Apache License, Version 2.0 (the "License");           #
+#   you may not use this file except in compliance with the License.          #
+#   You may obtain a copy of the License at                                   #
+#                                                                             #
+#       http://www.apache.org/licenses/LICENSE-2.0                            #
+#                                                                             #
+#   Unless required by applicable law or agreed to in writing, software       #
+#   distributed under the License is distributed on an "AS IS" BASIS,         #
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.  #
+#   See the License for the specific language governing permissions and       #
+#   limitations under the License.                                            #
+# --------------------------------------------------------------------------- #
+
+"""
+All Jinja templates used by pfsc-manage are served by a single, shared Jinja
+environment, which keeps compiled templates in an on-disk bytecode cache, so
+that we don't have to recompile them on every run of the `pfsc` command.
+
+Templates that live in a topic's `templates` directory are named with the
+topic as prefix, e.g. 'pfsc/Dockerfile.oca'. Each topic can get a view onto its
+own templates via `topic_templates()`.
+
+Templates that are defined inline, as strings in Python modules, should be
+made via `inline_template()`, which registers them under the 'inline' prefix.
+
+Rendered Dockerfile instructions can be traced back to the template lines that
+produced them, via `locate_template_line()`.
+"""
+
+import os
+import re
+
+import jinja2
+
+from manage import PFSC_ROOT
+from tools import timing
+
+TOPICS_DIR = os.path.dirname(__file__)
+TOPICS_WITH_TEMPLATES = [
+    'dummy', 'elk', 'gremlin', 'nginx', 'pfsc', 'redis', 'static',
+]
+
+JINJA_CACHE_DIR = os.path.join(PFSC_ROOT, 'build-cache', 'jinja')
+
+
+def make_bytecode_cache():
+    """
+    Make the bytecode cache, or return `None` if we cannot make its directory,
+    in which case templates are simply compiled on every run.
+    """
+    try:
+        os.makedirs(JINJA_CACHE_DIR, exist_ok=True)
+    except OSError:
+        return None
+    return jinja2.FileSystemBytecodeCache(JINJA_CACHE_DIR)
+
+
+class TimedTemplate(jinja2.Template):
+    """
+    Template class whose rendering is recorded when `--timings` is on.
+    """
+
+    def render(self, *args, **kwargs):
+        with timing.phase(self.name, 'template'):
+            return super().render(*args, **kwargs)
+
+
+inline_sources = {}
+
+jinja_env = jinja2.Environment(
+    loader=jinja2.PrefixLoader(dict(
+        {
+            topic: jinja2.FileSystemLoader(os.path.join(TOPICS_DIR, topic, 'templates'))
+            for topic in TOPICS_WITH_TEMPLATES
+        },
+        inline=jinja2.DictLoader(inline_sources),
+    )),
+    bytecode_cache=make_bytecode_cache(),
+)
+jinja_env.template_class = TimedTemplate
+
+
+class TopicTemplates:
+    """
+    A view onto the shared Jinja environment, giving access to the templates
+    of a single topic, by their names within that topic.
+    """
+
+    def __init__(self, topic):
+        self.topic = topic
+
+    def get_template(self, name):
+        return jinja_env.get_template(f'{self.topic}/{name}')
+
+
+def topic_templates(topic):
+    return TopicTemplates(topic)
+
+
+def inline_template(name, source):
+    """
+    Register a template defined inline, and return it, compiled.
+
+    :param name: a name for the template, unique among all inline templates.
+      By convention, this is prefixed by the name of the module where it is
+      defined, e.g. 'deploy/dc_script'.
+    :param source: the source text of the template.
+    :return: `jinja2.Template`
+    """
+    inline_sources[name] = source
+    return jinja_env.get_template(f'inline/{name}')
+
+
+DOCKERFILE_INSTRUCTIONS = {
+    'ADD', 'ARG', 'CMD', 'COPY', 'ENTRYPOINT', 'ENV', 'EXPOSE', 'FROM',
+    'HEALTHCHECK', 'LABEL', 'ONBUILD', 'RUN', 'SHELL', 'STOPSIGNAL', 'USER',
+    'VOLUME', 'WORKDIR',
+}
+# A conditional section within a single line, or any other Jinja tag:
+JINJA_ONE_LINE_IF = re.compile(r'{%-?\s*if\b.*?%}.*?{%-?\s*endif\s*-?%}')
+JINJA_TAG = re.compile(r'{{.*?}}|{%.*?%}|{#.*?#}')
+
+
+def template_line_pattern(line):
+    """
+    Make a regex that matches the start of any Dockerfile instruction that
+    could be rendered from a given template line.
+
+    :return: pair (compiled regex, number of literal chars in the pattern), or
+      `(None, 0)` if the line does not begin a Dockerfile instruction
+    """
+    text = line.strip()
+    if text.endswith('\\'):
+        text = text[:-1]
+    text = JINJA_ONE_LINE_IF.sub('{{}}', text)
+    literals = [' '.join(part.split()) for part in JINJA_TAG.split(text)]
+    words = literals[0].split()
+    if not words or words[0].upper() not in DOCKERFILE_INSTRUCTIONS:
+        return None, 0
+    pattern = '.*?'.join(re.escape(lit) for lit in literals)
+    return re.compile(pattern), sum(len(lit) for lit in literals)
+
+
+_template_line_patterns = None
+
+
+def get_template_line_patterns():
+    global _template_line_patterns
+    if _template_line_patterns is None:
+        _template_line_patterns = []
+        for name in jinja_env.list_templates():
+            if not os.path.basename(name).startswith('Dockerfile'):
+                continue
+            source, _, _ = jinja_env.loader.get_source(jinja_env, name)
+            for i, line in enumerate(source.split('\n')):
+                regex, score = template_line_pattern(line)
+                if regex:
+                    _template_line_patterns.append((regex, score, f'{name}:{i + 1}'))
+    return _template_line_patterns
+
+
+def locate_template_line(instruction):
+    """
+    Find the template line that most likely produced a rendered Dockerfile
+    instruction. When several lines could have, we choose the one matching
+    the most literal text.
+
+    :param instruction: the text of the instruction, with continuation lines
+      joined
+    :return: string 'TEMPLATE_NAME:LINE_NUMBER', or `None` if not found
+    """
+    text = ' '.join(instruction.split())
+    best, best_score = None, -1
+    for regex, score, location in get_template_line_patterns():
+        if score > best_score and regex.match(text):
+            best, best_score = location, score
+    return best
@@ -16,24 +16,19 @@
 #   limitations under the License.                                            #
 # --------------------------------------------------------------------------- #
 
-import os
+from topics import topic_templates
 
-import click
-import jinja2
 
-
-this_dir = os.path.dirname(__file__)
-templates_dir = os.path.join(this_dir, 'templates')
-jinja_env = jinja2.Environment(loader=jinja2.FileSystemLoader(templates_dir))
+templates = topic_templates('dummy')
 
 
 def write_web_py():
-    template = jinja_env.get_template('web.py')
+    template = templates.get_template('web.py')
     return template.render()+'\n'
 
 
 def write_dummy_server_dockerfile(tmp_dir_name):
-    template = jinja_env.get_template('Dockerfile')
+    template = templates.get_template('Dockerfile')
     return template.render(
         tmp_dir_name=tmp_dir_name,
     )
@@ -16,15 +16,12 @@
 #   limitations under the License.                                            #
 # --------------------------------------------------------------------------- #
 
-import os
-import jinja2
+from topics import topic_templates
 
-this_dir = os.path.dirname(__file__)
-templates_dir = os.path.join(this_dir, 'templates')
-jinja_env = jinja2.Environment(loader=jinja2.FileSystemLoader(templates_dir))
+templates = topic_templates('elk')
 
 def write_elk_build_env_dockerfile():
-    template = jinja_env.get_template('Dockerfile.build_env')
+    template = templates.get_template('Dockerfile.build_env')
     return template.render(
     )
 
@@ -16,12 +16,9 @@
 #   limitations under the License.                                            #
 # --------------------------------------------------------------------------- #
 
-import os
-import jinja2
+from topics import topic_templates
 
-this_dir = os.path.dirname(__file__)
-templates_dir = os.path.join(this_dir, 'templates')
-jinja_env = jinja2.Environment(loader=jinja2.FileSystemLoader(templates_dir))
+templates = topic_templates('gremlin')
 
 def write_gremlin_dockerfile():
     """
@@ -34,5 +31,5 @@ def write_gremlin_dockerfile():
 
     For now, keeping this here for historical purposes.
     """
-    template = jinja_env.get_template('Dockerfile')
+    template = templates.get_template('Dockerfile')
     return template.render()
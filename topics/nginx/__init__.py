@@ -16,15 +16,43 @@
 #   limitations under the License.                                            #
 # --------------------------------------------------------------------------- #
 
-import os
-import jinja2
+import re
+
+import click
 
 import conf as pfsc_conf
-from tools.util import squash, get_server_version
+from tools.util import squash
+from tools.resolved import resolved_conf
+from topics import topic_templates
+
+templates = topic_templates('nginx')
+
+# Static paths with a version component, like `/ise/v25.0`, serve files that
+# never change.
+VERSIONED_PATH = re.compile(r'/v\d')
+
+PROXY_COMPRESS_METHODS = ['gzip', 'brotli']
+# MIME types of proxied responses worth compressing. (nginx always compresses
+# text/html when compression is on, and warns if it is listed.)
+PROXY_COMPRESS_TYPES = """
+application/json application/javascript text/javascript text/css
+text/plain text/xml application/xml image/svg+xml
+""".split()
+# Level 5 gets most of the size reduction of the highest levels, at a fraction
+# of the CPU time, which matters when compressing on every request.
+PROXY_COMPRESS_LEVEL = 5
+# Responses smaller than this gain little, relative to the headers.
+PROXY_COMPRESS_MIN_LENGTH = 1024
+
+
+def get_proxy_compress_methods():
+    methods = getattr(pfsc_conf, 'NGINX_PROXY_COMPRESS', ['gzip'])
+    unknown = set(methods) - set(PROXY_COMPRESS_METHODS)
+    if unknown:
+        raise click.UsageError(
+            f'NGINX_PROXY_COMPRESS in conf.py may contain only: {", ".join(PROXY_COMPRESS_METHODS)}')
+    return methods
 
-this_dir = os.path.dirname(__file__)
-templates_dir = os.path.join(this_dir, 'templates')
-jinja_env = jinja2.Environment(loader=jinja2.FileSystemLoader(templates_dir))
 
 def write_nginx_conf(
         listen_on=80, server_name='localhost',
@@ -32,7 +60,18 @@ def write_nginx_conf(
         static_redir=None, static_acao=False,
         redir_http=False, twin_server_name=None,
         hsts_seconds=None,
+        pfsc_web_servers=None, upstream_keepalive=32,
+        static_caching=True,
         **kwargs):
+    # If `pfsc_web_servers` is given, it should be a list of `host:port`
+    # strings, naming the pfsc web server replicas. These are then grouped as
+    # an upstream, with idle keepalive connections up to `upstream_keepalive`
+    # per worker process. Otherwise we proxy directly to `pfsc_web_hostname`.
+    #
+    # If `static_caching` is false, no caching headers are sent for static
+    # assets, e.g. for development, where the assets change under fixed
+    # version numbers.
+    #
     # Define mapping {URL_path_extension: nginx_subdir}.
     # This means URLs pointing to
     #   {{app_url_prefix}}/static{{path_ext}}
@@ -41,7 +80,7 @@ def write_nginx_conf(
     # in the Nginx container.
     # Note: originally, this was not the identity map! Could maybe turn into
     # a mere list now, but for the moment I'm keeping it as a map.
-    server_vers = get_server_version()
+    server_vers = resolved_conf().server_version
     loc_map = {
         '/PDFLibrary': '/PDFLibrary',
         f'/pdfjs/v{pfsc_conf.CommonVars.PDFJS_VERSION}': f'/pdfjs/v{pfsc_conf.CommonVars.PDFJS_VERSION}',
@@ -54,7 +93,17 @@ def write_nginx_conf(
         '/dojo': '/dojo',
         f'/ise/v{pfsc_conf.CommonVars.ISE_VERSION}': f'/ise/v{pfsc_conf.CommonVars.ISE_VERSION}',
     }
-    template = jinja_env.get_template('nginx.conf')
+    cache_control = {}
+    if static_caching and getattr(pfsc_conf, 'NGINX_STATIC_CACHING', True):
+        max_age = getattr(pfsc_conf, 'NGINX_STATIC_MAX_AGE', 3600)
+        cache_control = {
+            path_ext: (
+                'public, max-age=31536000, immutable' if VERSIONED_PATH.search(path_ext)
+                else f'public, max-age={max_age}'
+            )
+            for path_ext in loc_map
+        }
+    template = templates.get_template('nginx.conf')
     return squash(template.render(
         listen_on=listen_on,
         redir_http=redir_http,
@@ -65,6 +114,16 @@ def write_nginx_conf(
         basic_auth_title=basic_auth_title,
         static_redir=static_redir, static_acao=static_acao,
         loc_map=loc_map,
+        cache_control=cache_control,
+        sendfile=getattr(pfsc_conf, 'NGINX_SENDFILE', True),
+        open_file_cache=getattr(pfsc_conf, 'NGINX_OPEN_FILE_CACHE', True),
+        aio_threads=getattr(pfsc_conf, 'NGINX_AIO_THREADS', True),
+        proxy_compress=get_proxy_compress_methods(),
+        compress_types=' '.join(PROXY_COMPRESS_TYPES),
+        compress_level=PROXY_COMPRESS_LEVEL,
+        compress_min_length=PROXY_COMPRESS_MIN_LENGTH,
+        pfsc_web_servers=pfsc_web_servers,
+        upstream_keepalive=upstream_keepalive,
         **kwargs
     ))
 
@@ -74,7 +133,7 @@ def write_maintenance_nginx_conf(
         ssl=False, basic_auth_title=None,
         redir_http=False,
         **kwargs):
-    template = jinja_env.get_template('maintenance_nginx.conf')
+    template = templates.get_template('maintenance_nginx.conf')
     return squash(template.render(
         listen_on=listen_on,
         redir_http=redir_http,
@@ -16,20 +16,19 @@
 #   limitations under the License.                                            #
 # --------------------------------------------------------------------------- #
 
-import os
 import pathlib
 
 import click
-import jinja2
 
 import conf
 from manage import PFSC_ROOT
 from tools.util import squash
 from tools.deploy import list_wheel_filenames
+from topics import topic_templates
 
-this_dir = os.path.dirname(__file__)
-templates_dir = os.path.join(this_dir, 'templates')
-jinja_env = jinja2.Environment(loader=jinja2.FileSystemLoader(templates_dir))
+templates = topic_templates('pfsc')
+
+SUPERVISOR_VERSION = '4.2.4'
 
 
 ##############################################################################
@@ -37,29 +36,33 @@ jinja_env = jinja2.Environment(loader=jinja2.FileSystemLoader(templates_dir))
 
 def write_startup_system(
         dir_where_startup_system_lives,
-        numbered_inis=None, tmp_dir_name=None):
+        numbered_inis=None, tmp_dir_name=None, buildkit=False):
     numbered_inis = numbered_inis or {}
-    template = jinja_env.get_template(f'Dockerfile.startup_system')
+    template = templates.get_template(f'Dockerfile.startup_system')
     return template.render(
         dir_where_startup_system_lives=dir_where_startup_system_lives,
         numbered_inis=numbered_inis,
         tmp_dir_name=tmp_dir_name,
         ensure_dirs=True,
+        buildkit=buildkit,
+        supervisor_version=SUPERVISOR_VERSION,
     )
 
 
 def write_oca_eula_file(version):
-    template = jinja_env.get_template('EULA.txt')
+    template = templates.get_template('EULA.txt')
     return template.render(
         version=version,
     )
 
 
-def write_pfsc_installation(
-        python_cmd='python',
-        ubuntu=True, demos=False, use_venv=False,
-        oca_version_file=None, eula_file=None):
-
+def write_pfsc_base_dockerfile(
+        python_cmd='python', ubuntu=True, use_venv=False,
+        buildkit=False, bytecode='strip'):
+    """
+    Write the Dockerfile for the pfsc-base image, which has the Python runtime
+    and the pfsc-server requirements.
+    """
     # At this time, we have no python packages to be installed locally.
     # If this once again becomes necessary, the 'Dockerfile.localreqs' file
     # in topics/pfsc/templates shows how we used to handle this with the
@@ -67,15 +70,24 @@ def write_pfsc_installation(
     # `local_reqs` variable here equal to its rendered contents.
     local_reqs = ''
 
-    template = jinja_env.get_template(f'Dockerfile.pfsc')
-    return template.render(
+    template = templates.get_template('Dockerfile.pfsc_base')
+    df = template.render(
         python_cmd=python_cmd,
         ubuntu=ubuntu,
-        demos=demos,
         use_venv=use_venv,
+        local_reqs=local_reqs,
+        buildkit=buildkit,
+        bytecode=bytecode,
+    )
+    return squash(df)
+
+
+def write_pfsc_installation(demos=False, oca_version_file=None, eula_file=None):
+    template = templates.get_template(f'Dockerfile.pfsc')
+    return template.render(
+        demos=demos,
         oca_version_file=oca_version_file,
         eula_file=eula_file,
-        local_reqs=local_reqs,
     )
 
 
@@ -84,9 +96,14 @@ def get_pyodide_major_minor_as_ints():
     return int(M), int(m)
 
 
-def write_oca_static_setup(tmp_dir_name, nginx=False):
-    template = jinja_env.get_template('Dockerfile.oca_static')
+def list_oca_static_assets():
+    """
+    List the static assets that go into the OCA.
 
+    :return: list of pairs (src, dst), where src is a path relative to
+      `PFSC_ROOT/src`, and dst is the path relative to the static dir in the
+      image. Each src is either a file or a directory.
+    """
     pyodide_files = """
     pyodide.js pyodide_py.tar pyodide.asm.js pyodide.asm.data pyodide.asm.wasm
     """.split()
@@ -95,6 +112,7 @@ def write_oca_static_setup(tmp_dir_name, nginx=False):
     micropip pyparsing packaging Jinja2 MarkupSafe mpmath
     """.split()
 
+    vers_dir_name = f'v{conf.CommonVars.PYODIDE_VERSION}'
     M, m = get_pyodide_major_minor_as_ints()
     if (M, m) < (0, 20):
         pyodide_files.extend(['packages.json', 'distutils.js', 'distutils.data'])
@@ -106,7 +124,6 @@ def write_oca_static_setup(tmp_dir_name, nginx=False):
             pyodide_files.append('packages.json')
         else:
             pyodide_files.append('repodata.json')
-        vers_dir_name = f'v{conf.CommonVars.PYODIDE_VERSION}'
         vers_path = pathlib.Path(PFSC_ROOT) / 'src' / 'pyodide' / vers_dir_name
         for name in project_names:
             paths = list(vers_path.glob(f'{name}-*.whl'))
@@ -115,21 +132,45 @@ def write_oca_static_setup(tmp_dir_name, nginx=False):
             path = paths[0]
             pyodide_files.append(path.name)
 
+    assets = [
+        (f'pyodide/{vers_dir_name}/{filename}', f'pyodide/{vers_dir_name}/{filename}')
+        for filename in pyodide_files
+    ]
+    assets += [
+        (f'whl/{whl_filename}', f'whl/{whl_filename}')
+        for whl_filename in list_wheel_filenames()
+    ]
+    assets += [
+        ('pfsc-ise/dist/ise', f'ise/v{conf.CommonVars.ISE_VERSION}'),
+        ('pfsc-ise/dist/dojo', 'dojo'),
+        ('pfsc-ise/dist/mathjax', f'mathjax/v{conf.CommonVars.MATHJAX_VERSION}'),
+        ('pfsc-ise/dist/elk', f'elk/v{conf.CommonVars.ELKJS_VERSION}'),
+        ('pfsc-pdf/build/generic', f'pdfjs/v{conf.CommonVars.PDFJS_VERSION}'),
+    ]
+    return assets
+
+
+def write_oca_static_setup(tmp_dir_name, nginx=False):
+    """
+    Write the Dockerfile section that installs the OCA's static assets.
+
+    The assets must already have been staged under `{tmp_dir_name}/static`,
+    laid out as in the final static dir, so that we can copy them all in a
+    single layer. See `tools.build.stage_oca_static_assets()`.
+
+    If serving with nginx, we also precompress the assets, for `gzip_static`.
+    """
+    from topics.static import write_precompress_section
+    template = templates.get_template('Dockerfile.oca_static')
     return template.render(
         tmp_dir_name=tmp_dir_name,
         nginx=nginx,
-        ise_version_dir_name=f'v{conf.CommonVars.ISE_VERSION}',
-        mathjax_version_dir_name=f'v{conf.CommonVars.MATHJAX_VERSION}',
-        elk_version_dir_name=f'v{conf.CommonVars.ELKJS_VERSION}',
-        pdfjs_version_dir_name=f'v{conf.CommonVars.PDFJS_VERSION}',
-        pyodide_version_dir_name=vers_dir_name,
-        pyodide_files=pyodide_files,
-        wheels=list_wheel_filenames(),
+        precompress=write_precompress_section('/usr/share/nginx') if nginx else '',
     )
 
 
-def write_oca_final_setup(tmp_dir_name, final_workdir='/home/pfsc'):
-    template = jinja_env.get_template('Dockerfile.oca_final_setup')
+def write_oca_final_setup(tmp_dir_name, final_workdir='/home/pfsc', bytecode='strip'):
+    template = templates.get_template('Dockerfile.oca_final_setup')
     return template.render(
         tmp_dir_name=tmp_dir_name,
         final_workdir=final_workdir,
@@ -139,6 +180,7 @@ def write_oca_final_setup(tmp_dir_name, final_workdir='/home/pfsc'):
         pdfjs_version=conf.CommonVars.PDFJS_VERSION,
         pyodide_version=conf.CommonVars.PYODIDE_VERSION,
         wheel_filenames=','.join(list_wheel_filenames()),
+        bytecode=bytecode,
     )
 
 
@@ -157,7 +199,7 @@ def write_oca_nginx_conf():
 
 
 def write_worker_and_web_supervisor_ini(worker=True, web=True, use_venv=True, oca=False):
-    template = jinja_env.get_template('pfsc.ini')
+    template = templates.get_template('pfsc.ini')
     return template.render(
         use_venv=use_venv,
         worker=worker,
@@ -168,20 +210,27 @@ def write_worker_and_web_supervisor_ini(worker=True, web=True, use_venv=True, oc
 ##############################################################################
 # Whole Dockerfiles
 
-def write_single_service_dockerfile(demos=False):
-    pfsc_install = write_pfsc_installation(
-        ubuntu=True, demos=demos, use_venv=False
-    )
-    template = jinja_env.get_template('Dockerfile.single_service')
+def write_single_service_dockerfile(base_image, demos=False, bytecode='strip'):
+    """
+    :param base_image: name:tag of the pfsc-base image to build `FROM`
+    """
+    pfsc_install = write_pfsc_installation(demos=demos)
+    template = templates.get_template('Dockerfile.single_service')
     df = template.render(
+        base_image=base_image,
         pfsc_install=pfsc_install,
+        bytecode=bytecode,
     )
     return squash(df)
 
 
-def write_proofscape_oca_dockerfile(tmp_dir_name, demos=False):
+def write_proofscape_oca_dockerfile(tmp_dir_name, base_image, demos=False, buildkit=False,
+                                    license_bundle_dir=None, bytecode='strip'):
+    """
+    :param base_image: name:tag of the pfsc-base image to build `FROM`
+    """
     pfsc_install = write_pfsc_installation(
-        ubuntu=True, demos=demos, use_venv=False,
+        demos=demos,
         oca_version_file=f'{tmp_dir_name}/oca_version.txt',
         eula_file=f'{tmp_dir_name}/eula.txt',
     )
@@ -189,21 +238,24 @@ def write_proofscape_oca_dockerfile(tmp_dir_name, demos=False):
         '/home/pfsc', numbered_inis={
             100: 'redisgraph',
             200: 'pfsc',
-        }, tmp_dir_name=tmp_dir_name
+        }, tmp_dir_name=tmp_dir_name, buildkit=buildkit
     )
     static_setup = write_oca_static_setup(
         tmp_dir_name, nginx=False
     )
     final_setup = write_oca_final_setup(
-        tmp_dir_name, final_workdir='/home/pfsc'
+        tmp_dir_name, final_workdir='/home/pfsc', bytecode=bytecode
     )
-    template = jinja_env.get_template('Dockerfile.oca')
+    template = templates.get_template('Dockerfile.oca')
     df = template.render(
         redisgraph_image_tag=conf.REDISGRAPH_IMAGE_TAG,
+        base_image=base_image,
         pfsc_install=pfsc_install,
         startup_system=startup_system,
         static_setup=static_setup,
         final_setup=final_setup,
+        buildkit=buildkit,
+        license_bundle_dir=license_bundle_dir,
     )
     return squash(df)
 
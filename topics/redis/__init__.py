@@ -16,30 +16,26 @@
 #   limitations under the License.                                            #
 # --------------------------------------------------------------------------- #
 
-import os
-import jinja2
-
 import conf as pfsc_conf
+from topics import topic_templates, inline_template
 
-this_dir = os.path.dirname(__file__)
-templates_dir = os.path.join(this_dir, 'templates')
-jinja_env = jinja2.Environment(loader=jinja2.FileSystemLoader(templates_dir))
+templates = topic_templates('redis')
 
 
 def write_redisgraph_ini(use_conf_file=True):
-    template = jinja_env.get_template('redisgraph.ini')
+    template = templates.get_template('redisgraph.ini')
     return template.render(
         use_conf_file=use_conf_file,
     )
 
 
-REDIS_DOCKERFILE_TPLT = jinja2.Template("""\
+REDIS_DOCKERFILE_TPLT = inline_template('redis/dockerfile', """\
 FROM redis:{{redis_image_tag}}
 COPY {{tmp_dir_name}}/redis.conf /usr/local/etc/redis/redis.conf
 CMD [ "redis-server", "/usr/local/etc/redis/redis.conf" ]
 """)
 
-REDISGRAPH_DOCKERFILE_TPLT = jinja2.Template("""\
+REDISGRAPH_DOCKERFILE_TPLT = inline_template('redis/redisgraph_dockerfile', """\
 FROM redislabs/redisgraph:{{redisgraph_image_tag}}
 COPY {{tmp_dir_name}}/redisgraph.conf /usr/local/etc/redis/redisgraph.conf
 CMD [ "redis-server", "/usr/local/etc/redis/redisgraph.conf", "--loadmodule", "/usr/lib/redis/modules/redisgraph.so" ]
@@ -70,7 +66,7 @@ def write_redis_conf():
 
     The save rules are just the default ones.
     """
-    template = jinja_env.get_template('redis.conf')
+    template = templates.get_template('redis.conf')
     return template.render(
         ipv4_bind_addr='0.0.0.0',
         tcp_backlog=128,
@@ -86,7 +82,7 @@ def write_redisgraph_conf():
     We use the same settings as for Redis, except that we save once a minute,
     if anything at all has changed.
     """
-    template = jinja_env.get_template('redis.conf')
+    template = templates.get_template('redis.conf')
     return template.render(
         ipv4_bind_addr='0.0.0.0',
         tcp_backlog=128,
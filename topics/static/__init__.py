@@ -16,24 +16,80 @@
 #   limitations under the License.                                            #
 # --------------------------------------------------------------------------- #
 
-import os
-import jinja2
+import click
 
-from tools.util import check_app_url_prefix
+from tools.resolved import resolved_conf
+from topics import topic_templates
 import conf
 
-this_dir = os.path.dirname(__file__)
-templates_dir = os.path.join(this_dir, 'templates')
-jinja_env = jinja2.Environment(loader=jinja2.FileSystemLoader(templates_dir))
+templates = topic_templates('static')
+
+PRECOMPRESS_METHODS = ['gzip', 'brotli']
+# Extensions of the static files worth precompressing. (Others, like images
+# and fonts, are compressed already.)
+PRECOMPRESS_EXTENSIONS = """
+js mjs css html json map svg txt xml wasm data tar whl bcmap
+""".split()
+# Precompressed files are kept only if smaller than this percentage of the
+# original, and files smaller than this many bytes are not compressed:
+PRECOMPRESS_MAX_RATIO_PCT = 90
+PRECOMPRESS_MIN_SIZE = 1024
+
+# The assets in the pfsc-static-nginx image, as pairs (src, dst), where src is
+# a path relative to `PFSC_ROOT/src`, and dst is the dir under the image's
+# static root.
+STATIC_IMAGE_ASSETS = [
+    ('pfsc-server/pfsc/static', 'minsite'),
+    ('pfsc-ise/dist', 'ise'),
+    ('pfsc-pdf/build/generic', 'pdfjs'),
+]
+
+
+def get_precompress_methods():
+    methods = getattr(conf, 'STATIC_PRECOMPRESS', ['gzip'])
+    unknown = set(methods) - set(PRECOMPRESS_METHODS)
+    if unknown:
+        raise click.UsageError(
+            f'STATIC_PRECOMPRESS in conf.py may contain only: {", ".join(PRECOMPRESS_METHODS)}')
+    return methods
+
+
+def write_precompress_section(root):
+    """
+    Write a Dockerfile section that precompresses the static assets under a
+    given dir, according to the `STATIC_PRECOMPRESS` setting in `conf.py`.
+
+    :return: the section, or the empty string if there is nothing to do
+    """
+    methods = get_precompress_methods()
+    if not methods:
+        return ''
+    template = templates.get_template('Dockerfile.precompress')
+    return template.render(
+        root=root,
+        gzip='gzip' in methods,
+        brotli='brotli' in methods,
+        extensions=PRECOMPRESS_EXTENSIONS,
+        max_ratio_pct=PRECOMPRESS_MAX_RATIO_PCT,
+        min_size=PRECOMPRESS_MIN_SIZE,
+    )
+
 
 def write_static_nginx_dockerfile(tmp_dir_name):
-    template = jinja_env.get_template('Dockerfile')
+    template = templates.get_template('Dockerfile')
     return template.render(
         nginx_image_tag=conf.NGINX_IMAGE_TAG,
         tmp_dir_name=tmp_dir_name,
+        assets=STATIC_IMAGE_ASSETS,
+        precompress=write_precompress_section('/static'),
     )
 
 def write_nginx_conf():
-    root_url, app_url_prefix = check_app_url_prefix()
-    template = jinja_env.get_template('nginx.conf')
-    return template.render(app_url_prefix=app_url_prefix)
+    root_url, app_url_prefix = resolved_conf().url_prefixes
+    methods = get_precompress_methods()
+    template = templates.get_template('nginx.conf')
+    return template.render(
+        app_url_prefix=app_url_prefix,
+        gzip_static='gzip' in methods,
+        brotli_static='brotli' in methods,
+    )